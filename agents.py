@@ -12,11 +12,10 @@ import maze
 
 class Boid:
     """ This class defines the boid """
-    arrayLen = cfg.ARRDIM * cfg.Dimensions + 1
+    arrayLen = cfg.BOID_TRIANGLE_OFFSET + 1
     arraySize = np.dtype(np.float32).itemsize * arrayLen
 
     def __init__(self):
-        self.orientation = np.float32(0)  # TODO: randomize
         if cfg.bounding_rects_show:
             self.collided = False
 
@@ -45,7 +44,10 @@ class Boid:
         # TODO: change pheromone_level type to uint16
         pheromone_level = np.zeros([1], dtype=np.float32)
 
-        return np.concatenate((pos, vel, pheromone_level))
+        # Orientation and its template triangle
+        orientation = np.zeros([2], dtype=np.float32)  # TODO: randomize
+
+        return np.concatenate((pos, vel, pheromone_level, orientation))
 
 
 class Flock:
@@ -83,6 +85,11 @@ def load_from_pickle(amaze):
         print("Failed to load the pickle", os.path.join(os.getcwd(), cfg.flock_pickle_url))
         return None
 
+    if flock.np_arrays.shape[1] < Boid.arrayLen:
+        # Pickled before boids got more fields
+        flock.np_arrays = np.pad(flock.np_arrays,
+                                 ((0, 0), (0, Boid.arrayLen - flock.np_arrays.shape[1])))
+
     extended_flock = False
     if len(flock.object_list) < cfg.NumberOfBoids:
         print("Not enough boids in the pickle. Generating the missing ones.")
@@ -133,3 +140,13 @@ def generate_agents(n, amaze):
     flock = Flock(n)
     flock.init_array(amaze)
     return flock
+
+
+def get_random_seed():
+    """
+    Returns the key of the random numbers the agents draw on their own (see
+    cfg.random_seed). Without a configured seed it is drawn from NumPy's generator
+    """
+    if cfg.random_seed is not None:
+        return cfg.random_seed & 0xFFFFFFFF
+    return int(np.random.randint(0, 1 << 32, dtype=np.uint64))
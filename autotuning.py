@@ -0,0 +1,92 @@
+"""
+autotuning.py tunes the work group sizes of the OpenCL kernels for the device and the
+workload (swarm size and maze size) - see run() and main.py --autotune.
+The sizes are compiled into the program (reqd_work_group_size), so every candidate size
+needs a build of its own. All kernels are timed with the profiling events on a short
+simulation, and each one gets the size it was the fastest with.
+"""
+import numpy as np
+import pyopencl as cl
+
+import configs as cfg
+import agents
+import maze
+import profiling
+import renderer
+import opencl_computations as cl_comp
+
+
+def get_candidate_sizes(device):
+    """
+    Powers of two up to the device limit. Groups larger than the longest dimension
+    of the kernels (boids or maze width) would only hold surplus work items
+    """
+    work_items_n = max(cfg.NumberOfBoids, cfg.maze_width)
+    sizes = [1]
+    while sizes[-1] < work_items_n and sizes[-1] * 2 <= device.max_work_group_size:
+        sizes.append(sizes[-1] * 2)
+    return sizes
+
+
+def time_kernels(context, device, queue, local_size, amazes, first_flocks, template_triangles):
+    """ Simulates cfg.autotune_steps timesteps. Returns median durations of the kernels in ms """
+    backend = cl_comp.OpenCLBackend(context, device, queue)
+    backend.local_sizes = dict.fromkeys(cl_comp.TUNABLE_KERNELS, local_size)
+    backend.prepare_batch(first_flocks, amazes, template_triangles)
+    del profiling.events[:]
+    instances_flocks = [[flock] for flock in first_flocks]
+    backend.generate_batch(1, min(cfg.autotune_steps, cfg.total_timesteps - 1), instances_flocks)
+    # The following batch has been enqueued ahead
+    queue.finish()
+    backend.transfer_queue.finish()
+    return {name: float(np.median(durations))
+            for (kind, name), durations in profiling.get_durations().items()
+            if kind == profiling.KERNEL and name in cl_comp.TUNABLE_KERNELS}
+
+
+def run(device_override=None):
+    """
+    Finds the fastest work group size of every kernel and saves them (see
+    cfg.autotune_url). Kernels that are not launched by the simulation keep
+    the preferred multiple of the device
+    """
+    # Kernels are timed with the profiling events. The timed steps are computed in a
+    # single batch, and they are not recorded
+    cfg.profiling_on = True
+    cfg.steps_per_batch = cfg.autotune_steps
+    cfg.record_on = False
+    context, device, queue = cl_comp.init_opencl(device_override)
+    print("Tuning work group sizes for", cl_comp.get_workload_key(device))
+
+    template_triangles = renderer.render_template_triangles()
+    amazes = [maze.Maze() for _ in range(cfg.batch_instances)]
+    first_flocks = [agents.generate_first_flock(amaze)[0] for amaze in amazes]
+
+    timings = {}
+    for local_size in get_candidate_sizes(device):
+        print("Timing the kernels in work groups of %d." % local_size)
+        try:
+            durations = time_kernels(context, device, queue, local_size,
+                                     amazes, first_flocks, template_triangles)
+        except cl.Error as e:
+            print("Work groups of %d are not supported: %s" % (local_size, e))
+            continue
+        for name, duration in durations.items():
+            timings.setdefault(name, {})[local_size] = duration
+    if not timings:
+        print("No work group size could be timed.")
+        return None
+
+    local_sizes = {name: min(durations, key=durations.get) for name, durations in timings.items()}
+    print("Median kernel durations [ms] by work group size:")
+    sizes = sorted({size for durations in timings.values() for size in durations})
+    row = "{0:<36} {1:>5}" + "".join(" {%d:>8}" % (i + 2) for i in range(len(sizes)))
+    print(row.format("Kernel", "Best", *sizes))
+    for name in sorted(timings):
+        print(row.format(name, local_sizes[name],
+                         *["%.4f" % timings[name][size] if size in timings[name] else "-"
+                           for size in sizes]))
+
+    cl_comp.save_local_sizes(device, local_sizes)
+    print("Work group sizes are saved into", cfg.autotune_url)
+    return local_sizes
@@ -66,9 +66,7 @@ def run(flock, previous_flock, amaze, template_triangles, amendments):
             boid[pos + x_var] = previous_flock.np_arrays[i][pos + x_var]
             boid[pos + y_var] = previous_flock.np_arrays[i][pos + y_var]
 
-            template_triangle = template_triangles[min(
-                int(np.round(np.degrees(flock.object_list[i].orientation))),
-                359)]
+            template_triangle = template_triangles[int(boid[cfg.BOID_TRIANGLE_OFFSET])]
             triangle_offset = template_triangle.get_triangle_top_left()
 
             triangle_rect = template_triangle.rect.copy()
@@ -18,6 +18,34 @@ solver              = "CPU"
 # Set reuse_data and save_data to False to randomize initial flock state and maze structure
 reuse_data          = False
 save_data           = False
+# Seeds the generation of mazes and flocks and keys the random numbers agents draw
+# on the device, so runs are reproducible. None gives a different run every time
+random_seed         = None
+
+" Backend settings "
+# "OpenCL" runs agents on an OpenCL device, "NumPy" runs them on the host.
+# "auto" uses NumPy for swarms of up to numpy_backend_max_boids agents
+# and when OpenCL is not available
+backend                     = "auto"
+numpy_backend_max_boids     = 64
+
+" OpenCL device settings "
+# Device types in the order of preference. CPU devices (e.g. pocl) are the fallback
+# for machines without a GPU
+device_preference           = ["GPU", "ACCELERATOR", "CPU"]
+# Time a short kernel on every available device and use the fastest one
+calibrate_devices           = True
+calibration_items           = 1 << 18
+calibration_runs            = 3
+# Overrides device selection: a device type ("CPU"), "platform:device" indices ("0:1")
+# or a part of the device name. Can also be set with --device
+device_env_var              = "SWARM_OPENCL_DEVICE"
+# Work group sizes are tuned by main.py --autotune: it simulates this number of timesteps
+# with each candidate size
+autotune_steps              = 48
+# Device memory holds a ring of the latest flocks instead of the whole history.
+# At least 2: the previous flock is read while the next one is written
+flock_ring_length           = 2
 
 " Additional simulation settings "
 Dimensions                  = 2
@@ -25,11 +53,43 @@ seconds                     = endSecond
 # Should be divisible by framespersecond
 total_timesteps             = int(seconds * framespersecond)
 debug_on                    = False
+# Collects timings of OpenCL kernels and transfers and reports them at the end
+profiling_on                = False
+# Number of timesteps the backend computes without returning to the host.
+# With more than 1, collision detection is off, unless the backend does it
+# itself (OpenCL)
+steps_per_batch             = 1
+# Saves the run every this number of timesteps (see simulator.save_checkpoint()), so that
+# it can be continued with main.py --resume. 0 turns checkpoints off
+checkpoint_interval         = 0
+# Streams the flocks and the maps to disk as they are computed (see recorder.py), so that
+# host memory doesn't grow with the length of the run. They are saved in chunks of
+# record_chunk_steps timesteps, and the latest record_window_chunks chunks are kept in memory
+record_on                   = False
+record_chunk_steps          = 64
+record_window_chunks        = 2
+# Saves the finished run into an archive (see run_archive.py), which is rendered with
+# main.py --render-archive, e.g. on another machine
+archive_on                  = False
 collision_detection_on      = True
+# Computes Reynolds rules and the agents' AI in a single kernel (OpenCL only). The previous
+# flock is read a tile at a time in local memory and every boid is compared with all the
+# others instead of going through the cell lists. It saves launches and global memory
+# round trips, which pays off for small and medium swarms only
+fused_agent_step            = False
+# Number of independent instances (mazes and swarms) simulated together in the same
+# kernel launches (OpenCL only), e.g. the repeats of an experiment. They share the
+# swarm and maze sizes. With more than 1, collision detection is done by the device
+batch_instances             = 1
 # track_map_changes controls whether the map is to be
 # transferred from GPU to CPU on each iteration.
-# Must be true if solver == "True"
+# Must be true unless solver == "CPU" and backend_goal_check is set
 track_map_changes           = True
+# The backend checks on every step whether the goal is reachable through the explored
+# passages (see k_check_goal_reachability), so the host only downloads a flag per step and
+# only searches the map for the path (maze_solver.py) once it is. Otherwise the host checks
+# it incrementally (maze_solver.ConnectivityTracker)
+backend_goal_check          = True
 reuse_agents                = reuse_maze = reuse_data
 save_agents                 = save_maze = save_data
 # How many exotic obstacles per area
@@ -55,7 +115,7 @@ NEURON_THRESHOLD                        = 1
 # Weights unitialized value = assume all surrounding squares are passages
 # For 8 neurons
 WEIGHTS_UNINITIALIZED                   = 0b00001111
-# Duration of time a random value is stored by the agent until CPU updates it
+# Number of timesteps an agent keeps its random value before drawing a new one
 RAND_CLOCK_MAX                          = 10
 # Agent is allowed to stall for some time to take into account an inertia.
 MAX_STALL_TIME_ALLOWED                  = 2 # Timesteps
@@ -69,6 +129,7 @@ bounding_rects_show         = False
 window_size                 = window_width, window_height = maze_width * tile_width, maze_height * tile_height
 # Boid triangle dimensions
 triangle_rotation_res       = 1 # Degrees
+triangles_n                 = len(range(0, 360, triangle_rotation_res))
 middle_line_size            = 17 # Pixels
 center_to_top_vertex        = 13 # Pixels
 center_to_bottom_line       = middle_line_size - center_to_top_vertex
@@ -100,6 +161,19 @@ node_label_color        = pg.Color(127, 127, 127)
 " Files settings "
 cl_dir                  = "opencl"
 cl_main_url             = "main.cl"
+cl_calibration_url      = "calibration.cl"
+# Compiled OpenCL programs and work group queries are cached here
+cl_cache_on             = True
+cl_cache_dir            = "cl_cache"
+cl_work_groups_url      = "work_groups.json"
+# Tuned work group sizes per device, swarm size and maze size (see autotuning.py)
+autotune_url            = "autotune.json"
+# The latest checkpoint of a run (see checkpoint_interval)
+checkpoint_url          = "checkpoint.pkl"
+# Recorded flocks and maps (see record_on)
+record_dir              = "record"
+# Run archives (see archive_on)
+archive_dir             = "archive"
 movie_url               = "opencl_video.mp4"
 images_filename         = "image"
 images_format           = ".png"
@@ -115,6 +189,10 @@ BOID_POS_VAR        = 0
 BOID_VEL_VAR        = 1
 ARRDIM              = 2
 BOID_PHEROMONE_VAR  = 2
+# Scalar fields after the pheromone level, computed by the backend along with the
+# velocity: orientation (radians) and the index of its template triangle
+BOID_ORIENTATION_OFFSET = ARRDIM * Dimensions + 1
+BOID_TRIANGLE_OFFSET    = BOID_ORIENTATION_OFFSET + 1
 X                   = 0
 Y                   = 1
 
@@ -144,10 +222,20 @@ EXP_SIZE                    = 1 + total_timesteps
 EXP_BOID_HIT_COUNT_VAR      = 0
 EXP_BOID_HITS_VAR           = 1
 
-" Maze map array map "
-NODE_SIZE               = 4 + NumberOfBoids
-NODE_IS_EXPLORED_VAR    = 0
-NODE_IS_DEADEND_VAR     = 1
-NODE_IS_GOAL_VAR        = 2
-NODE_PHEROMONE_A_VAR    = 3
-NODE_PHEROMONE_M_VAR    = 4
+" Maze map node layout (packed, in bytes) "
+# Attractant pheromone level (int32, 16.16 fixed point), status flags (uint8 bit field)
+# and a marker pheromone of each boid (uint16)
+NODE_PHEROMONE_A_OFFSET = 0
+NODE_FLAGS_OFFSET       = 4
+NODE_MARKERS_OFFSET     = 6
+# Rounded up to whole words, so that the fields of all nodes stay aligned
+NODE_SIZE               = (NODE_MARKERS_OFFSET + 2 * NumberOfBoids + 3) // 4 * 4
+# Pheromone level 1 in the fixed point. Levels are computed in float32 and rounded
+# to the nearest fixed point value when stored
+NODE_PHEROMONE_A_ONE    = 1 << 16
+# Bits of the status flags
+NODE_IS_EXPLORED_FLAG   = 0
+NODE_IS_DEADEND_FLAG    = 1
+NODE_IS_GOAL_FLAG       = 2
+# Markers count the steps left until they dissolve
+NODE_MARKER_STEPS       = int(round(1 / node_marker_dissolution_component))
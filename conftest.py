@@ -0,0 +1,98 @@
+"""
+Fixtures shared by the tests. Settings changed by a test (it is given cfg) are restored
+after it, as the simulator changes some of them too (e.g. cfg.total_timesteps).
+"""
+import random
+
+import numpy as np
+import pytest
+
+import configs as cfg
+import agents
+import maze
+import renderer
+
+
+@pytest.fixture
+def configs(tmp_path):
+    """ The settings module, with the files a run writes kept in tmp_path """
+    saved = {name: value for name, value in vars(cfg).items() if not name.startswith("__")}
+    cfg.render_display_on = False
+    cfg.record_dir = str(tmp_path / "record")
+    cfg.checkpoint_url = str(tmp_path / "checkpoint.pkl")
+    # Neither cached programs nor tuned work group sizes of the machine are used
+    cfg.cl_cache_dir = str(tmp_path / "cl_cache")
+    cfg.autotune_url = str(tmp_path / "autotune.json")
+    cfg.archive_on = False
+    yield cfg
+    for name in [name for name in vars(cfg) if not name.startswith("__")]:
+        if name not in saved:
+            delattr(cfg, name)
+    for name, value in saved.items():
+        setattr(cfg, name, value)
+
+
+@pytest.fixture(scope="session")
+def template_triangles():
+    return renderer.render_template_triangles()
+
+
+@pytest.fixture
+def generate_instance(configs):
+    """ Generates a maze and its first flocks, the same ones for the same seed """
+    def generate(seed):
+        np.random.seed(seed)
+        random.seed(seed)
+        amaze = maze.Maze()
+        return amaze, agents.generate_first_flock(amaze)
+    return generate
+
+
+@pytest.fixture
+def create_opencl_backend(configs):
+    """ Creates OpenCL backends. Tests using it are skipped without an OpenCL device """
+    cl_comp = pytest.importorskip("opencl_computations")
+
+    def create():
+        try:
+            return cl_comp.OpenCLBackend(*cl_comp.init_opencl())
+        except RuntimeError as e:
+            pytest.skip("OpenCL is not available (%s)" % e)
+    return create
+
+
+class FakePlatform:
+    """ What device selection and the caches use of a pyopencl Platform """
+
+    def __init__(self, name, devices):
+        self.name = name
+        self.version = "OpenCL 3.0"
+        self.devices = devices
+        for device in devices:
+            device.platform = self
+
+    def get_devices(self):
+        return self.devices
+
+
+class FakeDevice:
+    """ What device selection, the caches and the autotuner use of a pyopencl Device """
+
+    def __init__(self, name, device_type):
+        self.name = name
+        self.type = device_type
+        self.version = "OpenCL 3.0"
+        self.driver_version = "1.0"
+        self.max_work_group_size = 256
+        self.platform = None
+
+
+@pytest.fixture
+def fake_platforms(monkeypatch):
+    """ A GPU platform with two devices and a CPU one in place of the installed ones """
+    cl = pytest.importorskip("pyopencl")
+    platforms = [FakePlatform("GPUs", [FakeDevice("Fast GPU", cl.device_type.GPU),
+                                       FakeDevice("Slow GPU", cl.device_type.GPU)]),
+                 FakePlatform("CPUs", [FakeDevice("Some CPU", cl.device_type.CPU)])]
+    monkeypatch.setattr(cl, "get_platforms", lambda: platforms)
+    return platforms
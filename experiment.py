@@ -18,16 +18,22 @@ for swarm_size in swarm_sizes:
 
 Insert the following after simulation is finished:
 
-            experiment.report(queue, buffers, swarm_size,
+            experiment.report(backend, swarm_size,
                               maze_size[0], maze_size[1],
                               completion_time, t2 - t1, solver)
+
+Repeats share the swarm and maze sizes, so with the OpenCL backend they can be
+computed together instead of the innermost loop: set cfg.batch_instances = repeats,
+call simulator.run_batch() and report every instance with
+backend.get_experiment_data(instance).
+
+Runs saved by main.py --archive are reported with report_archive(), e.g. on another machine.
 """
 import csv
 from time import strftime
 import os
 import numpy as np
 
-import opencl_computations as cl_comp
 import configs as cfg
 
 
@@ -43,15 +49,19 @@ def get_tasks():
     return swarm_sizes, maze_sizes, repeats, solver
 
 
-def report(queue, buffers, n_boids, maze_w, maze_h, completion_time, computation_time, solver):
+def report(backend, n_boids, maze_w, maze_h, completion_time, computation_time, solver,
+           instance=0):
+    """
+    Saves the experiment data of the run into CSV files. backend is the backend of the
+    run or its archive (see run_archive.RunArchive)
+    """
     if not os.path.exists(cfg.reporting_dir):
         os.makedirs(cfg.reporting_dir)
     # Get experiment data
     print("Transferring experiment data from device to the host")
 
     # Collisions
-    experiment_data = cl_comp.get_experiment_data(queue, buffers)
-    queue.finish()
+    experiment_data = backend.get_experiment_data(instance)
     csvfile = open(os.path.join(cfg.reporting_dir, ("%d_%d_%d" % (n_boids,
                                                                   maze_w,
                                                                   maze_h)) +
@@ -85,3 +95,10 @@ def report(queue, buffers, n_boids, maze_w, maze_h, completion_time, computation
                        [computation_time] +
                        [solver])
     csvfile.close()
+
+
+def report_archive(archive):
+    """ Reports a run loaded from its archive (see run_archive.RunArchive) """
+    settings = archive.settings
+    report(archive, settings["NumberOfBoids"], settings["maze_width"], settings["maze_height"],
+           archive.completion_time, archive.computation_time, settings["solver"])
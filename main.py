@@ -2,7 +2,12 @@
 main.py is the top-level module which controls the simulator.
 """
 from time import time
+import argparse
 import os
+import random
+import sys
+
+import numpy as np
 
 import pygame as pg
 
@@ -11,55 +16,146 @@ import renderer
 import displayer
 import maze
 import simulator
-import opencl_computations as cl_comp
 import agents
 import experiment
+import profiling
+import recorder
+import run_archive
 
 # Set environment variables
 # Work process-related settings
+# PyOpenCL's own cache doesn't notice changes in the included files. Compiled programs
+# are cached by opencl_computations.build_cached_program() instead (see cfg.cl_cache_on)
 os.environ["PYOPENCL_NO_CACHE"] = "1"
 os.environ["PYOPENCL_COMPILER_OUTPUT"] = "1"
 
+parser = argparse.ArgumentParser(description="A GPU-accelerated stigmergic BCMM swarm")
+parser.add_argument("--device", default=None,
+                    help="OpenCL device to use: a device type (CPU, GPU), "
+                         "\"platform:device\" indices or a part of the device name. "
+                         "Overrides the " + cfg.device_env_var + " environment variable")
+parser.add_argument("--backend", default=None, choices=["auto", "OpenCL", "NumPy"],
+                    help="Simulation backend. Overrides cfg.backend")
+parser.add_argument("--profile", action="store_true",
+                    help="Report timings of OpenCL kernels and transfers. Sets cfg.profiling_on")
+parser.add_argument("--instances", type=int, default=None,
+                    help="Number of independent mazes and swarms computed together. The first "
+                         "one is rendered. Overrides cfg.batch_instances")
+parser.add_argument("--seed", type=int, default=None,
+                    help="Makes the run reproducible. Overrides cfg.random_seed")
+parser.add_argument("--autotune", action="store_true",
+                    help="Tune the work group sizes of the OpenCL kernels for the device, "
+                         "the swarm size and the maze size, save them and exit")
+parser.add_argument("--resume", action="store_true",
+                    help="Continue the run saved in " + cfg.checkpoint_url +
+                         " (see cfg.checkpoint_interval)")
+parser.add_argument("--archive", action="store_true",
+                    help="Save the run into an archive (see run_archive.py) for later "
+                         "rendering and analysis. Sets cfg.archive_on")
+parser.add_argument("--render-archive", nargs="?", const=cfg.archive_dir, default=None,
+                    metavar="DIR", help="Render the run saved in the archive (" +
+                                        cfg.archive_dir + " by default) instead of simulating")
+args = parser.parse_args()
+if args.backend is not None:
+    cfg.backend = args.backend
+if args.profile:
+    cfg.profiling_on = True
+if args.instances is not None:
+    cfg.batch_instances = args.instances
+if args.seed is not None:
+    cfg.random_seed = args.seed
+if args.archive:
+    cfg.archive_on = True
+if args.resume and cfg.batch_instances > 1:
+    parser.error("only runs of a single instance are saved in checkpoints")
+if cfg.random_seed is not None:
+    # Mazes and flocks are generated with both generators
+    random.seed(cfg.random_seed)
+    np.random.seed(cfg.random_seed)
+
 swarm_sizes, maze_sizes, repeats, solver = experiment.get_tasks()
 cfg.solver = solver
 
+archive = None
+if args.render_archive is not None:
+    # The run is rendered with the settings it was simulated with
+    archive = run_archive.RunArchive(args.render_archive)
+    archive.apply_settings()
+
+if args.autotune:
+    # Imported here, as it needs PyOpenCL
+    import autotuning
+    pg.init()
+    autotuning.run(args.device)
+    sys.exit()
+
 # Set timer
 t1 = time()
 
 # Initialize pygame
 pg.init()
 
-# Initialize opencl
-context, device, queue = cl_comp.init_opencl()
-
-# Generate or load maze
-failed_to_load_maze = False
-amaze = None
-if cfg.reuse_maze:
-    amaze = maze.load_from_pickle()
-    if amaze is None:
-        failed_to_load_maze = True
-if not cfg.reuse_maze or failed_to_load_maze:
-    amaze = maze.Maze()
-
+# Initialize the backend (OpenCL or NumPy). Archived runs are only rendered
+if archive is None:
+    backend = simulator.create_backend(args.device)
 
 template_triangles = renderer.render_template_triangles()
 
-# Generate or load agents
-failed_to_load_agents = False
-flocks = None
-if cfg.reuse_agents:
-    flocks = agents.load_from_pickle(amaze)
-    if flocks is None:
-        failed_to_load_agents = True
-if not cfg.reuse_agents or failed_to_load_agents:
-    flocks = agents.generate_first_flock(amaze)
-
-global_map, buffers, completion_time, solver =\
-    simulator.run(context, device, queue, amaze, flocks, template_triangles)
+if archive is not None:
+    amaze, flocks, global_map = archive.maze, archive.flocks, archive.global_map
+elif cfg.batch_instances > 1:
+    # Mazes and agents of the instances computed together are always generated
+    amazes = [maze.Maze() for _ in range(cfg.batch_instances)]
+    instances_flocks = [recorder.create_flock_history(agents.generate_first_flock(amaze), instance)
+                        for instance, amaze in enumerate(amazes)]
+
+    global_maps, backend, completion_times =\
+        simulator.run_batch(backend, amazes, instances_flocks, template_triangles)
+
+    # The first instance is rendered
+    amaze, flocks, global_map = amazes[0], instances_flocks[0], global_maps[0]
+    completion_time = completion_times[0]
+    cfg.total_timesteps = len(flocks)
+elif args.resume:
+    # The maze and the flocks so far are saved in the checkpoint
+    checkpoint = simulator.load_checkpoint()
+    amaze, flocks = checkpoint["maze"], checkpoint["flocks"]
+
+    global_map, backend, completion_time, solver =\
+        simulator.run(backend, amaze, flocks, template_triangles, checkpoint)
+else:
+    # Generate or load maze
+    failed_to_load_maze = False
+    amaze = None
+    if cfg.reuse_maze:
+        amaze = maze.load_from_pickle()
+        if amaze is None:
+            failed_to_load_maze = True
+    if not cfg.reuse_maze or failed_to_load_maze:
+        amaze = maze.Maze()
+
+    # Generate or load agents
+    failed_to_load_agents = False
+    flocks = None
+    if cfg.reuse_agents:
+        flocks = agents.load_from_pickle(amaze)
+        if flocks is None:
+            failed_to_load_agents = True
+    if not cfg.reuse_agents or failed_to_load_agents:
+        flocks = agents.generate_first_flock(amaze)
+    # The flocks are streamed to disk, if they are recorded
+    flocks = recorder.create_flock_history(flocks)
+
+    global_map, backend, completion_time, solver =\
+        simulator.run(backend, amaze, flocks, template_triangles)
 
 t2 = time()
 print("Calculations [s]:", t2 - t1)
+if cfg.profiling_on:
+    profiling.report()
+if cfg.archive_on and archive is None:
+    run_archive.save(amaze, flocks, global_map, backend.get_experiment_data(),
+                     completion_time, t2 - t1)
 
 if cfg.render_display_on:
     animation = renderer.render_animation(amaze, flocks, template_triangles, global_map)
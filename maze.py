@@ -215,6 +215,14 @@ class Maze:
         except IOError:
             print("Failed to save pickle into", os.path.join(os.getcwd(), cfg.maze_pickle_url))
 
+    def get_numeric_matrix(self):
+        """ Returns the matrix of squares' numeric values (see Square.get_numeric_value()) """
+        numeric_matrix = np.zeros((cfg.maze_width, cfg.maze_height), dtype=np.uint8)
+        for x in range(cfg.maze_width):
+            for y in range(cfg.maze_height):
+                numeric_matrix[x][y] = self.matrix[x][y].get_numeric_value()
+        return numeric_matrix
+
     def introduce_exotic_obstacles(self, n_obstacles, x_min, x_max, y_min, y_max, wall_list, passage_list):
         """ Changes types of walls and passages randomly within specific areas """
         # Range is a quarter of maze surface multipled by dancity
@@ -442,4 +450,38 @@ def outside_maze(x_float, y_float):
     """ Checks if the coordinates are inside the maze """
     return (x_float < 0 or y_float < 0 or
             x_float > cfg.maze_width or
-            y_float > cfg.maze_height)
\ No newline at end of file
+            y_float > cfg.maze_height)
+
+
+def get_node_dtype():
+    """ Type of the packed map nodes (see the node layout in configs.py) """
+    return np.dtype({"names": ["pheromone_a", "flags", "markers"],
+                     "formats": [np.int32, np.uint8, (np.uint16, (cfg.NumberOfBoids,))],
+                     "offsets": [cfg.NODE_PHEROMONE_A_OFFSET, cfg.NODE_FLAGS_OFFSET,
+                                 cfg.NODE_MARKERS_OFFSET],
+                     "itemsize": cfg.NODE_SIZE})
+
+
+def is_node_flag_set(map_inst, x, y, flag):
+    """ Checks a status flag (cfg.NODE_IS_..._FLAG) of a node of the map of one step """
+    return bool(map_inst["flags"][x, y] >> flag & 1)
+
+
+def set_node_flag(map_inst, x, y, flag):
+    """ Sets a status flag (cfg.NODE_IS_..._FLAG) of a node of the map of one step """
+    map_inst["flags"][x, y] |= 1 << flag
+
+
+def get_node_pheromone_a(map_inst, x, y):
+    """ Returns the attractant pheromone level of a node of the map of one step """
+    return to_pheromone_levels(map_inst["pheromone_a"][x, y])
+
+
+def to_pheromone_levels(fixed_levels):
+    """ Converts the stored attractant pheromone levels (16.16 fixed point) to float32 """
+    return np.float32(fixed_levels) / np.float32(cfg.NODE_PHEROMONE_A_ONE)
+
+
+def to_fixed_pheromone_levels(levels):
+    """ Rounds float32 attractant pheromone levels to the nearest stored values """
+    return np.rint(levels * np.float32(cfg.NODE_PHEROMONE_A_ONE)).astype(np.int32)
@@ -2,7 +2,11 @@
 maze_solver.py contains Dijkstra's algorithm implementation which is
 run on each iteration to find a solution path via the mapped areas of the
 maze. Dijkstra's algorithm is used if cfg.solver == "CPU".
+ConnectivityTracker tells cheaply whether there is a path at all, so the
+search only runs once there is.
 """
+import numpy as np
+
 import configs as cfg
 import maze
 
@@ -23,7 +27,7 @@ def solve_maze(global_map_inst, amaze, starting_node, goal_node):
         for y in range(cfg.maze_height):
             if ((x, y) != starting_node and
                isinstance(amaze.matrix[x][y].shape, maze.Passage) and
-               global_map_inst[x][y][cfg.NODE_IS_EXPLORED_VAR]):
+               maze.is_node_flag_set(global_map_inst, x, y, cfg.NODE_IS_EXPLORED_FLAG)):
                 unvisited[(x, y)] = float('Inf')
 
     current_node = starting_node
@@ -51,28 +55,107 @@ def solve_maze(global_map_inst, amaze, starting_node, goal_node):
             current_node = closest_node
 
 
+class ConnectivityTracker:
+    """
+    Union-find over the explored passage nodes of a maze, the nodes solve_maze() searches.
+    The nodes explored since the previous map are joined with their neighbours, so
+    is_connected() costs as much as the map changes. Nodes which are no longer explored
+    are only left out when the start and the goal seem connected, as they may be what
+    connects them: the structure is rebuilt from the map then
+    """
+
+    def __init__(self, amaze):
+        self.is_passage = np.array([[isinstance(amaze.matrix[x][y].shape, maze.Passage)
+                                     for y in range(cfg.maze_height)]
+                                    for x in range(cfg.maze_width)])
+        # Nodes in the structure and their parents by INDEX_IN_MAZE()
+        self.is_added = np.zeros((cfg.maze_width, cfg.maze_height), dtype=bool)
+        self.parents = list(range(cfg.maze_width * cfg.maze_height))
+        self.sizes = [1] * (cfg.maze_width * cfg.maze_height)
+
+    def find(self, node):
+        while self.parents[node] != node:
+            # Path halving
+            self.parents[node] = self.parents[self.parents[node]]
+            node = self.parents[node]
+        return node
+
+    def union(self, node_a, node_b):
+        root_a = self.find(node_a)
+        root_b = self.find(node_b)
+        if root_a == root_b:
+            return
+        if self.sizes[root_a] < self.sizes[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parents[root_b] = root_a
+        self.sizes[root_a] += self.sizes[root_b]
+
+    def add_node(self, node):
+        self.is_added[node] = True
+        for neighbour in get_neighbours(node):
+            if self.is_added[neighbour]:
+                self.union(get_index(node), get_index(neighbour))
+
+    def rebuild(self, is_open):
+        self.is_added[:] = False
+        self.parents = list(range(cfg.maze_width * cfg.maze_height))
+        self.sizes = [1] * (cfg.maze_width * cfg.maze_height)
+        for x, y in zip(*np.nonzero(is_open)):
+            self.add_node((int(x), int(y)))
+
+    def is_joined(self, starting_node, goal_node):
+        """ Whether the goal is in the set of the start or of one of its neighbours """
+        if starting_node == goal_node:
+            return True
+        if not self.is_added[goal_node]:
+            return False
+        goal_root = self.find(get_index(goal_node))
+        return any(self.is_added[node] and self.find(get_index(node)) == goal_root
+                   for node in [starting_node] + get_neighbours(starting_node))
+
+    def is_connected(self, global_map_inst, starting_node, goal_node):
+        """ Whether solve_maze() finds a path on the map of one step """
+        is_open = self.is_passage & \
+            ((global_map_inst["flags"] >> cfg.NODE_IS_EXPLORED_FLAG & 1) == 1)
+        for x, y in zip(*np.nonzero(is_open & ~self.is_added)):
+            self.add_node((int(x), int(y)))
+        starting_node = reuse_swarm_progress(global_map_inst, starting_node)
+        goal_node = reuse_swarm_progress(global_map_inst, goal_node)
+        if not self.is_joined(starting_node, goal_node):
+            return False
+        if (self.is_added & ~is_open).any():
+            self.rebuild(is_open)
+            return self.is_joined(starting_node, goal_node)
+        return True
+
+
+def get_index(node):
+    """ Index of the node in the maze, as INDEX_IN_MAZE() of the kernels """
+    return node[0] * cfg.maze_height + node[1]
+
+
 def reuse_swarm_progress(global_map_inst, root_node):
     """
     Use the partial solutions created by agents via propagation.
+    At most maze_size nodes are followed, as the path may loop.
     """
     current_node = root_node
-    if (global_map_inst[current_node[0]]
-                       [current_node[1]]
-                       [cfg.NODE_IS_GOAL_VAR]):
+    if maze.is_node_flag_set(global_map_inst, current_node[0], current_node[1],
+                             cfg.NODE_IS_GOAL_FLAG):
         previous_node = None
-        path_ended = False
-        while not path_ended:
+        for _ in range(cfg.maze_width * cfg.maze_height):
             neighbours = get_neighbours(current_node)
             for neighbour in neighbours:
                 path_ended = True
-                if (global_map_inst[neighbour[0]]
-                                   [neighbour[1]]
-                                   [cfg.NODE_IS_GOAL_VAR] and
+                if (maze.is_node_flag_set(global_map_inst, neighbour[0], neighbour[1],
+                                          cfg.NODE_IS_GOAL_FLAG) and
                    neighbour != previous_node):
                     previous_node = current_node
                     current_node = neighbour
                     path_ended = False
                     break
+            if path_ended:
+                break
     return current_node
 
 
@@ -0,0 +1,731 @@
+"""
+numpy_computations.py is a pure NumPy counterpart of opencl_computations.py.
+It mirrors the OpenCL kernels, but processes the whole flock at once with array
+operations. For small swarms it avoids per-step launch and transfer overheads,
+and it doesn't need an OpenCL device at all.
+
+Work items of a kernel are emulated as if they were running in lockstep:
+each phase of the agent AI is done for all boids before the next one starts.
+"""
+import numpy as np
+
+import configs as cfg
+import agents
+import maze
+import maze_solver
+import recorder
+
+f32 = np.float32
+
+# North, East, South and West
+NORTH = 0
+EAST = 1
+SOUTH = 2
+WEST = 3
+delta_coors = np.array([[0, -1],
+                        [+1, 0],
+                        [0, +1],
+                        [-1, 0]])
+# Directions translated into the half_pi multipliers of choose_passage()
+angle_multipliers = np.array([1, 0, 3, 2])
+reverse_directions = np.array([SOUTH, WEST, NORTH, EAST])
+
+TRUE = 1
+MAYBE = 2
+GOAL_NOT_SET = 0
+NEURONS_N = 8
+ERROR_EXPONENT = f32(0.001)
+ERROR_MARGIN = f32(0.02)
+# Philox2x32-10, see philox2x32() in utilities.cl
+PHILOX_ROUNDS = 10
+PHILOX_M2X32 = np.uint64(0xD256D193)
+PHILOX_W32 = np.uint64(0x9E3779B9)
+# Memory a run continues from (see NumpyBackend.get_state())
+STATE_ARRAYS = ["flock", "map", "cmms", "programmes", "experiment"]
+
+
+class NumpyBackend:
+    """ Simulation backend computing agents on the host with NumPy """
+    name = "NumPy"
+    # Collisions are detected on the host by collision_detection.run()
+    detects_collisions = False
+    # Instances are computed one at a time, see simulator.run()
+    runs_batches = False
+
+    def __init__(self):
+        self.flock = None
+        self.maze = None
+        self.map = None
+        self.cmms = None
+        self.programmes = None
+        self.experiment = None
+        self.random_key = None
+        # Goal checks of the steps, see cfg.backend_goal_check
+        self.goal_reached = None
+
+    def prepare(self, first_flock, amaze, template_triangles, state=None):
+        """
+            Initializes the memory and takes the first flock. A run saved by get_state()
+            is continued, if its state is given. Returns the map history (see
+            recorder.create_map_history())
+        """
+        print("Initializing the memory.")
+        self.flock = first_flock.np_arrays.astype(np.float32)
+        self.maze = amaze.get_numeric_matrix()
+        self.map = np.zeros(cfg.maze_width * cfg.maze_height, dtype=maze.get_node_dtype())
+        self.cmms = np.full((cfg.NumberOfBoids, get_square_types_n() ** 3), cfg.WEIGHTS_UNINITIALIZED,
+                            dtype=np.uint8)
+        # Programmes are ushort on the device. Here they are kept as ints and wrapped
+        # on assignment - see to_ushort()
+        self.programmes = np.zeros((cfg.NumberOfBoids, cfg.PROG_SIZE), dtype=np.int64)
+        self.experiment = np.zeros((cfg.NumberOfBoids, cfg.EXP_SIZE), dtype=np.float32)
+        self.random_key = agents.get_random_seed() if state is None else state["random_key"]
+        self.goal_reached = np.zeros(cfg.total_timesteps, dtype=np.uint8)
+        if state is not None:
+            for name in STATE_ARRAYS:
+                setattr(self, name, state[name].copy())
+
+        return recorder.create_map_history()
+
+    def amend_values(self, amendments):
+        """ Applies the amendments calculated by the collision detection (k_update_values) """
+        packet = amendments.get_packet()
+        amount = int(packet[amendments.amount_i])
+        if amount > 0:
+            pos = cfg.BOID_POS_VAR * cfg.Dimensions
+            indices = packet[amendments.indices_i][:amount]
+            self.flock[indices, pos:pos + cfg.Dimensions] = \
+                packet[amendments.values_i].reshape(-1, cfg.Dimensions)[:amount]
+
+    def update_map(self):
+        """ Dissolutes pheromones (k_update_map) """
+        dissolute_pheromones(self.map)
+
+    def generate_next_flock(self, step, flocks, global_map):
+        """
+            Does one iteration of the computation. To be called in the increasing continuous
+            order of the integer "step" argument
+        """
+        sensor_readings = read_sensors(self.maze, self.flock)
+        flock_pos_sum, flock_vel_sum = agent_reynolds_rules13_preprocess(self.flock)
+        avoidance_vectors = agent_reynolds_rule2_preprocess(self.flock)
+        self.flock = agent_ai_and_sim(self.flock, self.map, self.cmms, self.programmes,
+                                      sensor_readings, flock_pos_sum, flock_vel_sum,
+                                      avoidance_vectors, self.random_key, step, self.experiment)
+
+        new_flock = agents.Flock(cfg.NumberOfBoids)
+        new_flock.np_arrays = self.flock.copy()
+        flocks.append(new_flock)
+        if cfg.track_map_changes:
+            global_map[step] = self.map.reshape(cfg.maze_width, cfg.maze_height)
+        if cfg.backend_goal_check:
+            self.goal_reached[step] = check_goal_reachability(self.maze, self.map)
+
+    def generate_flocks(self, step, steps_n, flocks, global_map, work_ahead=True):
+        """ Does steps_n iterations starting from "step". Nothing is computed ahead """
+        for i in range(steps_n):
+            self.generate_next_flock(step + i, flocks, global_map)
+            self.update_map()
+
+    def is_goal_reachable(self, step, instance=0):
+        """ Whether the goal is reachable on the map of the step (cfg.backend_goal_check) """
+        return bool(self.goal_reached[step])
+
+    def get_state(self):
+        """ Returns the memory and the random key the run continues from with prepare() """
+        state = {name: getattr(self, name).copy() for name in STATE_ARRAYS}
+        state["random_key"] = self.random_key
+        return state
+
+    def get_experiment_data(self, instance=0):
+        """ There is only one instance, see runs_batches """
+        return self.experiment.copy()
+
+
+def get_square_types_n():
+    return maze.Square.square_types_n * maze.Square.square_orientation_n
+
+
+def float_to_int(f):
+    return np.trunc(f / ERROR_EXPONENT).astype(np.int64)
+
+
+def int_to_float(i):
+    return i.astype(np.float32) * ERROR_EXPONENT
+
+
+def philox2x32(counter_x, counter_y, key):
+    """ Philox2x32-10 of arrays of 32-bit counters. Returns both words of the results """
+    x = np.asarray(counter_x).astype(np.uint64)
+    y = np.asarray(counter_y).astype(np.uint64)
+    key = np.uint64(key)
+    for _ in range(PHILOX_ROUNDS):
+        product = PHILOX_M2X32 * x
+        x, y = ((product >> np.uint64(32)) ^ key ^ y), product & np.uint64(0xFFFFFFFF)
+        key = (key + PHILOX_W32) & np.uint64(0xFFFFFFFF)
+    return x, y
+
+
+def random_angle(counter_x, counter_y, key):
+    """ Random angles in [0, 2 * pi), see random_angle() in utilities.cl """
+    bits = philox2x32(counter_x, counter_y, key)[0]
+    return (bits >> np.uint64(8)).astype(np.float32) * f32(1 / 16777216) * f32(2 * np.pi)
+
+
+def to_ushort(values):
+    """ Emulates assignment of a number to a ushort variable """
+    return np.trunc(values).astype(np.int64) & 0xFFFF
+
+
+def index_in_map(x, y):
+    return (x * cfg.maze_height + y).astype(np.int64)
+
+
+def read_map(global_map, field, index):
+    """ Reads a field of the nodes of the flat map. Indices outside of the map read as zeros """
+    values = global_map[field]
+    inside = (index >= 0) & (index < len(values))
+    return np.where(inside, values[np.where(inside, index, 0)], values.dtype.type(0))
+
+
+def read_pheromone_level(global_map, index):
+    """ Reads the attractant pheromone levels of the nodes as float32, as NODE_PHEROMONE_A """
+    return maze.to_pheromone_levels(read_map(global_map, "pheromone_a", index))
+
+
+def read_node_flag(global_map, index, flag):
+    """ Reads a status flag (cfg.NODE_IS_..._FLAG) of the nodes as 0 or 1 """
+    return (read_map(global_map, "flags", index) >> flag) & 1
+
+
+def read_node_marker(global_map, index, boids):
+    """ Reads the markers of the boids on the nodes. Indices outside of the map read as zeros """
+    inside = (index >= 0) & (index < len(global_map))
+    return np.where(inside, global_map["markers"][np.where(inside, index, 0), boids], 0)
+
+
+def read_sensors(maze_matrix, flock):
+    """ Sensor readings of all boids. Borders of the maze are read as walls """
+    pos = cfg.BOID_POS_VAR * cfg.Dimensions
+    x = np.trunc(flock[:, pos]).astype(np.int64)
+    y = np.trunc(flock[:, pos + 1]).astype(np.int64)
+    is_inside = (x >= 0) & (x < cfg.maze_width) & (y >= 0) & (y < cfg.maze_height)
+    readings = np.empty((len(flock), cfg.READINGS_N), dtype=np.uint8)
+    for i, (dx, dy) in enumerate(delta_coors):
+        nx = x + dx
+        ny = y + dy
+        is_visible = (is_inside & (nx >= 0) & (nx < cfg.maze_width) &
+                      (ny >= 0) & (ny < cfg.maze_height))
+        readings[:, i] = np.where(is_visible,
+                                  maze_matrix[np.where(is_visible, nx, 0), np.where(is_visible, ny, 0)],
+                                  maze.Wall.normal.value)
+    readings[:, cfg.READINGS_N - 1] = np.where(
+        is_inside, maze_matrix[np.where(is_inside, x, 0), np.where(is_inside, y, 0)],
+        maze.Passage.normal.value)
+    return readings
+
+
+def agent_reynolds_rules13_preprocess(previous_flock):
+    """ Flock position and velocity sums for cohesion and alignment """
+    pos = cfg.BOID_POS_VAR * cfg.Dimensions
+    vel = cfg.BOID_VEL_VAR * cfg.Dimensions
+    return (previous_flock[:, pos:pos + cfg.Dimensions].sum(axis=0, dtype=np.float32),
+            previous_flock[:, vel:vel + cfg.Dimensions].sum(axis=0, dtype=np.float32))
+
+
+def agent_reynolds_rule2_preprocess(previous_flock):
+    """ Avoidance vectors for separation """
+    pos = cfg.BOID_POS_VAR * cfg.Dimensions
+    positions = previous_flock[:, pos:pos + cfg.Dimensions]
+    # difference[main_boid, compared_boid]
+    difference = positions[np.newaxis, :, :] - positions[:, np.newaxis, :]
+    distance = np.sqrt(np.square(difference).sum(axis=2, dtype=np.float32))
+    is_close = (distance > 0) & (distance < f32(cfg.MinSeparation))
+    return (difference * is_close[:, :, np.newaxis]).sum(axis=1, dtype=np.float32)
+
+
+def agent_ai_and_sim(previous_flock, global_map, cmms, programmes, sensor_readings,
+                     flock_pos_sum, flock_vel_sum, avoidance_vectors, random_key, iteration,
+                     experiment):
+    """ Agent AI and locomotion of all boids. Returns the new flock """
+    n = cfg.NumberOfBoids
+    boids = np.arange(n)
+    pos = cfg.BOID_POS_VAR * cfg.Dimensions
+    vel = cfg.BOID_VEL_VAR * cfg.Dimensions
+    readings = sensor_readings.astype(np.int64)
+    prog = programmes
+    new_flock = np.zeros_like(previous_flock)
+
+    previous_position = previous_flock[:, pos:pos + cfg.Dimensions]
+    previous_velocity = previous_flock[:, vel:vel + cfg.Dimensions]
+
+    # Get current coordinates (uchar on the device)
+    current_node = np.floor(previous_position).astype(np.int64) & 0xFF
+    neighbours = current_node[:, np.newaxis, :] + delta_coors[np.newaxis, :, :]
+
+    # Check if agent has stayed on the same square
+    is_same_src_square = (
+        (current_node[:, 0] == np.floor(int_to_float(prog[:, cfg.PROG_SRC_COORS_VAR]))) &
+        (current_node[:, 1] == np.floor(int_to_float(prog[:, cfg.PROG_SRC_COORS_VAR + 1]))))
+
+    # Update the previous chosen paths
+    moved = ~is_same_src_square
+    prog[moved, cfg.PROG_PREV_PREV_PATH_VAR] = prog[moved, cfg.PROG_PREV_PATH_VAR]
+    prog[moved, cfg.PROG_PREV_PATH_VAR] = prog[moved, cfg.PROG_CHOSEN_PATH_VAR]
+
+    rotated_by, trigram_ids = preprocess_for_cmm(readings)
+
+    is_agent_stalled, is_wall_detected = update_cmm(prog, cmms, current_node, readings,
+                                                    previous_position, trigram_ids)
+
+    paths, swamps, forbidden_paths, deadends_n = get_paths(cmms, global_map, prog, neighbours,
+                                                           trigram_ids, rotated_by)
+
+    (is_pheromone_level_shared, most_attractive_node,
+     unexplored_passes_n, passes_n) = browse_passages(global_map, paths, forbidden_paths,
+                                                      neighbours)
+
+    chosen_path = choose_passage(global_map, flock_pos_sum, flock_vel_sum, avoidance_vectors,
+                                 prog, previous_position, previous_velocity,
+                                 unexplored_passes_n, is_pheromone_level_shared,
+                                 most_attractive_node, paths, forbidden_paths, neighbours)
+
+    impulse = get_impulse(previous_position, chosen_path)
+
+    update_programme(global_map, prog, previous_position, current_node, chosen_path,
+                     neighbours, swamps, deadends_n, rotated_by, is_agent_stalled,
+                     is_wall_detected, is_same_src_square, passes_n, unexplored_passes_n,
+                     readings, random_key, iteration)
+
+    new_flock[:, cfg.BOID_PHEROMONE_VAR * cfg.Dimensions] = update_pheromone_levels(
+        global_map, prog, previous_flock, current_node, neighbours, boids,
+        unexplored_passes_n, is_same_src_square, is_wall_detected, chosen_path)
+
+    update_node_status(global_map, prog, current_node)
+
+    # Experiment results
+    hit_count = experiment[:, cfg.EXP_BOID_HIT_COUNT_VAR].astype(np.int64)
+    hits = is_wall_detected & (cfg.EXP_BOID_HITS_VAR + hit_count < cfg.EXP_SIZE)
+    experiment[boids[hits], cfg.EXP_BOID_HITS_VAR + hit_count[hits]] = iteration
+    experiment[is_wall_detected, cfg.EXP_BOID_HIT_COUNT_VAR] = hit_count[is_wall_detected] + 1
+
+    velocity = simulate_locomotion(previous_position, previous_velocity, impulse)
+
+    # Non-finite values are saved as zeros
+    velocity = zero_non_finite(velocity)
+    pheromone = cfg.BOID_PHEROMONE_VAR * cfg.Dimensions
+    new_flock[:, pheromone] = zero_non_finite(new_flock[:, pheromone])
+
+    # Move boids and update velocity
+    new_flock[:, pos:pos + cfg.Dimensions] = zero_non_finite(previous_position + velocity)
+    new_flock[:, vel:vel + cfg.Dimensions] = velocity
+
+    # Orientation and its template triangle
+    orientation = get_orientations(velocity, previous_flock[:, cfg.BOID_ORIENTATION_OFFSET])
+    new_flock[:, cfg.BOID_ORIENTATION_OFFSET] = orientation
+    new_flock[:, cfg.BOID_TRIANGLE_OFFSET] = get_triangle_indices(orientation)
+    return new_flock
+
+
+def preprocess_for_cmm(readings):
+    """ Splits sensor readings into sorted trigrams. Returns rotations and trigram ids """
+    trigrams_n = cfg.READINGS_N - 1
+    square_types_n = get_square_types_n()
+    unsorted_trigram_ids = np.zeros((len(readings), trigrams_n), dtype=np.int64)
+    for i in range(trigrams_n):
+        unsorted_trigram_ids[:, i] = (readings[:, i] * square_types_n ** 2 +
+                                      readings[:, (i + 1) % trigrams_n] * square_types_n +
+                                      readings[:, (i + 2) % trigrams_n])
+    # The order of the smallest trigram is the value by which outputs are rotated
+    rotated_by = np.argmin(unsorted_trigram_ids, axis=1)
+    return rotated_by, np.sort(unsorted_trigram_ids, axis=1)
+
+
+def update_cmm(prog, cmms, current_node, readings, previous_position, trigram_ids):
+    """ Consults the programme and updates CMMs. Returns stall and wall detection flags """
+    n = len(prog)
+    boids = np.arange(n)[:, np.newaxis]
+    is_agent_stalled = np.zeros(n, dtype=bool)
+    is_wall_detected = np.zeros(n, dtype=bool)
+
+    is_goal_set = prog[:, cfg.PROG_EDGE_VAR] != GOAL_NOT_SET
+    is_goal_reached = ((prog[:, cfg.PROG_GOAL_SQUARE_VAR] == current_node[:, 0]) &
+                       (prog[:, cfg.PROG_GOAL_SQUARE_VAR + 1] == current_node[:, 1]))
+    rotated_path_id = (prog[:, cfg.PROG_CHOSEN_PATH_VAR] - prog[:, cfg.PROG_ROTATED_BY_VAR]) % 4
+
+    # If agent is in a swamp, set that side's SLOW_GO for each trigram.
+    # The "not in a swamp" branch of the kernel never changes the weights
+    in_swamp = (is_goal_set & is_goal_reached & (readings[:, cfg.READINGS_N - 1] == 1) &
+                (prog[:, cfg.PROG_SWAMP_GOAL_VAR] == 0))
+    # SLOW_GO neurons start at index 4
+    slow_go = (1 << (rotated_path_id + 4)).astype(np.uint8)
+    cmms[boids[in_swamp], trigram_ids[in_swamp]] |= slow_go[in_swamp, np.newaxis]
+
+    # If agent hasn't reached the goal, check if it has moved along the goal axis
+    src_coors = int_to_float(prog[:, cfg.PROG_SRC_COORS_VAR:cfg.PROG_SRC_COORS_VAR + 2])
+    is_moving = is_goal_set & ~is_goal_reached
+    is_agent_stalled[is_moving] = (
+        ((prog[:, cfg.PROG_EDGE_VAR] == cfg.GOAL_EDGE_VERTICAL) &
+         in_proximity(previous_position[:, 0], src_coors[:, 0])) |
+        ((prog[:, cfg.PROG_EDGE_VAR] == cfg.GOAL_EDGE_HORIZONTAL) &
+         in_proximity(previous_position[:, 1], src_coors[:, 1])))[is_moving]
+    # Detect if the agent was pushed backwards by rotating on the same spot near a wall
+    chosen_path = prog[:, cfg.PROG_CHOSEN_PATH_VAR]
+    is_pushed_back = (((chosen_path == NORTH) & (previous_position[:, 1] > src_coors[:, 1])) |
+                      ((chosen_path == EAST) & (previous_position[:, 0] < src_coors[:, 0])) |
+                      ((chosen_path == SOUTH) & (previous_position[:, 1] < src_coors[:, 1])) |
+                      ((chosen_path == WEST) & (previous_position[:, 0] > src_coors[:, 0])))
+    is_agent_stalled |= is_moving & is_pushed_back
+
+    # Wall detected - the agent has been stalling for too long. Unset GO for that side
+    is_wall_detected[:] = is_agent_stalled & (prog[:, cfg.PROG_STALL_TIME_VAR] ==
+                                              cfg.MAX_STALL_TIME_ALLOWED)
+    no_go = (0xFF ^ (1 << rotated_path_id)).astype(np.uint8)
+    cmms[boids[is_wall_detected], trigram_ids[is_wall_detected]] &= \
+        no_go[is_wall_detected, np.newaxis]
+    return is_agent_stalled, is_wall_detected
+
+
+def in_proximity(what, of):
+    return (what > of - ERROR_MARGIN) & (what < of + ERROR_MARGIN)
+
+
+def get_paths(cmms, global_map, prog, neighbours, trigram_ids, rotated_by):
+    """ Gets lists of paths, swamps and forbidden paths. Returns them and the deadend count """
+    n = len(prog)
+    trigrams_n = cfg.READINGS_N - 1
+    weights = cmms[np.arange(n)[:, np.newaxis], trigram_ids]
+    # Inputs to neurons. CMM columns are NORTH-SLOW, EAST-SLOW, SOUTH-SLOW, WEST-SLOW,
+    # NORTH, EAST, SOUTH, WEST
+    inputs = ((weights[:, :, np.newaxis] >> np.arange(NEURONS_N, dtype=np.uint8)) & 1).sum(axis=1)
+
+    paths = np.zeros((n, 4), dtype=bool)
+    swamps = np.zeros((n, 4), dtype=bool)
+    forbidden_paths = np.zeros((n, 4), dtype=bool)
+    deadends_n = np.zeros(n, dtype=np.int64)
+    for i in range(4):
+        rotated_id = (i + rotated_by) % trigrams_n
+        rotated_neighbours = neighbours[np.arange(n), rotated_id]
+        # Apply fixed threshold and don't let coordinates get negative
+        paths[np.arange(n), rotated_id] = ((inputs[:, i] >= cfg.NEURON_THRESHOLD) &
+                                           (rotated_neighbours[:, 0] >= 0) &
+                                           (rotated_neighbours[:, 1] >= 0))
+        # SLOW_GO neurons start at index 4
+        swamps[np.arange(n), rotated_id] = inputs[:, i + 4] > trigrams_n
+    for i in range(4):
+        # Does it lead to deadend?
+        neighbour = index_in_map(neighbours[:, i, 0], neighbours[:, i, 1])
+        is_deadend = ((read_node_flag(global_map, neighbour, cfg.NODE_IS_DEADEND_FLAG) == 1) |
+                      (read_node_flag(global_map, neighbour, cfg.NODE_IS_GOAL_FLAG) == 1))
+        deadends_n += is_deadend
+        # Has agent returned to the same square via the same path?
+        prev_path = prog[:, cfg.PROG_PREV_PATH_VAR]
+        reversed_path = np.where(prev_path < 4, reverse_directions[np.minimum(prev_path, 3)], 0)
+        forbidden_paths[:, i] = is_deadend | ((reversed_path == i) &
+                                              (prog[:, cfg.PROG_PREV_PREV_PATH_VAR] == i))
+    return paths, swamps, forbidden_paths, deadends_n
+
+
+def browse_passages(global_map, paths, forbidden_paths, neighbours):
+    """ Gathers information about available passages """
+    n = len(paths)
+    max_pheromone_level = np.zeros(n, dtype=np.float32)
+    most_attractive_node = np.zeros(n, dtype=np.int64)
+    unexplored_passes_n = np.zeros(n, dtype=np.int64)
+    is_pheromone_level_shared = np.zeros(n, dtype=bool)
+    passes_n = paths.sum(axis=1)
+    # If all passes are forbidden, permit all of them so that
+    # a path will be chosen based on Reynold's rules
+    forbidden_paths[(paths & forbidden_paths).sum(axis=1) == passes_n] = False
+
+    for i in range(4):
+        neighbour = index_in_map(neighbours[:, i, 0], neighbours[:, i, 1])
+        is_explored = read_node_flag(global_map, neighbour, cfg.NODE_IS_EXPLORED_FLAG) != 0
+        pheromone_level = read_pheromone_level(global_map, neighbour)
+        is_candidate = paths[:, i] & is_explored & ~forbidden_paths[:, i]
+        is_higher = is_candidate & (pheromone_level > max_pheromone_level)
+        is_equal = is_candidate & ~is_higher & (pheromone_level == max_pheromone_level)
+        most_attractive_node[is_higher] = i
+        max_pheromone_level[is_higher] = pheromone_level[is_higher]
+        is_pheromone_level_shared[is_higher] = False
+        is_pheromone_level_shared[is_equal] = True
+        unexplored_passes_n += paths[:, i] & ~is_explored
+    return is_pheromone_level_shared, most_attractive_node, unexplored_passes_n, passes_n
+
+
+def choose_passage(global_map, flock_pos_sum, flock_vel_sum, avoidance_vectors, prog,
+                   previous_position, previous_velocity, unexplored_passes_n,
+                   is_pheromone_level_shared, most_attractive_node, paths, forbidden_paths,
+                   neighbours):
+    """ Chooses a desired direction """
+    n = len(prog)
+    half_pi = f32(np.pi) / f32(2)
+    chosen_path = np.zeros(n, dtype=np.int64)
+    is_explored = np.stack([read_node_flag(global_map, index_in_map(
+        neighbours[:, i, 0], neighbours[:, i, 1]), cfg.NODE_IS_EXPLORED_FLAG) for i in range(4)],
+        axis=1)
+    is_unexplored_option = paths & ~forbidden_paths & (is_explored == 0)
+
+    # If all paths are explored, choose the one that leads to a node
+    # with the highest attractant level
+    is_path_chosen = (unexplored_passes_n == 0) & ~is_pheromone_level_shared
+    chosen_path[is_path_chosen] = most_attractive_node[is_path_chosen]
+    # If only one unexplored path - choose it
+    only_unexplored = ((unexplored_passes_n == 1) & ~is_path_chosen &
+                       is_unexplored_option.any(axis=1))
+    chosen_path[only_unexplored] = np.argmax(is_unexplored_option[only_unexplored], axis=1)
+    is_path_chosen |= only_unexplored
+
+    # Otherwise choose the path, to which the Reynold's vector is closest
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reynolds_vector = ((flock_pos_sum / f32(cfg.NumberOfBoids) - previous_position) *
+                           f32(cfg.WeightCenterOfMass))
+        reynolds_vector = reynolds_vector - avoidance_vectors * f32(cfg.WeightSeparation)
+        reynolds_vector = reynolds_vector + ((flock_vel_sum / f32(cfg.NumberOfBoids) -
+                                              previous_velocity) * f32(cfg.WeightAlignment))
+        reynolds_angle = np.arctan(reynolds_vector[:, 1] / reynolds_vector[:, 0])
+    # Rotate and flip so that axis X > +positive is 0, axis Y > +positive is pi/2
+    reynolds_angle = np.where(reynolds_vector[:, 0] < 0, f32(np.pi) + reynolds_angle,
+                              reynolds_angle)
+    reynolds_angle = np.where((reynolds_vector[:, 0] > 0) & (reynolds_vector[:, 1] < 0),
+                              f32(2 * np.pi) + reynolds_angle, reynolds_angle)
+    random_angle = prog[:, cfg.PROG_RAND_VAR].astype(np.float32)
+    most_attractive_level = read_pheromone_level(global_map, index_in_map(
+        neighbours[np.arange(n), most_attractive_node, 0],
+        neighbours[np.arange(n), most_attractive_node, 1]))
+
+    by_unexplored = ~is_path_chosen & (unexplored_passes_n > 0)
+    by_random = ~is_path_chosen & ~by_unexplored & is_pheromone_level_shared
+    minimum_angle = np.full(n, f32(2 * np.pi), dtype=np.float32)
+    for i in range(4):
+        multiplier = f32(angle_multipliers[i]) * half_pi
+        with np.errstate(invalid='ignore'):
+            first = np.abs(reynolds_angle - multiplier)
+            second = np.abs((f32(np.pi) - multiplier) - reynolds_angle)
+            # OpenCL min() returns the first argument unless the second one is smaller
+            unexplored_difference = np.where(second < first, second, first)
+            random_difference = np.abs(random_angle - multiplier)
+        pheromone_level = read_pheromone_level(global_map, index_in_map(
+            neighbours[:, i, 0], neighbours[:, i, 1]))
+        angle_difference = np.where(by_unexplored, unexplored_difference, random_difference)
+        is_option = ((by_unexplored & is_unexplored_option[:, i]) |
+                     (by_random & paths[:, i] & ~forbidden_paths[:, i] &
+                      (is_explored[:, i] == 1) & (pheromone_level == most_attractive_level)))
+        with np.errstate(invalid='ignore'):
+            is_closer = is_option & (angle_difference < minimum_angle)
+        minimum_angle[is_closer] = angle_difference[is_closer]
+        chosen_path[is_closer] = i
+    return chosen_path
+
+
+def get_impulse(previous_position, chosen_path):
+    """ Impulse vector from the current position to the middle point of the chosen edge """
+    floor = np.floor(previous_position)
+    ceil = np.ceil(previous_position)
+    half = f32(0.5)
+    goal_point = np.empty_like(previous_position)
+    goal_point[:, 0] = np.select([chosen_path == EAST, chosen_path == WEST],
+                                 [ceil[:, 0], floor[:, 0]], floor[:, 0] + half)
+    goal_point[:, 1] = np.select([chosen_path == NORTH, chosen_path == SOUTH],
+                                 [floor[:, 1], ceil[:, 1]], floor[:, 1] + half)
+    impulse = goal_point - previous_position
+    # Scale vector according to the set speed
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return impulse * (f32(cfg.BoidVelocity) /
+                          np.sqrt(np.square(impulse).sum(axis=1)))[:, np.newaxis]
+
+
+def update_programme(global_map, prog, previous_position, current_node, chosen_path,
+                     neighbours, swamps, deadends_n, rotated_by, is_agent_stalled,
+                     is_wall_detected, is_same_src_square, passes_n, unexplored_passes_n,
+                     readings, random_key, iteration):
+    """ Updates agents' programmes with info about the new goal """
+    n = len(prog)
+    boids = np.arange(n)
+    prog[:, cfg.PROG_RAND_CLOCK_VAR] = to_ushort(prog[:, cfg.PROG_RAND_CLOCK_VAR] + 1)
+    is_rand_clock = prog[:, cfg.PROG_RAND_CLOCK_VAR] == cfg.RAND_CLOCK_MAX
+    prog[is_rand_clock, cfg.PROG_RAND_CLOCK_VAR] = 0
+    prog[is_rand_clock, cfg.PROG_RAND_VAR] = to_ushort(
+        random_angle(np.full(n, iteration), boids, random_key)[is_rand_clock])
+
+    goal_square = neighbours[boids, chosen_path]
+    is_same_goal_square = ((prog[:, cfg.PROG_GOAL_SQUARE_VAR] == goal_square[:, 0]) &
+                           (prog[:, cfg.PROG_GOAL_SQUARE_VAR + 1] == goal_square[:, 1]))
+    # Stall time counter is updated even if the goal is the same
+    stall = is_same_goal_square & is_agent_stalled
+    prog[stall, cfg.PROG_STALL_TIME_VAR] = to_ushort(prog[stall, cfg.PROG_STALL_TIME_VAR] + 1)
+    prog[is_same_goal_square & ~is_agent_stalled, cfg.PROG_STALL_TIME_VAR] = 0
+
+    new_goal = ~is_same_goal_square
+    # Is agent near a goal path?
+    is_near_goal_path = np.zeros(n, dtype=bool)
+    for i in range(4):
+        is_near_goal_path |= read_node_flag(global_map, index_in_map(
+            neighbours[:, i, 0], neighbours[:, i, 1]), cfg.NODE_IS_GOAL_FLAG) == 1
+    entrance_id = maze.Square(maze.Passage.entrance, maze.Orientation.north).get_numeric_value()
+    exit_id = maze.Square(maze.Passage.exit, maze.Orientation.north).get_numeric_value()
+    bottom = readings[:, cfg.READINGS_N - 1]
+    leaving_goal = new_goal & (passes_n - deadends_n <= 1) & (
+        is_near_goal_path | (bottom == entrance_id) | (bottom == exit_id))
+    prog[leaving_goal, cfg.PROG_LEAVING_GOAL_VAR] = TRUE
+    prog[leaving_goal, cfg.PROG_LEAVING_DEADEND_VAR] = TRUE
+
+    # Is the agent leaving the deadend?
+    leaving_deadend = prog[:, cfg.PROG_LEAVING_DEADEND_VAR].copy()
+    just_visited = new_goal & (leaving_deadend == 0) & (passes_n == 1)
+    on_crossroads = (new_goal & (leaving_deadend == TRUE) &
+                     (passes_n - deadends_n - unexplored_passes_n > 1))
+    checking_crossroads = (new_goal & (leaving_deadend == TRUE) & ~on_crossroads &
+                           (unexplored_passes_n > 0) & (passes_n > 1))
+    other = new_goal & (leaving_deadend != 0) & (leaving_deadend != TRUE)
+    another_deadend = (other & is_same_src_square & is_wall_detected &
+                       (unexplored_passes_n == 0) & (passes_n - deadends_n <= 1))
+    left_crossroads = other & ~is_same_src_square
+    prog[just_visited | another_deadend, cfg.PROG_LEAVING_DEADEND_VAR] = TRUE
+    prog[on_crossroads | left_crossroads, cfg.PROG_LEAVING_DEADEND_VAR] = 0
+    prog[on_crossroads | left_crossroads, cfg.PROG_LEAVING_GOAL_VAR] = 0
+    prog[checking_crossroads, cfg.PROG_LEAVING_DEADEND_VAR] = MAYBE
+
+    prog[new_goal, cfg.PROG_STALL_TIME_VAR] = 0
+    prog[new_goal, cfg.PROG_GOAL_SQUARE_VAR] = to_ushort(goal_square[new_goal, 0])
+    prog[new_goal, cfg.PROG_GOAL_SQUARE_VAR + 1] = to_ushort(goal_square[new_goal, 1])
+    prog[new_goal, cfg.PROG_EDGE_VAR] = np.where(
+        (chosen_path[new_goal] == NORTH) | (chosen_path[new_goal] == SOUTH),
+        cfg.GOAL_EDGE_HORIZONTAL, cfg.GOAL_EDGE_VERTICAL)
+    prog[new_goal, cfg.PROG_ROTATED_BY_VAR] = rotated_by[new_goal]
+    prog[new_goal & swamps[boids, chosen_path], cfg.PROG_SWAMP_GOAL_VAR] = TRUE
+    prog[new_goal, cfg.PROG_CHOSEN_PATH_VAR] = chosen_path[new_goal]
+
+    # Source position coors
+    prog[:, cfg.PROG_SRC_COORS_VAR] = to_ushort(float_to_int(previous_position[:, 0]))
+    prog[:, cfg.PROG_SRC_COORS_VAR + 1] = to_ushort(float_to_int(previous_position[:, 1]))
+
+
+def update_pheromone_levels(global_map, prog, previous_flock, current_node, neighbours, boids,
+                            unexplored_passes_n, is_same_src_square, is_wall_detected,
+                            chosen_path):
+    """ Updates node and boid pheromone levels. Returns new boid pheromone levels """
+    level = previous_flock[:, cfg.BOID_PHEROMONE_VAR * cfg.Dimensions]
+    dissolution = f32(cfg.boid_attractant_dissolution_component)
+    level = np.where(level > dissolution, level - dissolution, f32(0))
+
+    node = index_in_map(current_node[:, 0], current_node[:, 1])
+    # The levels are updated in float32 and stored once, as in apply_node_updates()
+    pheromone = maze.to_pheromone_levels(global_map["pheromone_a"])
+    # Update boid's marker pheromone on this node
+    global_map["markers"][node, boids] = cfg.NODE_MARKER_STEPS
+
+    level = np.where(is_wall_detected, np.where(level > 1, level - f32(1), f32(0)), level)
+
+    unexplored_level = (unexplored_passes_n - 1).astype(np.float32)
+    leaving_deadend = prog[:, cfg.PROG_LEAVING_DEADEND_VAR] == TRUE
+    # Agent will only remove all node pheromones if it is sure it's not on crossroads
+    clear = leaving_deadend & (unexplored_passes_n == 0)
+    pheromone[node[clear]] = 0
+
+    update = ~leaving_deadend & ~is_same_src_square
+    # An agent can be trailing itself only if there are no unexplored passes available
+    chosen_neighbour = neighbours[boids, chosen_path]
+    trailing_itself = update & (unexplored_passes_n == 0) & (read_node_marker(
+        global_map, index_in_map(chosen_neighbour[:, 0], chosen_neighbour[:, 1]), boids) != 0)
+    pheromone[node[trailing_itself]] = level[trailing_itself]
+
+    # Agent consumes 1 attractant pheromone on each node it visits
+    consume = update & ~trailing_itself
+    is_consumed = consume & (pheromone[node] >= 1)
+    np.subtract.at(pheromone, node[is_consumed], f32(1))
+    pheromone[node[consume & ~is_consumed]] = 0
+
+    # Node attractant pheromone level must be always no less than number of unexplored passes
+    # it has minus one
+    raise_level = update & (unexplored_passes_n > 1) & (pheromone[node] < unexplored_level)
+    pheromone[node[raise_level]] = unexplored_level[raise_level]
+
+    # Add agent's own attractant level to the node's attractant level. Boids sharing a node
+    # overwrite each other's additions, the last one's stays (as in apply_node_updates())
+    pheromone[node[consume]] = pheromone[node[consume]] + level[consume]
+    global_map["pheromone_a"][node] = maze.to_fixed_pheromone_levels(pheromone[node])
+    return np.where(consume & (unexplored_passes_n > 1), level + unexplored_level, level)
+
+
+def update_node_status(global_map, prog, current_node):
+    """ Updates node attributes other than pheromone level """
+    leaving_deadend = prog[:, cfg.PROG_LEAVING_DEADEND_VAR] == TRUE
+    leaving_goal = prog[:, cfg.PROG_LEAVING_GOAL_VAR] != 0
+    node = index_in_map(current_node[:, 0], current_node[:, 1])
+    flags = global_map["flags"]
+    deadend = leaving_deadend & ~leaving_goal
+    np.bitwise_or.at(flags, node[deadend], np.uint8(1 << cfg.NODE_IS_DEADEND_FLAG))
+    goal = leaving_deadend & leaving_goal
+    np.bitwise_or.at(flags, node[goal], np.uint8(1 << cfg.NODE_IS_GOAL_FLAG))
+    # If agent has just entered the node, update node exploration status
+    entered = prog[:, cfg.PROG_EDGE_VAR] != GOAL_NOT_SET
+    np.bitwise_or.at(flags, node[entered], np.uint8(1 << cfg.NODE_IS_EXPLORED_FLAG))
+
+
+def simulate_locomotion(previous_position, previous_velocity, impulse):
+    """ Applies traction, inertia and maze bounds to impulses. Returns velocities """
+    velocity = impulse * (f32(1) - f32(cfg.Traction))
+    velocity = (previous_velocity * f32(cfg.WeightInertia) +
+                velocity * (f32(1) - f32(cfg.WeightInertia)))
+    new_position = previous_position + velocity
+    bounds = np.array([cfg.maze_width, cfg.maze_height], dtype=np.float32)
+    with np.errstate(invalid='ignore'):
+        out_of_bounds = (new_position > bounds) | (new_position < 0)
+    return np.where(out_of_bounds, f32(0), velocity)
+
+
+def zero_non_finite(values):
+    return np.where(np.isfinite(values), values, f32(0))
+
+
+def get_orientations(velocity, previous_orientation):
+    """ Directions of velocities in [0, 2 pi). Boids standing still keep their orientations """
+    orientation = np.arctan2(velocity[:, 1], velocity[:, 0])
+    orientation = np.where(orientation < 0, orientation + f32(2 * np.pi), orientation)
+    return np.where((velocity == 0).all(axis=1), previous_orientation, orientation)
+
+
+def get_triangle_indices(orientation):
+    """ Template triangles are rendered for whole degrees """
+    return np.minimum(np.rint(np.degrees(orientation)), cfg.triangles_n - 1)
+
+
+def check_goal_reachability(maze_matrix, global_map):
+    """
+    Whether the goal is reachable through explored passages from the start, both moved
+    along the goal paths of the agents (k_check_goal_reachability). Nodes reached from the
+    start are marked in waves, until the goal is reached or a wave marks nothing new
+    """
+    map_inst = global_map.reshape(cfg.maze_width, cfg.maze_height)
+    start = maze_solver.reuse_swarm_progress(map_inst, cfg.starting_node)
+    goal = maze_solver.reuse_swarm_progress(map_inst, cfg.goal_node)
+    first_wall_id = maze.Square(maze.Wall.normal, maze.Orientation.north).get_numeric_value()
+    is_open = (maze_matrix < first_wall_id) & \
+        ((map_inst["flags"] >> cfg.NODE_IS_EXPLORED_FLAG & 1) == 1)
+    reached = np.zeros((cfg.maze_width, cfg.maze_height), dtype=bool)
+    reached[start] = True
+    while not reached[goal]:
+        neighbour_reached = np.zeros_like(reached)
+        neighbour_reached[:, 1:] |= reached[:, :-1]
+        neighbour_reached[:, :-1] |= reached[:, 1:]
+        neighbour_reached[1:, :] |= reached[:-1, :]
+        neighbour_reached[:-1, :] |= reached[1:, :]
+        wave = neighbour_reached & is_open & ~reached
+        if not wave.any():
+            break
+        reached |= wave
+    return bool(reached[goal])
+
+
+def dissolute_pheromones(global_map):
+    """ Pheromone levels are reduced regularly to simulate ageing """
+    a_dissolution = f32(cfg.node_attractant_dissolution_component)
+    attractant = maze.to_pheromone_levels(global_map["pheromone_a"])
+    global_map["pheromone_a"] = maze.to_fixed_pheromone_levels(
+        np.where(attractant > a_dissolution, attractant - a_dissolution, f32(0)))
+    markers = global_map["markers"]
+    markers[markers > 0] -= 1
+    flags = global_map["flags"]
+    is_node_outdated = ((flags >> cfg.NODE_IS_DEADEND_FLAG & 1) == 0) & ~(markers > 0).any(axis=1)
+    flags[is_node_outdated] &= np.uint8(~(1 << cfg.NODE_IS_EXPLORED_FLAG) & 0xFF)
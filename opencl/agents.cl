@@ -1,56 +1,95 @@
 #include "utilities.h"
 #include "agents.h"
 
-// Will be called NUMBER_OF_BOIDS times
+// Will be called by all work items of a group
 void
-agent_reynolds_rules13_preprocess(__local float* local_flock_pos_sum,
-                                  __local float* local_flock_vel_sum,
-                                  float* previous_position,
-                                  float* previous_velocity) {
+agent_reynolds_rules13_preprocess(__local float* local_positions,
+                                  __local float* local_velocities,
+                                  int local_id) {
     // Reynold's rule 1. Cohesion - Steer to move towards the center of mass
-    // Create partial (for <group_size> boids) sum in local memory
-    atomic_add_local_arr(local_flock_pos_sum, previous_position);
-    
     // Reynold's rule 3. Alignment - Steer towards the average heading of local flockmates
-    // Create partial (for <group_size> boids) sum in local memory
-    atomic_add_local_arr(local_flock_vel_sum, previous_velocity);
+    // Create partial (for <group_size> boids) sums of positions and velocities in local
+    // memory. They are summed up in a tree: each round adds the upper half of the values
+    // to the lower half, so the order of the additions is always the same
+    int size, stride;
+    for (size = K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE; size > 1; size = stride) {
+        stride = (size + 1) / 2;
+        if (local_id < size - stride) {
+            VSTOREN(VLOADN(&local_positions[local_id * DIMENSIONS]) +
+                    VLOADN(&local_positions[(local_id + stride) * DIMENSIONS]),
+                    &local_positions[local_id * DIMENSIONS]);
+            VSTOREN(VLOADN(&local_velocities[local_id * DIMENSIONS]) +
+                    VLOADN(&local_velocities[(local_id + stride) * DIMENSIONS]),
+                    &local_velocities[local_id * DIMENSIONS]);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+}
+
+
+
+// Will be called NUMBER_OF_BOIDS times
+int
+get_cell_index(__global float* previous_flock,
+               int boid_id,
+               int* cell_x,
+               int* cell_y) {
+    // Cells are maze tiles. Boids outside the maze are put into the border cells
+    *cell_x = clamp((int)floor(previous_flock[INDEX_IN_FLOCK(boid_id, BOID_POS_VAR)]), 0, MAZE_WIDTH - 1);
+    *cell_y = clamp((int)floor(previous_flock[INDEX_IN_FLOCK(boid_id, BOID_POS_VAR) + 1]), 0, MAZE_HEIGHT - 1);
+    return INDEX_IN_MAZE(*cell_x, *cell_y);
 }
 
 
 
-// Will be called NUMBER_OF_BOIDS * NUMBER_OF_BOIDS times
+// Will be called NUMBER_OF_BOIDS times
 void
 agent_reynolds_rule2_preprocess(__global float* previous_flock,
-                                __global float* global_boid_avoidance_vectors,
+                                __global int* global_cell_heads,
+                                __global int* global_boid_next,
                                 int main_boid_id,
-                                int compared_boid_id) {
+                                FLOATN* avoidance_vector) {
     float adistance;
     FLOATN difference;
+    FLOATN position = VLOADN(&previous_flock[INDEX_IN_FLOCK(main_boid_id, BOID_POS_VAR)]);
+    int cell_x, cell_y, x, y;
+    int compared_boid_id;
 
     // Reynold's rule 2. Separation - steer to avoid crowding local flockmates
-    // Create an avoidance vector for each boid
-    difference = VLOADN(&previous_flock[INDEX_IN_FLOCK(compared_boid_id, BOID_POS_VAR)]) - 
-                    VLOADN(&previous_flock[INDEX_IN_FLOCK(main_boid_id, BOID_POS_VAR)]);
-    adistance = length(difference);
-    if (adistance > 0 && adistance < MINSEPARATION)
-        atomic_add_global_v(&global_boid_avoidance_vectors[INDEX_IN_BOID(main_boid_id)], &difference);
+    // Create an avoidance vector for each boid. Flockmates closer than MINSEPARATION
+    // can only be in the cells within SEPARATION_CELLS from the boid's one
+    get_cell_index(previous_flock, main_boid_id, &cell_x, &cell_y);
+    *avoidance_vector = 0;
+    for (x = max(cell_x - SEPARATION_CELLS, 0); x <= min(cell_x + SEPARATION_CELLS, MAZE_WIDTH - 1); x++)
+        for (y = max(cell_y - SEPARATION_CELLS, 0); y <= min(cell_y + SEPARATION_CELLS, MAZE_HEIGHT - 1); y++)
+            for (compared_boid_id = global_cell_heads[INDEX_IN_MAZE(x, y)];
+                 compared_boid_id != NO_BOID;
+                 compared_boid_id = global_boid_next[compared_boid_id]) {
+                difference = VLOADN(&previous_flock[INDEX_IN_FLOCK(compared_boid_id, BOID_POS_VAR)]) -
+                                position;
+                adistance = length(difference);
+                if (adistance > 0 && adistance < MINSEPARATION)
+                    *avoidance_vector += difference;
+            }
 }
 
 
 
 void
-agent_ai(__global float* global_map,
+agent_ai(__global uchar* global_map,
          __global uchar* global_cmm,
-         __global float* global_boid_avoidance_vectors,
+         FLOATN avoidance_vector,
          __local float* local_flock_pos_sum,
          __local float* local_flock_vel_sum,
          __global float* global_previous_flock,
          __global float* global_new_flock,
          __global ushort* global_agent_programme,
+         __global int* global_node_update,
          uchar* sensor_readings,
          int global_id,
          FLOATN* impulse,
-         __global float* global_random,
+         uint random_key,
+         uint2 random_counter,
          __local ushort* local_iteration,
          __global float* global_experiment,
          __global float* global_test) {
@@ -154,7 +193,7 @@ agent_ai(__global float* global_map,
     chosen_path = choose_passage(global_map,
                                  local_flock_pos_sum,
                                  local_flock_vel_sum,
-                                 global_boid_avoidance_vectors,
+                                 avoidance_vector,
                                  global_agent_programme,
                                  global_id,
                                  previous_boid,
@@ -190,13 +229,15 @@ agent_ai(__global float* global_map,
                      passes_n,
                      unexplored_passes_n,
                      sensor_readings,
-                     global_random,
+                     random_key,
+                     random_counter,
                      global_test);
 
     /* Update node and boid's pheromone levels */
     update_pheromone_levels(global_map,
                             global_new_flock,
                             global_agent_programme,
+                            global_node_update,
                             previous_boid,
                             current_node,
                             global_id,
@@ -209,11 +250,10 @@ agent_ai(__global float* global_map,
                             delta_coors,
                             global_test);
     /* Update node attributes other than pheromone level */
-    update_node_status(global_map,
+    update_node_status(global_node_update,
                        global_agent_programme,
                        passes_n,
                        unexplored_passes_n,
-                       current_node,
                        global_test);
 
     // TEST
@@ -400,7 +440,7 @@ in_proximity(float what, float of) {
 
 void
 get_paths(__global uchar* global_cmm,
-          __global float* global_map,
+          __global uchar* global_map,
           __global ushort* global_agent_programme,
           UCHARN current_node,
           uchar* paths,
@@ -445,9 +485,10 @@ get_paths(__global uchar* global_cmm,
     }
     // Get list of swamps
     for (i = 4; i < 8; i++) {
-        rotated_id = i + rotated_by < TRIGRAMS_N ?
-                     i + rotated_by :
-                     i + rotated_by - TRIGRAMS_N;
+        // SLOW_GO neurons start at index 4
+        rotated_id = i - 4 + rotated_by < TRIGRAMS_N ?
+                     i - 4 + rotated_by :
+                     i - 4 + rotated_by - TRIGRAMS_N;
         swamps[rotated_id] = false;
         // Apply fixed threshold
         // The last reading is not considered here
@@ -459,12 +500,10 @@ get_paths(__global uchar* global_cmm,
     // Have agent entered into a loop between current node and the suggested path
     for (i = 0; i < 4; i++) {
         forbidden_paths[i] = false;
-        if (global_map[ INDEX_IN_MAP(DELTA_COOR_X( current_node, i ),
-                                     DELTA_COOR_Y( current_node, i ),
-                                     NODE_IS_DEADEND_VAR)] == true ||
-            global_map[ INDEX_IN_MAP(DELTA_COOR_X( current_node, i ),
-                                     DELTA_COOR_Y( current_node, i ),
-                                     NODE_IS_GOAL_VAR)] == true) {
+        if (NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                       DELTA_COOR_Y( current_node, i ), NODE_IS_DEADEND_FLAG) == true ||
+            NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                       DELTA_COOR_Y( current_node, i ), NODE_IS_GOAL_FLAG) == true) {
             *deadends_n += 1;
             forbidden_paths[i] = true;
         }
@@ -480,7 +519,7 @@ get_paths(__global uchar* global_cmm,
 
 
 void
-browse_passages(__global float* global_map,
+browse_passages(__global uchar* global_map,
                 boolean* is_pheromone_level_shared,
                 uchar* most_attractive_node,
                 uchar* unexplored_passes_n,
@@ -515,27 +554,22 @@ browse_passages(__global float* global_map,
         // For 4 possible directions
         if (is_passage[i]) {
             // If neural network says the square is a passage, not an obstacle
-            if (global_map[ INDEX_IN_MAP(DELTA_COOR_X( current_node, i ),
-                                         DELTA_COOR_Y( current_node, i ),
-                                         NODE_IS_EXPLORED_VAR)]) {
+            if (NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                           DELTA_COOR_Y( current_node, i ), NODE_IS_EXPLORED_FLAG)) {
                 // If the square is explored
                 if (is_passage_forbidden[i] == false) {
                     // If the square is not forbidden. Otherwise we are not interested in its attractant level
-                    if (global_map[ INDEX_IN_MAP( DELTA_COOR_X( current_node, i ),
-                                                  DELTA_COOR_Y( current_node, i ),
-                                                  NODE_PHEROMONE_A_VAR)] > max_pheromone_level) {
+                    if (NEIGHBOUR_PHEROMONE_A(global_map, DELTA_COOR_X( current_node, i ),
+                                                          DELTA_COOR_Y( current_node, i )) > max_pheromone_level) {
                         // If square has the highest attractant level so far, save it
                         *most_attractive_node = i;
-                        max_pheromone_level = global_map[ 
-                            INDEX_IN_MAP( DELTA_COOR_X( current_node, i ),
-                                          DELTA_COOR_Y( current_node, i ),
-                                          NODE_PHEROMONE_A_VAR)];
+                        max_pheromone_level = NEIGHBOUR_PHEROMONE_A(global_map, DELTA_COOR_X( current_node, i ),
+                                                                                DELTA_COOR_Y( current_node, i ));
                         *is_pheromone_level_shared = false;
                     }
                     else
-                        if (global_map[ INDEX_IN_MAP( DELTA_COOR_X( current_node, i ),
-                                                      DELTA_COOR_Y( current_node, i ),
-                                                      NODE_PHEROMONE_A_VAR)] == max_pheromone_level)
+                        if (NEIGHBOUR_PHEROMONE_A(global_map, DELTA_COOR_X( current_node, i ),
+                                                              DELTA_COOR_Y( current_node, i )) == max_pheromone_level)
                             *is_pheromone_level_shared = true;
                 }
             }
@@ -550,10 +584,10 @@ browse_passages(__global float* global_map,
 
 
 uchar
-choose_passage(__global float* global_map,
+choose_passage(__global uchar* global_map,
                __local float* local_flock_pos_sum,
                __local float* local_flock_vel_sum,
-               __global float* global_boid_avoidance_vectors,
+               FLOATN avoidance_vector,
                __global ushort* global_agent_programme,
                int global_id,
                float* previous_boid,
@@ -578,9 +612,8 @@ choose_passage(__global float* global_map,
         if (unexplored_passes_n == 1) {
             for (i = 0; i < 4; i++)
                 if (is_passage[i] && is_passage_forbidden[i] == false &&
-                   global_map[ INDEX_IN_MAP(DELTA_COOR_X( current_node, i ),
-                                            DELTA_COOR_Y( current_node, i ),
-                                            NODE_IS_EXPLORED_VAR) ] == false) {
+                   NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                              DELTA_COOR_Y( current_node, i ), NODE_IS_EXPLORED_FLAG) == false) {
                     chosen_path = i;
                     is_path_chosen = true;
                     break;
@@ -604,7 +637,7 @@ choose_passage(__global float* global_map,
 
         // Reynold's rule 2. Separation - steer to avoid crowding local flockmates
         // Avoidance vectors were calculated during preprocessing
-        reynolds_vector = reynolds_vector - VLOADN(&global_boid_avoidance_vectors[INDEX_IN_BOID(global_id)]) * WEIGHTSEPARATION;
+        reynolds_vector = reynolds_vector - avoidance_vector * WEIGHTSEPARATION;
 
         // Reynold's rule 3. Alignment - Steer towards the average heading of local flockmates
         // Center of flock velocity was calculated during preprocessing
@@ -625,14 +658,16 @@ choose_passage(__global float* global_map,
             // choose the path, to which the Reynold's vector is closest
             for (i = 0; i < 4; i++) {
                 if (is_passage[i] && is_passage_forbidden[i] == false &&
-                   global_map[ INDEX_IN_MAP(DELTA_COOR_X( current_node, i ), 
-                                            DELTA_COOR_Y( current_node, i ),
-                                            NODE_IS_EXPLORED_VAR)] == false) {
+                   NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                              DELTA_COOR_Y( current_node, i ), NODE_IS_EXPLORED_FLAG) == false) {
                     // Inline if for translating North=0, East=1 etc into North=1,
-                    // East=0, South=3, West=2 (half_pi multiplier)
+                    // East=0, South=3, West=2 (half_pi multiplier). The constant is
+                    // subtracted last, so East and West, which are equally close, tie exactly
+                    // instead of by the rounding of reynolds_angle
                     angle_difference = min(fabs(reynolds_angle - 
                                                 (1 - i >= 0 ? 1 - i : 5 - i) * half_pi),
-                                           fabs((float)M_PI - reynolds_angle - (1 - i >= 0 ? 1 - i : 5 - i) * half_pi));
+                                           fabs(((float)M_PI - (1 - i >= 0 ? 1 - i : 5 - i) * half_pi) -
+                                                reynolds_angle));
                     if (angle_difference < minimum_angle) {
                         minimum_angle = angle_difference;
                         chosen_path = i;
@@ -647,15 +682,12 @@ choose_passage(__global float* global_map,
                 // Choose the path, to which the Reynold's vector is closest
                 for (i = 0; i < 4; i++) {
                     if (is_passage[i] && is_passage_forbidden[i] == false &&
-                       global_map[ INDEX_IN_MAP(DELTA_COOR_X( current_node, i ),
-                                                DELTA_COOR_Y( current_node, i ),
-                                                NODE_IS_EXPLORED_VAR)] == true &&
-                       global_map[ INDEX_IN_MAP( DELTA_COOR_X( current_node, i ),
-                                                 DELTA_COOR_Y( current_node, i ),
-                                                 NODE_PHEROMONE_A_VAR)] == 
-                       global_map[ INDEX_IN_MAP( DELTA_COOR_X( current_node, most_attractive_node),
-                                                 DELTA_COOR_Y( current_node, most_attractive_node),
-                                                 NODE_PHEROMONE_A_VAR )]) {
+                       NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                                  DELTA_COOR_Y( current_node, i ), NODE_IS_EXPLORED_FLAG) == true &&
+                       NEIGHBOUR_PHEROMONE_A(global_map, DELTA_COOR_X( current_node, i ),
+                                                         DELTA_COOR_Y( current_node, i )) == 
+                       NEIGHBOUR_PHEROMONE_A(global_map, DELTA_COOR_X( current_node, most_attractive_node),
+                                                         DELTA_COOR_Y( current_node, most_attractive_node))) {
                         // Inline if for translating North=0, East=1 etc into North=1,
                         // East=0, South=3, West=2 (half_pi multiplier)
                         angle_difference = fabs(reynolds_angle - 
@@ -705,7 +737,7 @@ get_impulse(float* previous_boid,
 
 
 void
-update_programme(__global float* global_map,
+update_programme(__global uchar* global_map,
                  __global ushort* global_agent_programme,
                  float* previous_boid,
                  UCHARN current_node,
@@ -721,13 +753,15 @@ update_programme(__global float* global_map,
                  uchar passes_n,
                  uchar unexplored_passes_n,
                  uchar* sensor_readings,
-                 __global float* global_random,
+                 uint random_key,
+                 uint2 random_counter,
                  __global float* global_test) {
     boolean is_same_goal_square = false;
     global_agent_programme[PROG_RAND_CLOCK_VAR] += 1;
     if (global_agent_programme[PROG_RAND_CLOCK_VAR] == RAND_CLOCK_MAX) {
         global_agent_programme[PROG_RAND_CLOCK_VAR] = 0;
-        global_agent_programme[PROG_RAND_VAR] = *global_random;
+        // Every agent draws its own number, so nothing is uploaded by the host
+        global_agent_programme[PROG_RAND_VAR] = random_angle(random_counter, random_key);
     }
     if (global_agent_programme[PROG_GOAL_SQUARE_VAR] == current_node.x +
                                                         delta_coors[chosen_path * 2] &&
@@ -750,9 +784,8 @@ update_programme(__global float* global_map,
         /* Is agent near a goal path? */
         boolean is_near_goal_path = false;
         for (int i = 0; i < 4; i++) {
-            if (global_map[INDEX_IN_MAP(DELTA_COOR_X( current_node, i ), 
-                                        DELTA_COOR_Y( current_node, i ),
-                                        NODE_IS_GOAL_VAR)] == true) {
+            if (NEIGHBOUR_FLAG(global_map, DELTA_COOR_X( current_node, i ),
+                                           DELTA_COOR_Y( current_node, i ), NODE_IS_GOAL_FLAG) == true) {
                 is_near_goal_path = true;
                 break;
             }
@@ -851,9 +884,10 @@ update_programme(__global float* global_map,
 
 
 void
-update_pheromone_levels(__global float* global_map,
+update_pheromone_levels(__global uchar* global_map,
                         __global float* global_new_flock,
                         __global ushort* global_agent_programme,
+                        __global int* global_node_update,
                         float *previous_boid,
                         UCHARN current_node,
                         int global_id,
@@ -880,9 +914,7 @@ update_pheromone_levels(__global float* global_map,
         new_boid_pheromone_level = 0;
 
     // Update boid's marker pheromone on this node
-    global_map[ INDEX_IN_MAP( current_node.x,
-                              current_node.y,
-                              NODE_PHEROMONE_M_VAR ) + global_id] = 1;
+    NODE_MARKER(global_map, current_node.x, current_node.y, global_id) = NODE_MARKER_STEPS;
 
     if (is_wall_detected)
         // The wall agent has just detected was previously an unknown path and has increased
@@ -892,14 +924,17 @@ update_pheromone_levels(__global float* global_map,
         else
             new_boid_pheromone_level = 0;
 
-    // We don't fetch node pheromone level into the private memory as it is a shared memory
-    // and can get updated in parallel by other agents, so operations have to be as atomic
-    // as possible
+    // Node attractant pheromone level is read by other agents in parallel, so it is not
+    // updated here. The update is recorded and applied by k_apply_node_updates
+    global_node_update[NODE_UPDATE_NODE_VAR] = INDEX_IN_MAZE(current_node.x, current_node.y);
+    global_node_update[NODE_UPDATE_OP_VAR] = NODE_UPDATE_NONE;
+    global_node_update[NODE_UPDATE_LEVEL_VAR] = as_int(new_boid_pheromone_level);
+    global_node_update[NODE_UPDATE_RAISE_VAR] = 0;
     if (global_agent_programme[PROG_LEAVING_DEADEND_VAR] == TRUE) {
         // The agent is on a path to a deadend and still on an unexplored track
         if (unexplored_passes_n == 0) {
             // Agent will only remove all node pheromones if it is sure it's not on crossroads
-            global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] = 0;
+            global_node_update[NODE_UPDATE_OP_VAR] = NODE_UPDATE_CLEAR;
         }
     }
     else {
@@ -910,19 +945,17 @@ update_pheromone_levels(__global float* global_map,
                 // An agent can be trailing itself only if there are no unexplored passes available
                 trailing_itself = true;
                 /*uchar current_node_pheromones = 
-                    global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )];
+                    NODE_PHEROMONE_A(global_map, current_node.x, current_node.y);
                 for (int i = 0; i < 4; i++) {
                     if (i != chosen_path && is_passage[i] == true && is_passage_forbidden[i] == false) {
-                        if (global_map[ INDEX_IN_MAP( DELTA_COOR_X( current_node, i ),
-                                                      DELTA_COOR_Y( current_node, i ),
-                                                      NODE_PHEROMONE_A_VAR)] > current_node_pheromones) {
+                        if (NEIGHBOUR_PHEROMONE_A(global_map, DELTA_COOR_X( current_node, i ),
+                                                              DELTA_COOR_Y( current_node, i )) > current_node_pheromones) {
                             trailing_itself = false;
                         }
                     }
                 }*/                
-                if (global_map[ INDEX_IN_MAP( DELTA_COOR_X( current_node, chosen_path ),
-                                              DELTA_COOR_Y( current_node, chosen_path ),
-                                              NODE_PHEROMONE_M_VAR) + global_id] == 0) {
+                if (NEIGHBOUR_MARKER(global_map, DELTA_COOR_X( current_node, chosen_path ),
+                                                 DELTA_COOR_Y( current_node, chosen_path ), global_id) == 0) {
                     trailing_itself = false;
                 }
                 if (trailing_itself == true) {
@@ -930,35 +963,23 @@ update_pheromone_levels(__global float* global_map,
                     // the new paths. In order to prevent the agent from updating the attractant levels of nodes
                     // it just visited up to very high values, the agent will set the attractant levels to its own
                     // attractant level (instead of adding its level to node's level).
-                    global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] = new_boid_pheromone_level;
+                    global_node_update[NODE_UPDATE_OP_VAR] = NODE_UPDATE_TRAIL;
                 }
             }
             if (trailing_itself == false) {
-            // Agent consumes 1 attractant pheromone on each node it visits
-                if (global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] >= 1) {
-                    float decrement = -1;
-                    atomic_add_global_float(&global_map[ INDEX_IN_MAP( current_node.x,
-                                                                       current_node.y,
-                                                                       NODE_PHEROMONE_A_VAR )],
-                                            &decrement);
-                }
-                else
-                    // If node attractant level is below 1, set it to zero
-                    global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] = 0;
+                // Agent consumes 1 attractant pheromone on each node it visits (or sets the level
+                // to zero, if it is below 1) and adds its own attractant level to the node's one
+                global_node_update[NODE_UPDATE_OP_VAR] = NODE_UPDATE_CONSUME;
             }
 
-            if (unexplored_passes_n > 1 &&
-                global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] < unexplored_passes_n - 1) {
+            if (unexplored_passes_n > 1) {
                 // Node attractant pheromone level must be always no less than number of unexplored passes it has
                 // minus one, as agent will explore one. It will still be reduced by one if two agents
                 // in the same node are targeting the same unexplored path.
-                global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] = unexplored_passes_n - 1;
+                global_node_update[NODE_UPDATE_RAISE_VAR] = unexplored_passes_n - 1;
             }
 
             if (trailing_itself == false) {
-                // Add agent's own attractant level to the node's attractant level
-                global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_PHEROMONE_A_VAR )] += new_boid_pheromone_level;
-
                 // Update agent's attractant level:
                 // If unexplored paths remain on current node, increase attractant level
                 if (unexplored_passes_n > 1)
@@ -973,12 +994,13 @@ update_pheromone_levels(__global float* global_map,
 
 
 void
-update_node_status(__global float* global_map,
+update_node_status(__global int* global_node_update,
                    __global ushort* global_agent_programme,
                    uchar passes_n,
                    uchar unexplored_passes_n,
-                   UCHARN current_node,
                    __global float* global_test) {
+    // Flags are recorded with the pheromone update and set by k_apply_node_updates
+    uint flags = 0;
     if (global_agent_programme[PROG_LEAVING_DEADEND_VAR] == TRUE) {
         // The agent is on a path to a deadend and still on an unexplored track
         //if (unexplored_passes_n == 0 || passes_n < 2) {
@@ -987,21 +1009,17 @@ update_node_status(__global float* global_map,
             // square and set its attractant level to 0.
             // If there is less then 2 roads, it's definitely not crossroads.
             if (global_agent_programme[PROG_LEAVING_GOAL_VAR] == false)
-                global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_IS_DEADEND_VAR )] = true;
+                flags |= 1u << NODE_IS_DEADEND_FLAG;
             else
-                global_map[ INDEX_IN_MAP( current_node.x, current_node.y, NODE_IS_GOAL_VAR )] = true;
+                flags |= 1u << NODE_IS_GOAL_FLAG;
         //}
     }
     
     if (global_agent_programme[PROG_EDGE_VAR] != GOAL_NOT_SET)
         // If agent has just entered the node
         // Update node exploration status
-        if (global_map[ INDEX_IN_MAP(current_node.x,
-                                     current_node.y,
-                                     NODE_IS_EXPLORED_VAR)] == false)
-            global_map[ INDEX_IN_MAP(current_node.x,
-                                     current_node.y,
-                                     NODE_IS_EXPLORED_VAR)] = true;
+        flags |= 1u << NODE_IS_EXPLORED_FLAG;
+    global_node_update[NODE_UPDATE_FLAGS_VAR] = flags;
 }
 
 
@@ -1,27 +1,34 @@
 /* Prototypes */
 void
-agent_reynolds_rules13_preprocess(__local float* local_flock_pos_sum,
-                                  __local float* local_flock_vel_sum,
-                                  float* previous_position,
-                                  float* previous_velocity);
+agent_reynolds_rules13_preprocess(__local float* local_positions,
+                                  __local float* local_velocities,
+                                  int local_id);
+int
+get_cell_index(__global float* previous_flock,
+               int boid_id,
+               int* cell_x,
+               int* cell_y);
 void
 agent_reynolds_rule2_preprocess(__global float* previous_flock,
-                                __global float* global_boid_avoidance_vectors,
+                                __global int* global_cell_heads,
+                                __global int* global_boid_next,
                                 int main_boid_id,
-                                int compared_boid_id);
+                                FLOATN* avoidance_vector);
 void
-agent_ai(__global float* global_map,
+agent_ai(__global uchar* global_map,
          __global uchar* global_cmm,
-         __global float* global_boid_avoidance_vectors,
+         FLOATN avoidance_vector,
          __local float* local_flock_pos_sum,
          __local float* local_flock_vel_sum,
          __global float* global_previous_flock,
          __global float* global_new_flock,
          __global ushort* global_agent_programme,
+         __global int* global_node_update,
          uchar* sensor_readings,
          int global_id,
          FLOATN* impulse,         
-         __global float* global_random,
+         uint random_key,
+         uint2 random_counter,
          __local ushort* local_iteration,
          __global float* global_experiment,
          __global float* global_test);
@@ -45,7 +52,7 @@ uchar
 in_proximity(float what, float of);
 void
 get_paths(__global uchar* global_cmm,
-          __global float* global_map,
+          __global uchar* global_map,
           __global ushort* global_agent_programme,
           UCHARN current_node,
           uchar* paths,
@@ -57,7 +64,7 @@ get_paths(__global uchar* global_cmm,
           char* delta_coors,
           __global float* global_test);
 void
-browse_passages(__global float* global_map,
+browse_passages(__global uchar* global_map,
                 boolean* is_pheromone_level_shared,
                 uchar* most_attractive_node,
                 uchar* unexplored_passes_n,
@@ -68,10 +75,10 @@ browse_passages(__global float* global_map,
                 uchar* passes_n,
                 __global float* global_test);
 uchar
-choose_passage(__global float* global_map,
+choose_passage(__global uchar* global_map,
                __local float* local_flock_pos_sum,
                __local float* local_flock_vel_sum,
-               __global float* global_boid_avoidance_vectors,
+               FLOATN avoidance_vector,
                __global ushort* global_agent_programme,
                int global_id,
                float* previous_boid,
@@ -88,7 +95,7 @@ get_impulse(float* previous_boid,
             uchar chosen_path,
             FLOATN* impulse);
 void
-update_programme(__global float* global_map,
+update_programme(__global uchar* global_map,
                  __global ushort* global_agent_programme,
                  float* previous_boid,
                  UCHARN current_node,
@@ -104,12 +111,14 @@ update_programme(__global float* global_map,
                  uchar passes_n,
                  uchar unexplored_passes_n,
                  uchar* sensor_readings,
-                 __global float* global_random,
+                 uint random_key,
+                 uint2 random_counter,
                  __global float* global_test);
 void
-update_pheromone_levels(__global float* global_map,
+update_pheromone_levels(__global uchar* global_map,
                         __global float* global_new_flock,
                         __global ushort* global_agent_programme,
+                        __global int* global_node_update,
                         float *previous_boid,
                         UCHARN current_node,
                         int global_id,
@@ -122,11 +131,10 @@ update_pheromone_levels(__global float* global_map,
                         char* delta_coors,
                         __global float* global_test);
 void
-update_node_status(__global float* global_map,
+update_node_status(__global int* global_node_update,
                    __global ushort* global_agent_programme,
                    uchar passes_n,
                    uchar unexplored_passes_n,
-                   UCHARN current_node,
                    __global float* global_test);
 uchar
 reverse_direction(uchar direction);
\ No newline at end of file
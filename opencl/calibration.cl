@@ -0,0 +1,10 @@
+// A short arithmetic-bound kernel for choosing the fastest device.
+// It is built on its own, without macros of main.cl
+__kernel void
+k_calibrate(__global float* data) {
+    int global_id = get_global_id(0);
+    float value = data[global_id];
+    for (int i = 0; i < 64; i++)
+        value = value * 0.999f + 0.001f;
+    data[global_id] = value;
+}
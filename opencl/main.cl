@@ -2,10 +2,32 @@
 // OpenCL
 #define PREFERRED_WORK_GROUP_SIZE_MULTIPLE      %(preferred_work_group_size_multiple)d
 #define MAX_WORK_GROUP_SIZE                     %(max_work_group_size)d
+// Work group sizes of the kernels, tuned per device and workload (see autotuning.py)
+#define K_UPDATE_MAP_GROUP_SIZE                 %(k_update_map_group_size)d
+#define K_LIST_MAP_CHANGES_GROUP_SIZE           %(k_list_map_changes_group_size)d
+#define K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE %(k_agent_reynolds_rules13_preprocess_group_size)d
+#define K_CLEAR_CELLS_GROUP_SIZE                %(k_clear_cells_group_size)d
+#define K_BIN_BOIDS_GROUP_SIZE                  %(k_bin_boids_group_size)d
+#define K_SORT_CELLS_GROUP_SIZE                 %(k_sort_cells_group_size)d
+#define K_AGENT_REYNOLDS_RULE2_PREPROCESS_GROUP_SIZE %(k_agent_reynolds_rule2_preprocess_group_size)d
+#define K_AGENT_AI_AND_SIM_GROUP_SIZE           %(k_agent_ai_and_sim_group_size)d
+#define K_AGENT_STEP_FUSED_GROUP_SIZE           %(k_agent_step_fused_group_size)d
+#define K_APPLY_NODE_UPDATES_GROUP_SIZE         %(k_apply_node_updates_group_size)d
+#define K_DETECT_COLLISIONS_GROUP_SIZE          %(k_detect_collisions_group_size)d
+#define K_UPDATE_VALUES_GROUP_SIZE              %(k_update_values_group_size)d
+#define K_CHECK_GOAL_REACHABILITY_GROUP_SIZE    %(k_check_goal_reachability_group_size)d
 
 // Maze
 #define MAZE_WIDTH                              %(maze_width)d
 #define MAZE_HEIGHT                             %(maze_height)d
+#define MAZE_SIZE                               (MAZE_WIDTH * MAZE_HEIGHT)
+#define STARTING_NODE                           (int2)(%(starting_node_x)d, %(starting_node_y)d)
+#define GOAL_NODE                               (int2)(%(goal_node_x)d, %(goal_node_y)d)
+
+// Independent instances (mazes and swarms of the same sizes) computed in the same
+// NDRanges. Their index is the last global id, and kernels move their pointers to
+// the memory of the instance first
+#define INSTANCES_N                             %(instances_n)d
 
 // Agent intelligence
 #define NEURON_THRESHOLD                        %(neuron_threshold)d
@@ -15,7 +37,6 @@
 #define WEIGHTS_UNINITIALIZED                   %(weights_uninitialized)d
 #define BOID_ATTRACTANT_DISSOLUTION_COMPONENT   %(boid_attractant_dissolution_component)f
 #define NODE_ATTRACTANT_DISSOLUTION_COMPONENT   %(node_attractant_dissolution_component)f
-#define NODE_MARKER_DISSOLUTION_COMPONENT       %(node_marker_dissolution_component)f
 #define NEURONS_N                               8
 #define READINGS_N                              %(readings_n)d
 #define TRIGRAMS_N                              (%(readings_n)d - 1)
@@ -27,10 +48,27 @@
 
 #define ENTRANCE_ID                             %(entrance_id)d
 #define EXIT_ID                                 %(exit_id)d
+// Readings beyond the borders of the maze
+#define BORDER_ID                               %(border_id)d
+#define NO_BOTTOM_ID                            %(no_bottom_id)d
+// Squares with values from this one on are walls
+#define FIRST_WALL_ID                           %(first_wall_id)d
+
+// Collision detection
+#define TILE_WIDTH                              %(tile_width)d
+#define TILE_HEIGHT                             %(tile_height)d
+#define COLLISION_CHECK_STEP                    %(collision_check_step)f
+#define COLLISION_PRECISION_X                   %(collision_precision_x)f
+#define COLLISION_PRECISION_Y                   %(collision_precision_y)f
+#define TRIANGLES_N                             %(triangles_n)d
 
 // Boids
 #define NUMBER_OF_BOIDS                         %(number_of_boids)d
 #define MINSEPARATION                           %(minseparation)f
+// Neighbour search radius in cells (maze tiles), i.e. ceil(MINSEPARATION)
+#define SEPARATION_CELLS                        %(separation_cells)d
+// End of a cell's boid list
+#define NO_BOID                                 -1
 #define BOIDVELOCITY                            %(boidvelocity)f
 #define TRACTION                                %(traction)f
 #define CENTER                                  %(center)f
@@ -49,6 +87,8 @@
 #define BOID_POS_VAR                            %(boid_pos_var)d
 #define BOID_VEL_VAR                            %(boid_vel_var)d
 #define BOID_PHEROMONE_VAR                      %(boid_pheromone_var)d
+#define BOID_ORIENTATION_OFFSET                 %(boid_orientation_offset)d
+#define BOID_TRIANGLE_OFFSET                    %(boid_triangle_offset)d
 #define ARRDIM                                  %(arrdim)d
 
 #define FLOATN                                  float%(dimensions)d
@@ -56,12 +96,19 @@
 #define VLOADN(p)                               vload%(dimensions)d(0, p)
 #define VSTOREN(data, p)                        vstore%(dimensions)d(data, 0, p)
 
-#define BOID_SIZE                               (ARRDIM * DIMENSIONS + 1)
+#define BOID_SIZE                               (BOID_TRIANGLE_OFFSET + 1)
 #define FLOCK_SIZE(boids)                       ((boids) * BOID_SIZE)
 
 #define INDEX_IN_BOID(var)                      ((var) * DIMENSIONS)
-#define INDEX_IN_FLOCK(boid, var)               (boid * BOID_SIZE + INDEX_IN_BOID(var))
-#define INDEX_IN_ALL_FLOCKS(step, boid, var)    ((step) * NUMBER_OF_BOIDS * BOID_SIZE + INDEX_IN_FLOCK(boid, var))
+#define INDEX_IN_FLOCK(boid, var)               ((boid) * BOID_SIZE + INDEX_IN_BOID(var))
+// Device keeps only the last FLOCK_RING_LENGTH flocks, completed ones are downloaded by the host.
+// A ring slot holds the flocks of all the instances
+#define FLOCK_RING_LENGTH                       %(flock_ring_length)d
+#define INDEX_IN_ALL_FLOCKS(step, boid, var)    (((step) %% FLOCK_RING_LENGTH) * INSTANCES_N * FLOCK_SIZE(NUMBER_OF_BOIDS) + INDEX_IN_FLOCK(boid, var))
+// Rules 1 and 3 sum up positions and velocities of the boids a work group at a time.
+// Sums of the groups are added up by k_agent_ai_and_sim
+#define FLOCK_SUM_GROUPS_N                      ((NUMBER_OF_BOIDS + K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE - 1) / \
+                                                 K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE)
 
 // TODO: pack pairs of programme small uchar values in single ushort values
 #define PROG_SIZE                               %(prog_size)d
@@ -94,17 +141,51 @@
 #define GOAL_EDGE_VERTICAL                      %(goal_edge_vertical)d
 
 /* agents.cl-related macros */
+// Map nodes are packed (see configs.py), sizes and offsets are in bytes
 #define NODE_SIZE                               %(node_size)d
-#define NODE_PHEROMONE_A_VAR                    %(node_pheromone_a_var)d
-#define NODE_PHEROMONE_M_VAR                    %(node_pheromone_m_var)d
-// TODO: combine NODE_IS_EXPLORED_VAR and NODE_IS_DEADEND_VAR booleans
-// into a one uchar variable node_status
-#define NODE_IS_EXPLORED_VAR                    %(node_is_explored_var)d
-#define NODE_IS_DEADEND_VAR                     %(node_is_deadend_var)d
-#define NODE_IS_GOAL_VAR                        %(node_is_goal_var)d
-#define INDEX_IN_MAP(x, y, var)                 (x * MAZE_HEIGHT * NODE_SIZE + y * NODE_SIZE + var)
+#define NODE_PHEROMONE_A_OFFSET                 %(node_pheromone_a_offset)d
+#define NODE_FLAGS_OFFSET                       %(node_flags_offset)d
+#define NODE_MARKERS_OFFSET                     %(node_markers_offset)d
+#define NODE_PHEROMONE_A_ONE                    %(node_pheromone_a_one)d
+#define NODE_IS_EXPLORED_FLAG                   %(node_is_explored_flag)d
+#define NODE_IS_DEADEND_FLAG                    %(node_is_deadend_flag)d
+#define NODE_IS_GOAL_FLAG                       %(node_is_goal_flag)d
+#define NODE_MARKER_STEPS                       %(node_marker_steps)d
+#define INDEX_IN_MAZE(x, y)                     ((x) * MAZE_HEIGHT + (y))
+#define INDEX_IN_MAP(x, y, offset)              (INDEX_IN_MAZE(x, y) * NODE_SIZE + (offset))
+#define MAP_SIZE                                (MAZE_SIZE * NODE_SIZE)
+// Node accessors. Pheromone levels are stored in 16.16 fixed point and read as floats.
+// Every kernel writing the map has a single work item per node, so nothing is atomic
+#define NODE_PHEROMONE_A_FIXED(map, x, y)       (*(__global int*)&(map)[INDEX_IN_MAP(x, y, NODE_PHEROMONE_A_OFFSET)])
+#define NODE_PHEROMONE_A(map, x, y)             ((float)NODE_PHEROMONE_A_FIXED(map, x, y) / NODE_PHEROMONE_A_ONE)
+#define SET_NODE_PHEROMONE_A(map, x, y, level)  (NODE_PHEROMONE_A_FIXED(map, x, y) = convert_int_rte((float)(level) * NODE_PHEROMONE_A_ONE))
+#define NODE_FLAGS(map, x, y)                   ((map)[INDEX_IN_MAP(x, y, NODE_FLAGS_OFFSET)])
+#define NODE_FLAG(map, x, y, flag)              ((NODE_FLAGS(map, x, y) >> (flag)) & 1)
+#define CLEAR_NODE_FLAG(map, x, y, flag)        (NODE_FLAGS(map, x, y) &= ~(1u << (flag)))
+// Markers count the steps left until they dissolve
+#define NODE_MARKER(map, x, y, boid)            (*(__global ushort*)&(map)[INDEX_IN_MAP(x, y, NODE_MARKERS_OFFSET) + (boid) * 2])
+// Lists of changed nodes are kept per step and instance in slots (see k_list_map_changes)
+#define MAP_CHANGE_SLOTS                        %(map_change_slots)d
+// Agents record their updates of the current node, k_apply_node_updates applies them
+// in boid order (see apply_node_updates)
+#define NODE_UPDATE_SIZE                        %(node_update_size)d
+#define NODE_UPDATE_NODE_VAR                    0
+#define NODE_UPDATE_OP_VAR                      1
+#define NODE_UPDATE_LEVEL_VAR                   2
+#define NODE_UPDATE_RAISE_VAR                   3
+#define NODE_UPDATE_FLAGS_VAR                   4
+#define NODE_UPDATE_NONE                        0
+#define NODE_UPDATE_CLEAR                       1
+#define NODE_UPDATE_TRAIL                       2
+#define NODE_UPDATE_CONSUME                     3
 #define DELTA_COOR_X(c, i)                      (c.x + delta_coors[i * 2])
 #define DELTA_COOR_Y(c, i)                      (c.y + delta_coors[i * 2 + 1])
+// Neighbours of border nodes may be outside of the map. They are read as zeros, as in
+// numpy_computations.read_map()
+#define IS_IN_MAP(x, y)                         (INDEX_IN_MAZE(x, y) >= 0 && INDEX_IN_MAZE(x, y) < MAZE_SIZE)
+#define NEIGHBOUR_PHEROMONE_A(map, x, y)        (IS_IN_MAP(x, y) ? NODE_PHEROMONE_A(map, x, y) : 0)
+#define NEIGHBOUR_FLAG(map, x, y, flag)         (IS_IN_MAP(x, y) ? NODE_FLAG(map, x, y, flag) : 0)
+#define NEIGHBOUR_MARKER(map, x, y, boid)       (IS_IN_MAP(x, y) ? NODE_MARKER(map, x, y, boid) : 0)
 #define NORTH                                   0
 #define EAST                                    1
 #define SOUTH                                   2
@@ -112,6 +193,10 @@
 #define TRUE                                    1
 #define MAYBE                                   2
 
+// Multiplications and additions are not fused into fma, so that they are rounded as in
+// the NumPy backend
+#pragma OPENCL FP_CONTRACT OFF
+
 // This is the only place where source code is linked
 // Other .cl files will be including only header files
 #include "utilities.cl"
@@ -128,139 +213,368 @@
 // and then store pointer
 __kernel __attribute__((reqd_work_group_size(1, 1, 1)))
 void
-k_init_memory(__global float* global_map,
+k_init_memory(__global uchar* global_map,
+              __global uchar* global_map_shadow,
               __global float* global_flock_pos_sum,
               __global float* global_flock_vel_sum,
               __global float* global_boid_avoidance_vectors,
               __global ushort* global_agent_programmes,
-              __global uchar* global_cmms) {
+              __global uchar* global_cmms,
+              __global float* global_experiment,
+              __global uchar* global_solved/*[INSTANCES_N]*/) {
     int i;
-    // Clean global memory
-    for (i = 0; i < DIMENSIONS; i++) {
+    // Clean global memory of all the instances
+    for (i = 0; i < INSTANCES_N; i++)
+        global_solved[i] = false;
+    for (i = 0; i < INSTANCES_N * FLOCK_SUM_GROUPS_N * DIMENSIONS; i++) {
         global_flock_pos_sum[i] = 0.0f;
         global_flock_vel_sum[i] = 0.0f;
     }
-    for (i = 0; i < NUMBER_OF_BOIDS * ARRDIM * DIMENSIONS; i++)
+    for (i = 0; i < INSTANCES_N * NUMBER_OF_BOIDS * DIMENSIONS; i++)
         global_boid_avoidance_vectors[i] = 0.0f;
-    for (i = 0; i < MAZE_WIDTH * MAZE_HEIGHT * NODE_SIZE; i++)
+    for (i = 0; i < INSTANCES_N * MAP_SIZE; i++) {
         global_map[i] = 0;
+        global_map_shadow[i] = 0;
+    }
     // Initialize CMM
-    for (i = 0; i < NUMBER_OF_BOIDS * SQUARE_TYPES_N3; i++)
+    for (i = 0; i < INSTANCES_N * NUMBER_OF_BOIDS * SQUARE_TYPES_N3; i++)
         global_cmms[i] = 0xF;
     // Initialize agent programmes
-    for (i = 0; i < NUMBER_OF_BOIDS * PROG_SIZE; i++)
+    for (i = 0; i < INSTANCES_N * NUMBER_OF_BOIDS * PROG_SIZE; i++)
         global_agent_programmes[i] = 0;
+    // Initialize experiment results
+    for (i = 0; i < INSTANCES_N * NUMBER_OF_BOIDS * EXP_SIZE; i++)
+        global_experiment[i] = 0;
 }
 
 
 
-__kernel __attribute__((reqd_work_group_size(1, 1, 1)))
+__kernel __attribute__((reqd_work_group_size(K_UPDATE_MAP_GROUP_SIZE, 1, 1)))
 void
-k_update_map(__global float* global_map,
+k_update_map(__global uchar* global_map/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT][NODE_SIZE]*/,
+             __global uchar* global_solved/*[INSTANCES_N]*/,
              __global float* global_test) {
-    dissolute_pheromones(global_map);
+    // One workitem per node: (x, y, instance)
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int instance = get_global_id(2);
+
+    // We have more workitems than nodes along the x axis
+    if (x >= MAZE_WIDTH || global_solved[instance])
+        return;
+
+    dissolute_pheromones(&global_map[instance * MAP_SIZE], x, y);
+}
+
+
+
+__kernel __attribute__((reqd_work_group_size(K_LIST_MAP_CHANGES_GROUP_SIZE, 1, 1)))
+void
+k_list_map_changes(__global uchar* global_map/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT][NODE_SIZE]*/,
+                   __global uchar* global_map_shadow/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT][NODE_SIZE]*/,
+                   __global uchar* global_solved/*[INSTANCES_N]*/,
+                   __global ushort* global_iteration,
+                   __global int* global_map_changes_n/*[MAP_CHANGE_SLOTS][INSTANCES_N]*/,
+                   __global int* global_changed_nodes/*[MAP_CHANGE_SLOTS][INSTANCES_N][MAZE_SIZE]*/,
+                   __global uchar* global_changed_values/*[MAP_CHANGE_SLOTS][INSTANCES_N][MAZE_SIZE][NODE_SIZE]*/) {
+    // One workitem per node: (x, y, instance)
+    // The shadow is the map as it was listed the last time. Nodes differing from it
+    // are appended to the list of the slot of this iteration and the instance, so
+    // the host only downloads these. The order of the list is arbitrary
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int instance = get_global_id(2);
+    int word, list_i, change_i;
+    boolean is_changed = false;
+
+    // We have more workitems than nodes along the x axis
+    if (x >= MAZE_WIDTH || global_solved[instance])
+        return;
+
+    __global uint* node = (__global uint*)&global_map[instance * MAP_SIZE + INDEX_IN_MAP(x, y, 0)];
+    __global uint* shadow_node = (__global uint*)&global_map_shadow[instance * MAP_SIZE + INDEX_IN_MAP(x, y, 0)];
+
+    // Nodes are compared by (aligned) words, so the host copy stays exact (-0.0f, NaN)
+    for (word = 0; word < NODE_SIZE / 4; word++) {
+        if (node[word] != shadow_node[word]) {
+            is_changed = true;
+            break;
+        }
+    }
+    if (!is_changed)
+        return;
+
+    list_i = (*global_iteration %% MAP_CHANGE_SLOTS) * INSTANCES_N + instance;
+    change_i = list_i * MAZE_SIZE + atomic_inc(&global_map_changes_n[list_i]);
+    global_changed_nodes[change_i] = INDEX_IN_MAZE(x, y);
+    __global uint* changed_node = (__global uint*)&global_changed_values[change_i * NODE_SIZE];
+    for (word = 0; word < NODE_SIZE / 4; word++) {
+        shadow_node[word] = node[word];
+        changed_node[word] = node[word];
+    }
+}
+
+
+
+__kernel __attribute__((reqd_work_group_size(K_CHECK_GOAL_REACHABILITY_GROUP_SIZE, 1, 1)))
+void
+k_check_goal_reachability(__global uchar* global_map/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT][NODE_SIZE]*/,
+                          __global uchar* global_maze/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+                          __global uchar* global_solved/*[INSTANCES_N]*/,
+                          __global ushort* global_iteration,
+                          __global uchar* global_reached_nodes/*[INSTANCES_N][MAZE_SIZE]*/,
+                          __global uchar* global_goal_reached/*[MAP_CHANGE_SLOTS][INSTANCES_N]*/) {
+    // One work group per instance: (local id, instance)
+    // Same test as maze_solver.solve_maze() finding a path: the goal is reachable through
+    // explored passages from the start (both moved along the goal paths of the agents).
+    // Nodes reached from the start are marked in waves, until the goal is reached or a
+    // wave marks nothing new. The result is put into the slot of this iteration, so the
+    // host only downloads a flag per step and instance
+    int local_id = get_local_id(0);
+    int instance = get_global_id(1);
+    int node, x, y;
+    __local int local_start;
+    __local int local_goal;
+    __local boolean local_is_marked;
+
+    // The whole group returns together
+    if (global_solved[instance])
+        return;
+    global_map += instance * MAP_SIZE;
+    global_maze += instance * MAZE_SIZE;
+    global_reached_nodes += instance * MAZE_SIZE;
+
+    if (local_id == 0) {
+        int2 start = follow_goal_path(global_map, STARTING_NODE);
+        int2 goal = follow_goal_path(global_map, GOAL_NODE);
+        local_start = INDEX_IN_MAZE(start.x, start.y);
+        local_goal = INDEX_IN_MAZE(goal.x, goal.y);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (node = local_id; node < MAZE_SIZE; node += K_CHECK_GOAL_REACHABILITY_GROUP_SIZE)
+        global_reached_nodes[node] = node == local_start;
+    barrier(CLK_GLOBAL_MEM_FENCE);
+
+    do {
+        // Everyone has read the flag of the previous wave
+        barrier(CLK_LOCAL_MEM_FENCE);
+        if (local_id == 0)
+            local_is_marked = false;
+        barrier(CLK_LOCAL_MEM_FENCE);
+        // Marks made during the wave are seen by the rest of it, which only speeds it up
+        for (node = local_id; node < MAZE_SIZE; node += K_CHECK_GOAL_REACHABILITY_GROUP_SIZE) {
+            if (global_reached_nodes[node] || !is_node_open(global_maze, global_map, node))
+                continue;
+            x = node / MAZE_HEIGHT;
+            y = node %% MAZE_HEIGHT;
+            if ((y > 0 && global_reached_nodes[node - 1]) ||
+                (x > 0 && global_reached_nodes[node - MAZE_HEIGHT]) ||
+                (x < MAZE_WIDTH - 1 && global_reached_nodes[node + MAZE_HEIGHT]) ||
+                (y < MAZE_HEIGHT - 1 && global_reached_nodes[node + 1])) {
+                global_reached_nodes[node] = true;
+                local_is_marked = true;
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE | CLK_GLOBAL_MEM_FENCE);
+    } while (local_is_marked && !global_reached_nodes[local_goal]);
+
+    if (local_id == 0)
+        global_goal_reached[(*global_iteration %% MAP_CHANGE_SLOTS) * INSTANCES_N + instance] =
+            global_reached_nodes[local_goal];
 }
 
 
 
-__kernel __attribute__((reqd_work_group_size(PREFERRED_WORK_GROUP_SIZE_MULTIPLE, 1, 1)))
+__kernel __attribute__((reqd_work_group_size(K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE, 1, 1)))
 void
-k_agent_reynolds_rules13_preprocess(__global float* global_generated_flocks/*[TOTAL_TIMESTEPS][NUMBER_OF_BOIDS][ARRDIM]*/,
+k_agent_reynolds_rules13_preprocess(__global float* global_generated_flocks/*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/,
+                                    __global uchar* global_solved/*[INSTANCES_N]*/,
                                     __global ushort* global_iteration,
-                                    __global float* global_flock_pos_sum,
-                                    __local float* local_flock_pos_sum,
-                                    __global float* global_flock_vel_sum,
-                                    __local float* local_flock_vel_sum,
+                                    __global float* global_flock_pos_sum/*[INSTANCES_N][FLOCK_SUM_GROUPS_N][DIMENSIONS]*/,
+                                    __global float* global_flock_vel_sum/*[INSTANCES_N][FLOCK_SUM_GROUPS_N][DIMENSIONS]*/,
                                     __global float* global_test) {
 
     /*--------- Prepare memory and filter out surplus workitems ---------------*/
 
-    float previous_position[DIMENSIONS];
-    float previous_velocity[DIMENSIONS];
+    __local float local_positions[K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE * DIMENSIONS];
+    __local float local_velocities[K_AGENT_REYNOLDS_RULES13_PREPROCESS_GROUP_SIZE * DIMENSIONS];
     int global_id = get_global_id(0);
     int local_id = get_local_id(0);
-    int i;
+    int instance = get_global_id(1);
 
-    // We have more workitems than boids
-    if (global_id >= NUMBER_OF_BOIDS)
+    // Groups don't span instances, so all workitems of a group leave together
+    if (global_solved[instance])
         return;
+    global_generated_flocks += instance * FLOCK_SIZE(NUMBER_OF_BOIDS);
+    global_flock_pos_sum += instance * FLOCK_SUM_GROUPS_N * DIMENSIONS;
+    global_flock_vel_sum += instance * FLOCK_SUM_GROUPS_N * DIMENSIONS;
 
-    /* PER WORKGROUP */
-    /* Clean local memory */
-    if (local_id == 0)
-        for (i = 0; i < DIMENSIONS; i++) {
-            local_flock_pos_sum[i] = 0.0f;
-            local_flock_vel_sum[i] = 0.0f;
-        }
+    /* Entry fetch (global -> local) */
+    // We have more workitems than boids. Surplus workitems add zeros, they cannot
+    // return straight away as all workitems of a group must reach the barriers
+    if (global_id < NUMBER_OF_BOIDS) {
+        VSTOREN(VLOADN(&global_generated_flocks[INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), global_id, BOID_POS_VAR)]),
+                &local_positions[local_id * DIMENSIONS]);
+        VSTOREN(VLOADN(&global_generated_flocks[INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), global_id, BOID_VEL_VAR)]),
+                &local_velocities[local_id * DIMENSIONS]);
+    }
+    else {
+        VSTOREN((FLOATN)0, &local_positions[local_id * DIMENSIONS]);
+        VSTOREN((FLOATN)0, &local_velocities[local_id * DIMENSIONS]);
+    }
     barrier(CLK_LOCAL_MEM_FENCE);
 
-    // Fetch agent's previous position
-    fetch_global(&global_generated_flocks[INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), global_id, BOID_POS_VAR)],
-                 previous_position, DIMENSIONS);
-    // Fetch agent's previous velocity
-    fetch_global(&global_generated_flocks[INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), global_id, BOID_VEL_VAR)],
-                 previous_velocity, DIMENSIONS);
-
     /*---------           Compute outputs           ---------------*/
 
-    agent_reynolds_rules13_preprocess(local_flock_pos_sum,
-                                      local_flock_vel_sum,
-                                      previous_position,
-                                      previous_velocity);
+    agent_reynolds_rules13_preprocess(local_positions,
+                                      local_velocities,
+                                      local_id);
 
     /*---------            Save outputs            ---------------*/
 
     /* PER WORKGROUP */
-    // Exit fetch (local -> global) 
-    barrier(CLK_LOCAL_MEM_FENCE);
-    // Doesn't matter which work item will do it, but it must be unique within workgroup
-    if (local_id == get_local_size(0) - 1) {
-        float vector[DIMENSIONS];
-        // Add partial sum up to the full sum in global memory
-        fetch_local(local_flock_pos_sum, vector, DIMENSIONS);
-        atomic_add_global_arr(global_flock_pos_sum, vector);
-        // Add partial sum up to the full sum in global memory
-        fetch_local(local_flock_vel_sum, vector, DIMENSIONS);
-        atomic_add_global_arr(global_flock_vel_sum, vector);
+    // Exit fetch (local -> global). Each group has a slot of its own, so there is
+    // no need for atomics
+    if (local_id == 0) {
+        VSTOREN(VLOADN(local_positions), &global_flock_pos_sum[get_group_id(0) * DIMENSIONS]);
+        VSTOREN(VLOADN(local_velocities), &global_flock_vel_sum[get_group_id(0) * DIMENSIONS]);
+    }
+}
+
+
+
+__kernel __attribute__((reqd_work_group_size(K_CLEAR_CELLS_GROUP_SIZE, 1, 1)))
+void
+k_clear_cells(__global int* global_cell_heads/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+              __global uchar* global_solved/*[INSTANCES_N]*/) {
+    // One workitem per cell: (x, y, instance)
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int instance = get_global_id(2);
+
+    // We have more workitems than cells along the x axis
+    if (x >= MAZE_WIDTH || global_solved[instance])
+        return;
+
+    global_cell_heads[instance * MAZE_SIZE + INDEX_IN_MAZE(x, y)] = NO_BOID;
+}
+
+
+
+__kernel __attribute__((reqd_work_group_size(K_BIN_BOIDS_GROUP_SIZE, 1, 1)))
+void
+k_bin_boids(__global float* global_generated_flocks/*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/,
+            __global uchar* global_solved/*[INSTANCES_N]*/,
+            __global ushort* global_iteration,
+            __global int* global_cell_heads/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+            __global int* global_boid_next/*[INSTANCES_N][NUMBER_OF_BOIDS]*/) {
+    // Puts boids into the linked lists of their cells
+    int global_id = get_global_id(0);
+    int instance = get_global_id(1);
+    int cell_x, cell_y;
+
+    // We have more workitems than boids
+    if (global_id >= NUMBER_OF_BOIDS || global_solved[instance])
+        return;
+    global_generated_flocks += instance * FLOCK_SIZE(NUMBER_OF_BOIDS);
+    global_cell_heads += instance * MAZE_SIZE;
+    global_boid_next += instance * NUMBER_OF_BOIDS;
+
+    global_boid_next[global_id] = atomic_xchg(
+        &global_cell_heads[get_cell_index(&global_generated_flocks[
+                                              INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), 0, 0)],
+                                          global_id, &cell_x, &cell_y)],
+        global_id);
+}
+
+
+
+__kernel __attribute__((reqd_work_group_size(K_SORT_CELLS_GROUP_SIZE, 1, 1)))
+void
+k_sort_cells(__global uchar* global_solved/*[INSTANCES_N]*/,
+             __global int* global_cell_heads/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+             __global int* global_boid_next/*[INSTANCES_N][NUMBER_OF_BOIDS]*/) {
+    // Sorts the linked list of each cell by boid index. k_bin_boids links the boids
+    // in the order of its atomics, and the avoidance vectors are summed in list order
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int instance = get_global_id(2);
+    int boid_id, next_boid_id, previous_boid_id;
+    int sorted_head = NO_BOID;
+
+    // We have more workitems than cells along the x axis
+    if (x >= MAZE_WIDTH || global_solved[instance])
+        return;
+    global_cell_heads += instance * MAZE_SIZE + INDEX_IN_MAZE(x, y);
+    global_boid_next += instance * NUMBER_OF_BOIDS;
+
+    // Insertion sort, as cells hold few boids
+    for (boid_id = *global_cell_heads; boid_id != NO_BOID; boid_id = next_boid_id) {
+        next_boid_id = global_boid_next[boid_id];
+        if (sorted_head == NO_BOID || boid_id < sorted_head) {
+            global_boid_next[boid_id] = sorted_head;
+            sorted_head = boid_id;
+            continue;
+        }
+        previous_boid_id = sorted_head;
+        while (global_boid_next[previous_boid_id] != NO_BOID &&
+               global_boid_next[previous_boid_id] < boid_id)
+            previous_boid_id = global_boid_next[previous_boid_id];
+        global_boid_next[boid_id] = global_boid_next[previous_boid_id];
+        global_boid_next[previous_boid_id] = boid_id;
     }
+    *global_cell_heads = sorted_head;
 }
 
 
 
-__kernel __attribute__((reqd_work_group_size(MAX_WORK_GROUP_SIZE, 1, 1)))
+__kernel __attribute__((reqd_work_group_size(K_AGENT_REYNOLDS_RULE2_PREPROCESS_GROUP_SIZE, 1, 1)))
 void
-k_agent_reynolds_rule2_preprocess(__global float* global_generated_flocks, /*[TOTAL_TIMESTEPS][NUMBER_OF_BOIDS][ARRDIM]*/
+k_agent_reynolds_rule2_preprocess(__global float* global_generated_flocks, /*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/
+                                  __global uchar* global_solved/*[INSTANCES_N]*/,
                                   __global ushort* global_iteration,
+                                  __global int* global_cell_heads/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+                                  __global int* global_boid_next/*[INSTANCES_N][NUMBER_OF_BOIDS]*/,
                                   __global float* global_boid_avoidance_vectors) {
 
     /*--------- Prepare memory and filter out surplus workitems ---------------*/
 
-    int global_id           = get_global_id(0);
-    int local_id            = get_local_id(0);
-    int main_boid_id        = trunc((float)global_id / (float)NUMBER_OF_BOIDS);;
-    int compared_boid_id    = fmod((float)global_id, NUMBER_OF_BOIDS);
+    int global_id = get_global_id(0);
+    int instance = get_global_id(1);
+    FLOATN avoidance_vector;
 
     // We have more workitems than boids
-    if (main_boid_id >= NUMBER_OF_BOIDS)
+    if (global_id >= NUMBER_OF_BOIDS || global_solved[instance])
         return;
+    global_generated_flocks += instance * FLOCK_SIZE(NUMBER_OF_BOIDS);
+    global_cell_heads += instance * MAZE_SIZE;
+    global_boid_next += instance * NUMBER_OF_BOIDS;
+    global_boid_avoidance_vectors += instance * NUMBER_OF_BOIDS * DIMENSIONS;
 
     /*---------           Compute outputs           ---------------*/
 
     agent_reynolds_rule2_preprocess(&global_generated_flocks[
                                       INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), 0, 0)],
-                                    global_boid_avoidance_vectors,
-                                    main_boid_id,
-                                    compared_boid_id);
+                                    global_cell_heads,
+                                    global_boid_next,
+                                    global_id,
+                                    &avoidance_vector);
+
+    /*---------            Save outputs            ---------------*/
+
+    // Each boid writes only its own vector, so there is no need for atomics
+    VSTOREN(avoidance_vector, &global_boid_avoidance_vectors[INDEX_IN_BOID(global_id)]);
 }
 
 
 
-__kernel __attribute__((reqd_work_group_size(PREFERRED_WORK_GROUP_SIZE_MULTIPLE, 1, 1)))
+__kernel __attribute__((reqd_work_group_size(K_AGENT_AI_AND_SIM_GROUP_SIZE, 1, 1)))
 void
-k_agent_ai_and_sim(__global float* global_generated_flocks, /*[TOTAL_TIMESTEPS][NUMBER_OF_BOIDS][ARRDIM]*/
-                  __global float* global_map,
+k_agent_ai_and_sim(__global float* global_generated_flocks, /*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/
+                  __global uchar* global_solved/*[INSTANCES_N]*/,
+                  __global uchar* global_map,
                   __global uchar* global_cmms,
-                  __global uchar* global_sensor_readings,
+                  __global uchar* global_maze/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
                   __global float* global_flock_pos_sum,
                   __local float* local_flock_pos_sum,
                   __global float* global_flock_vel_sum,
@@ -269,33 +583,45 @@ k_agent_ai_and_sim(__global float* global_generated_flocks, /*[TOTAL_TIMESTEPS][
                   __local ushort* local_iteration,
                   __global float* global_boid_avoidance_vectors,
                   __global ushort* global_agent_programmes,
-                  __global float* global_random,
+                  __global int* global_node_updates/*[INSTANCES_N][NUMBER_OF_BOIDS][NODE_UPDATE_SIZE]*/,
+                  uint random_key,
                   __global float* global_experiment,
                   __global float* global_test) {
 
     /*--------- Prepare memory and filter out surplus workitems ---------------*/
 
-    __global float* global_previous_flock;
-    __global float* global_new_flock;
     __global float* global_test_subarr;
     int global_id = get_global_id(0);
     int local_id = get_local_id(0);
-    FLOATN impulse;
-    FLOATN velocity;
-    uchar sensor_readings[READINGS_N];
+    int instance = get_global_id(1);
     int i;
 
-    // We have more workitems than boids
-    if (global_id >= NUMBER_OF_BOIDS)
+    // Groups don't span instances, so all workitems of a group leave together
+    if (global_solved[instance])
         return;
+    global_generated_flocks += instance * FLOCK_SIZE(NUMBER_OF_BOIDS);
+    global_map += instance * MAP_SIZE;
+    global_cmms += instance * NUMBER_OF_BOIDS * SQUARE_TYPES_N3;
+    global_maze += instance * MAZE_SIZE;
+    global_flock_pos_sum += instance * FLOCK_SUM_GROUPS_N * DIMENSIONS;
+    global_flock_vel_sum += instance * FLOCK_SUM_GROUPS_N * DIMENSIONS;
+    global_boid_avoidance_vectors += instance * NUMBER_OF_BOIDS * DIMENSIONS;
+    global_agent_programmes += instance * NUMBER_OF_BOIDS * PROG_SIZE;
+    global_node_updates += instance * NUMBER_OF_BOIDS * NODE_UPDATE_SIZE;
+    global_experiment += instance * NUMBER_OF_BOIDS * EXP_SIZE;
 
     /* PER WORKGROUP */
     /* Entry fetch (global -> local) */
     if (local_id == 0) {
-        for (i = 0; i < DIMENSIONS; i++) {
-            local_flock_pos_sum[i] = global_flock_pos_sum[i];
-            local_flock_vel_sum[i] = global_flock_vel_sum[i];
+        // Sums of the groups of rules 1 and 3 are added up in the same order every time
+        FLOATN flock_pos_sum = 0;
+        FLOATN flock_vel_sum = 0;
+        for (i = 0; i < FLOCK_SUM_GROUPS_N; i++) {
+            flock_pos_sum += VLOADN(&global_flock_pos_sum[i * DIMENSIONS]);
+            flock_vel_sum += VLOADN(&global_flock_vel_sum[i * DIMENSIONS]);
         }
+        VSTOREN(flock_pos_sum, local_flock_pos_sum);
+        VSTOREN(flock_vel_sum, local_flock_vel_sum);
 
         *local_iteration = *global_iteration;
     }
@@ -305,59 +631,203 @@ k_agent_ai_and_sim(__global float* global_generated_flocks, /*[TOTAL_TIMESTEPS][
         global_test_subarr = global_test + 10;
     barrier(CLK_LOCAL_MEM_FENCE);
 
-    /* Entry fetch (global -> private) */
-    for (i = 0; i < READINGS_N; i++)
-        sensor_readings[i] = global_sensor_readings[READINGS_N * global_id + i];
+    // We have more workitems than boids. Only now, after the barrier,
+    // surplus workitems can leave
+    if (global_id >= NUMBER_OF_BOIDS)
+        return;
+
+    /*---------    Compute and save outputs        ---------------*/
+
+    simulate_agent_step(&global_generated_flocks[INDEX_IN_ALL_FLOCKS(*local_iteration - 1, 0, 0)],
+                        &global_generated_flocks[INDEX_IN_ALL_FLOCKS(*local_iteration, 0, 0)],
+                        global_map,
+                        global_cmms,
+                        global_maze,
+                        local_flock_pos_sum,
+                        local_flock_vel_sum,
+                        local_iteration,
+                        VLOADN(&global_boid_avoidance_vectors[INDEX_IN_BOID(global_id)]),
+                        global_agent_programmes,
+                        global_node_updates,
+                        random_key,
+                        instance,
+                        global_id,
+                        global_experiment,
+                        global_test_subarr);
+}
 
-    /* Select previous data out of the whole dataset */
-    global_previous_flock = &global_generated_flocks[
-        INDEX_IN_ALL_FLOCKS(*local_iteration - 1, 0, 0)];
 
-    /* Select current data out of the whole dataset */
-    global_new_flock = &global_generated_flocks[
-        INDEX_IN_ALL_FLOCKS(*local_iteration, 0, 0)];
+
+// Rules 1, 2 and 3 and k_agent_ai_and_sim in a single kernel (see cfg.fused_agent_step).
+// Each group goes through the previous flock a tile (a position and a velocity per work
+// item) at a time in local memory. Every boid compares itself with all the boids of a
+// tile and work item 0 adds them up to the flock sums. The sums and the avoidance vectors
+// need no global memory and the additions always go in the order of the boids
+__kernel __attribute__((reqd_work_group_size(K_AGENT_STEP_FUSED_GROUP_SIZE, 1, 1)))
+void
+k_agent_step_fused(__global float* global_generated_flocks, /*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/
+                   __global uchar* global_solved/*[INSTANCES_N]*/,
+                   __global uchar* global_map,
+                   __global uchar* global_cmms,
+                   __global uchar* global_maze/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+                   __global ushort* global_iteration,
+                   __global ushort* global_agent_programmes,
+                   __global int* global_node_updates/*[INSTANCES_N][NUMBER_OF_BOIDS][NODE_UPDATE_SIZE]*/,
+                   uint random_key,
+                   __global float* global_experiment,
+                   __global float* global_test) {
+
+    /*--------- Prepare memory and filter out surplus workitems ---------------*/
+
+    __local float local_positions[K_AGENT_STEP_FUSED_GROUP_SIZE * DIMENSIONS];
+    __local float local_velocities[K_AGENT_STEP_FUSED_GROUP_SIZE * DIMENSIONS];
+    __local float local_flock_pos_sum[DIMENSIONS];
+    __local float local_flock_vel_sum[DIMENSIONS];
+    __local ushort local_iteration;
+    __global float* global_previous_flock;
+    int global_id = get_global_id(0);
+    int local_id = get_local_id(0);
+    int instance = get_global_id(1);
+    int tile_start, tile_size, i;
+    float adistance;
+    FLOATN difference;
+    FLOATN position = 0;
+    FLOATN avoidance_vector = 0;
+    FLOATN flock_pos_sum = 0;
+    FLOATN flock_vel_sum = 0;
+
+    // Groups don't span instances, so all workitems of a group leave together
+    if (global_solved[instance])
+        return;
+    global_generated_flocks += instance * FLOCK_SIZE(NUMBER_OF_BOIDS);
+    global_map += instance * MAP_SIZE;
+    global_cmms += instance * NUMBER_OF_BOIDS * SQUARE_TYPES_N3;
+    global_maze += instance * MAZE_SIZE;
+    global_agent_programmes += instance * NUMBER_OF_BOIDS * PROG_SIZE;
+    global_node_updates += instance * NUMBER_OF_BOIDS * NODE_UPDATE_SIZE;
+    global_experiment += instance * NUMBER_OF_BOIDS * EXP_SIZE;
+
+    if (local_id == 0)
+        local_iteration = *global_iteration;
+    global_previous_flock = &global_generated_flocks[
+        INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), 0, 0)];
+    if (global_id < NUMBER_OF_BOIDS)
+        position = VLOADN(&global_previous_flock[INDEX_IN_FLOCK(global_id, BOID_POS_VAR)]);
 
     /*---------           Compute outputs           ---------------*/
 
-    agent_ai(global_map,
-             &global_cmms[global_id * SQUARE_TYPES_N3],
-             global_boid_avoidance_vectors,
-             local_flock_pos_sum,
-             local_flock_vel_sum,
-             global_previous_flock,
-             global_new_flock,
-             &global_agent_programmes[INDEX_IN_PROGS(global_id)],
-             sensor_readings,
-             global_id,
-             &impulse,
-             global_random,
-             local_iteration,
-             &global_experiment[INDEX_IN_EXP(global_id)],
-             global_test_subarr);
-
-    simulate_locomotion(global_previous_flock,                  
-                        local_iteration,
-                        impulse,
+    // Surplus workitems load the tiles with the others, they cannot return straight
+    // away as all workitems of a group must reach the barriers
+    for (tile_start = 0; tile_start < NUMBER_OF_BOIDS; tile_start += K_AGENT_STEP_FUSED_GROUP_SIZE) {
+        /* Entry fetch (global -> local) */
+        tile_size = min(K_AGENT_STEP_FUSED_GROUP_SIZE, NUMBER_OF_BOIDS - tile_start);
+        if (local_id < tile_size) {
+            VSTOREN(VLOADN(&global_previous_flock[INDEX_IN_FLOCK(tile_start + local_id, BOID_POS_VAR)]),
+                    &local_positions[local_id * DIMENSIONS]);
+            VSTOREN(VLOADN(&global_previous_flock[INDEX_IN_FLOCK(tile_start + local_id, BOID_VEL_VAR)]),
+                    &local_velocities[local_id * DIMENSIONS]);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        // Reynold's rules 1 and 3. Cohesion and alignment
+        if (local_id == 0)
+            for (i = 0; i < tile_size; i++) {
+                flock_pos_sum += VLOADN(&local_positions[i * DIMENSIONS]);
+                flock_vel_sum += VLOADN(&local_velocities[i * DIMENSIONS]);
+            }
+        // Reynold's rule 2. Separation - steer to avoid crowding local flockmates
+        if (global_id < NUMBER_OF_BOIDS)
+            for (i = 0; i < tile_size; i++) {
+                difference = VLOADN(&local_positions[i * DIMENSIONS]) - position;
+                adistance = length(difference);
+                if (adistance > 0 && adistance < MINSEPARATION)
+                    avoidance_vector += difference;
+            }
+        // The tile is overwritten by the next one only after everyone is done with it
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+
+    /* PER WORKGROUP */
+    if (local_id == 0) {
+        VSTOREN(flock_pos_sum, local_flock_pos_sum);
+        VSTOREN(flock_vel_sum, local_flock_vel_sum);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Only now, after the barriers, surplus workitems can leave
+    if (global_id >= NUMBER_OF_BOIDS)
+        return;
+
+    /*---------    Compute and save outputs        ---------------*/
+
+    simulate_agent_step(global_previous_flock,
+                        &global_generated_flocks[INDEX_IN_ALL_FLOCKS(local_iteration, 0, 0)],
+                        global_map,
+                        global_cmms,
+                        global_maze,
+                        local_flock_pos_sum,
+                        local_flock_vel_sum,
+                        &local_iteration,
+                        avoidance_vector,
+                        global_agent_programmes,
+                        global_node_updates,
+                        random_key,
+                        instance,
                         global_id,
-                        &velocity);
+                        global_experiment,
+                        global_test);
+}
 
-    /*---------            Save outputs            ---------------*/
 
-    // Move boids
-    VSTOREN(
-        VLOADN(&global_previous_flock[INDEX_IN_FLOCK(global_id, BOID_POS_VAR)]) + velocity,
-            &global_new_flock[INDEX_IN_FLOCK(global_id, BOID_POS_VAR)]);
 
-    // Update velocity
-    VSTOREN(velocity, 
-        &global_new_flock[INDEX_IN_FLOCK(global_id, BOID_VEL_VAR)]);
+__kernel __attribute__((reqd_work_group_size(K_APPLY_NODE_UPDATES_GROUP_SIZE, 1, 1)))
+void
+k_apply_node_updates(__global uchar* global_map/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT][NODE_SIZE]*/,
+                     __global uchar* global_solved/*[INSTANCES_N]*/,
+                     __global int* global_node_updates/*[INSTANCES_N][NUMBER_OF_BOIDS][NODE_UPDATE_SIZE]*/) {
+    // One workitem per node: (x, y, instance)
+    int x = get_global_id(0);
+    int y = get_global_id(1);
+    int instance = get_global_id(2);
+
+    // We have more workitems than nodes along the x axis
+    if (x >= MAZE_WIDTH || global_solved[instance])
+        return;
+
+    apply_node_updates(&global_map[instance * MAP_SIZE],
+                       &global_node_updates[instance * NUMBER_OF_BOIDS * NODE_UPDATE_SIZE],
+                       x, y);
+}
+
+
+
+__kernel __attribute__((reqd_work_group_size(K_DETECT_COLLISIONS_GROUP_SIZE, 1, 1)))
+void
+k_detect_collisions(__global float* global_generated_flocks/*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/,
+                    __global uchar* global_solved/*[INSTANCES_N]*/,
+                    __global uchar* global_maze/*[INSTANCES_N][MAZE_WIDTH][MAZE_HEIGHT]*/,
+                    __global float* global_triangle_rects/*[TRIANGLES_N][4]*/,
+                    __global ushort* global_iteration) {
+    int global_id = get_global_id(0);
+    int instance = get_global_id(1);
+
+    // We have more workitems than boids
+    if (global_id >= NUMBER_OF_BOIDS || global_solved[instance])
+        return;
+    global_generated_flocks += instance * FLOCK_SIZE(NUMBER_OF_BOIDS);
+    global_maze += instance * MAZE_SIZE;
+
+    detect_collisions(global_maze,
+                      global_triangle_rects,
+                      &global_generated_flocks[INDEX_IN_ALL_FLOCKS((int)(*global_iteration - 1), global_id, 0)],
+                      &global_generated_flocks[INDEX_IN_ALL_FLOCKS(*global_iteration, global_id, 0)]);
 }
 
 
 
-__kernel __attribute__((reqd_work_group_size(PREFERRED_WORK_GROUP_SIZE_MULTIPLE, 1, 1)))
+__kernel __attribute__((reqd_work_group_size(K_UPDATE_VALUES_GROUP_SIZE, 1, 1)))
 void
-k_update_values(__global float* global_generated_flocks/*[TOTAL_TIMESTEPS][NUMBER_OF_BOIDS][ARRDIM]*/,
+k_update_values(__global float* global_generated_flocks/*[FLOCK_RING_LENGTH][INSTANCES_N][NUMBER_OF_BOIDS][ARRDIM]*/,
                 __global ushort* global_amendments_n,
                 __global ushort* global_amendment_indices/*[amendments_n]*/,
                 __local ushort* local_amendment_indices/*[amendments_n]*/,
@@ -373,12 +843,11 @@ k_update_values(__global float* global_generated_flocks/*[TOTAL_TIMESTEPS][NUMBE
 
     global_id = get_global_id(0);
     local_id = get_local_id(0);
-
-    // We probably have more workitems than amendments
-    if (global_id >= *global_amendments_n)
-        return;
+    // Amendments are computed by the host for one instance at a time
+    global_generated_flocks += get_global_id(1) * FLOCK_SIZE(NUMBER_OF_BOIDS);
 
     /* Entry fetch (global -> local) */
+    // The first workitem of a group always has an amendment
     if (local_id == 0) {
         int limit;
         if (global_id + get_local_size(0) < *global_amendments_n)
@@ -393,15 +862,14 @@ k_update_values(__global float* global_generated_flocks/*[TOTAL_TIMESTEPS][NUMBE
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
+    // We probably have more workitems than amendments
+    if (global_id >= *global_amendments_n)
+        return;
+
     /*---------            Save outputs            ---------------*/
     
     for (i = 0; i < DIMENSIONS; i++)
         global_generated_flocks[
         INDEX_IN_ALL_FLOCKS(*global_iteration, local_amendment_indices[global_id], BOID_POS_VAR) + i] = 
             local_amendment_values[INDEX_IN_BOID(global_id) + i];
-
-    /* Exit clean up (global) */
-    barrier(CLK_GLOBAL_MEM_FENCE);
-    if (global_id == 0)
-        *global_amendments_n = 0;
 }
@@ -1,33 +1,30 @@
 #include "utilities.h"
 
 void
-dissolute_pheromones(__global float* global_map) {
-    int x, y, boid_id;
+dissolute_pheromones(__global uchar* global_map, int x, int y) {
+    // Processes a single node
+    int boid_id;
     boolean is_node_outdated;
-    for (x = 0; x < MAZE_WIDTH; x++)
-        for (y = 0; y < MAZE_HEIGHT; y++) {
-            if (global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_A_VAR)] > NODE_ATTRACTANT_DISSOLUTION_COMPONENT)
-                global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_A_VAR)] -= NODE_ATTRACTANT_DISSOLUTION_COMPONENT;
-            else
-                global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_A_VAR)] = 0;
-            for (boid_id = 0; boid_id < NUMBER_OF_BOIDS; boid_id++) {
-                if (global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_M_VAR) + boid_id] > NODE_MARKER_DISSOLUTION_COMPONENT)
-                    global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_M_VAR) + boid_id] -= NODE_MARKER_DISSOLUTION_COMPONENT;
-                else
-                    global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_M_VAR) + boid_id] = 0;
-            }
-            if (global_map[ INDEX_IN_MAP(x, y, NODE_IS_DEADEND_VAR )] == false) {                
-                is_node_outdated = true;
-                for (boid_id = 0; boid_id < NUMBER_OF_BOIDS; boid_id++) {
-                    if (global_map[INDEX_IN_MAP(x, y, NODE_PHEROMONE_M_VAR) + boid_id] > 0) {
-                        is_node_outdated = false;
-                        break;
-                    }
-                }
-                if (is_node_outdated == true)
-                    global_map[INDEX_IN_MAP(x, y, NODE_IS_EXPLORED_VAR)] = false;
+    float pheromone_level = NODE_PHEROMONE_A(global_map, x, y);
+    if (pheromone_level > NODE_ATTRACTANT_DISSOLUTION_COMPONENT)
+        SET_NODE_PHEROMONE_A(global_map, x, y, pheromone_level - NODE_ATTRACTANT_DISSOLUTION_COMPONENT);
+    else
+        SET_NODE_PHEROMONE_A(global_map, x, y, 0);
+    for (boid_id = 0; boid_id < NUMBER_OF_BOIDS; boid_id++) {
+        if (NODE_MARKER(global_map, x, y, boid_id) > 0)
+            NODE_MARKER(global_map, x, y, boid_id) -= 1;
+    }
+    if (NODE_FLAG(global_map, x, y, NODE_IS_DEADEND_FLAG) == false) {
+        is_node_outdated = true;
+        for (boid_id = 0; boid_id < NUMBER_OF_BOIDS; boid_id++) {
+            if (NODE_MARKER(global_map, x, y, boid_id) > 0) {
+                is_node_outdated = false;
+                break;
             }
         }
+        if (is_node_outdated == true)
+            CLEAR_NODE_FLAG(global_map, x, y, NODE_IS_EXPLORED_FLAG);
+    }
 }
 
 
@@ -54,4 +51,457 @@ simulate_locomotion(__global float* global_previous_flock,/*[NUMBER_OF_BOIDS][AR
     if (global_previous_flock[INDEX_IN_FLOCK(global_id, BOID_POS_VAR) + 1] + (*velocity).y > MAZE_HEIGHT ||
         global_previous_flock[INDEX_IN_FLOCK(global_id, BOID_POS_VAR) + 1] + (*velocity).y < 0)
         (*velocity).y = 0;
-}
\ No newline at end of file
+}
+
+
+FLOATN
+zero_non_finite(FLOATN values) {
+    return select((FLOATN)0, values, isfinite(values));
+}
+
+
+float
+get_orientation(FLOATN velocity, float previous_orientation) {
+    // Direction of the velocity in [0, 2 pi). A boid standing still keeps its orientation
+    float orientation;
+    if (velocity.x == 0 && velocity.y == 0)
+        return previous_orientation;
+    orientation = atan2(velocity.y, velocity.x);
+    if (orientation < 0)
+        orientation += 2 * M_PI_F;
+    return orientation;
+}
+
+
+int
+get_triangle_index(float orientation) {
+    // Template triangles are rendered for whole degrees, see renderer.render_template_triangles()
+    return min((int)rint(degrees(orientation)), TRIANGLES_N - 1);
+}
+
+
+void
+read_sensors(__global uchar* global_maze,
+             __global float* global_boid,
+             uchar* sensor_readings) {
+    // Same as maze.get_neighboring_tiles() of the boid position.
+    // Borders of the maze are read as walls
+    int x = (int)global_boid[INDEX_IN_BOID(BOID_POS_VAR)];
+    int y = (int)global_boid[INDEX_IN_BOID(BOID_POS_VAR) + 1];
+    boolean is_inside = x >= 0 && x < MAZE_WIDTH && y >= 0 && y < MAZE_HEIGHT;
+
+    sensor_readings[READING_NORTH] = (is_inside && y - 1 >= 0 ?
+                                      global_maze[INDEX_IN_MAZE(x, y - 1)] : BORDER_ID);
+    sensor_readings[READING_EAST] = (is_inside && x + 1 < MAZE_WIDTH ?
+                                     global_maze[INDEX_IN_MAZE(x + 1, y)] : BORDER_ID);
+    sensor_readings[READING_SOUTH] = (is_inside && y + 1 < MAZE_HEIGHT ?
+                                      global_maze[INDEX_IN_MAZE(x, y + 1)] : BORDER_ID);
+    sensor_readings[READING_WEST] = (is_inside && x - 1 >= 0 ?
+                                     global_maze[INDEX_IN_MAZE(x - 1, y)] : BORDER_ID);
+    sensor_readings[READING_BOTTOM] = (is_inside ?
+                                       global_maze[INDEX_IN_MAZE(x, y)] : NO_BOTTOM_ID);
+}
+
+
+
+boolean
+is_wall(__global uchar* global_maze, int x, int y) {
+    // Tiles outside of the maze are not walls, as in maze.get_neighboring_tiles()
+    return x >= 0 && x < MAZE_WIDTH && y >= 0 && y < MAZE_HEIGHT &&
+           global_maze[INDEX_IN_MAZE(x, y)] >= FIRST_WALL_ID;
+}
+
+
+void
+get_diagonal_collision_type(int wall_x,
+                            int wall_y,
+                            int boid_x,
+                            int boid_y,
+                            int4 triangle_rect,
+                            int* diagonal_side,
+                            int* diagonal_edge) {
+    // Same as collision_detection.get_diagonal_collision_type(). Results which
+    // are a single location are kept too - they override the previous ones
+    int side, edge;
+    int wall_left = wall_x * TILE_WIDTH;
+    int wall_top = wall_y * TILE_HEIGHT;
+    int wall_right = (wall_x + 1) * TILE_WIDTH;
+    boolean is_wall_above, is_wall_below;
+
+    if (wall_x == boid_x - 1)
+        side = WEST;
+    else if (wall_x == boid_x + 1)
+        side = EAST;
+    else
+        return;
+    edge = (wall_y == boid_y - 1 ? NORTH : SOUTH);
+
+    is_wall_above = edge == NORTH && triangle_rect.s1 >= wall_top - COLLISION_PRECISION_Y;
+    is_wall_below = edge == SOUTH && triangle_rect.s3 <= wall_top + COLLISION_PRECISION_Y;
+
+    if (side == EAST) {
+        if (triangle_rect.s2 <= wall_left + COLLISION_PRECISION_X) {
+            // Boid is at least on the left edge of the wall
+            *diagonal_side = EAST;
+            *diagonal_edge = (is_wall_above || is_wall_below ? edge : -1);
+            return;
+        }
+    }
+    else if (triangle_rect.s0 >= wall_right - COLLISION_PRECISION_X &&
+             (is_wall_above || is_wall_below)) {
+        // Boid is on the corner of the wall
+        *diagonal_side = WEST;
+        *diagonal_edge = edge;
+        return;
+    }
+    if (is_wall_above || is_wall_below) {
+        *diagonal_side = -1;
+        *diagonal_edge = edge;
+    }
+}
+
+
+void
+check_for_collision(__global uchar* global_maze,
+                    float4 triangle_template,
+                    FLOATN boid_center,
+                    FLOATN velocity,
+                    int4* triangle_rect,
+                    boolean* hits) {
+    // Same as collision_detection.check_for_collision(). The triangle rect is
+    // stored as (left, top, right, bottom) in pixels, hits are indexed by direction
+    int x = (int)boid_center.x;
+    int y = (int)boid_center.y;
+    int i, j, wall_x, wall_y, boid_x, boid_y;
+    int diagonal_side = -1;
+    int diagonal_edge = -1;
+    boolean is_diagonal_collision = false;
+
+    // Pygame rounds the coordinates of rects
+    (*triangle_rect).s0 = (int)round((float)((int)(boid_center.x * TILE_WIDTH)) + triangle_template.s0);
+    (*triangle_rect).s1 = (int)round((float)((int)(boid_center.y * TILE_HEIGHT)) + triangle_template.s1);
+    (*triangle_rect).s2 = (*triangle_rect).s0 + (int)triangle_template.s2;
+    (*triangle_rect).s3 = (*triangle_rect).s1 + (int)triangle_template.s3;
+    boid_x = ((*triangle_rect).s0 + (int)triangle_template.s2 / 2) / TILE_WIDTH;
+    boid_y = ((*triangle_rect).s1 + (int)triangle_template.s3 / 2) / TILE_HEIGHT;
+
+    for (i = 0; i < 4; i++)
+        hits[i] = false;
+
+    // Neighbouring walls are checked in the order of maze.get_neighboring_tiles()
+    for (i = 0; i < 9; i++) {
+        j = (i == 8 ? 4 : (i < 4 ? i : i + 1));
+        wall_x = x + j % 3 - 1;
+        wall_y = y + j / 3 - 1;
+        if (!is_wall(global_maze, wall_x, wall_y))
+            continue;
+        if (!((*triangle_rect).s0 < (wall_x + 1) * TILE_WIDTH &&
+              (*triangle_rect).s2 > wall_x * TILE_WIDTH &&
+              (*triangle_rect).s1 < (wall_y + 1) * TILE_HEIGHT &&
+              (*triangle_rect).s3 > wall_y * TILE_HEIGHT))
+            continue;
+
+        // Collision type is relative to the center of the triangle rect
+        if (wall_x != boid_x && wall_y != boid_y) {
+            is_diagonal_collision = true;
+            get_diagonal_collision_type(wall_x, wall_y, boid_x, boid_y, *triangle_rect,
+                                        &diagonal_side, &diagonal_edge);
+        }
+        else if (wall_y != boid_y)
+            hits[wall_y < boid_y ? NORTH : SOUTH] = true;
+        else
+            hits[wall_x > boid_x ? EAST : WEST] = true;
+    }
+
+    // If boid has collided only with a diagonal wall, then alter its velocity
+    if (is_diagonal_collision && !(hits[NORTH] || hits[EAST] || hits[SOUTH] || hits[WEST])) {
+        boolean is_vertical_impulse = fabs(velocity.y) > fabs(velocity.x);
+        if ((diagonal_side == WEST && diagonal_edge == SOUTH) ||
+            (diagonal_side == EAST && diagonal_edge == NORTH) ||
+            (diagonal_side == EAST && diagonal_edge == SOUTH))
+            hits[is_vertical_impulse ? diagonal_side : diagonal_edge] = true;
+    }
+}
+
+
+void
+detect_collisions(__global uchar* global_maze,
+                  __global float* global_triangle_rects,
+                  __global float* global_previous_boid,
+                  __global float* global_new_boid) {
+    // Same as collision_detection.run() for one boid. Amended position
+    // is written straight into the new flock
+    FLOATN velocity = VLOADN(&global_new_boid[INDEX_IN_BOID(BOID_VEL_VAR)]);
+    FLOATN position, delta;
+    float4 triangle_template;
+    float impulse = hypot(velocity.x, velocity.y);
+    float unit_impulse;
+    int4 triangle_rect;
+    boolean hits[4];
+    boolean is_collision_detected = false;
+    int i, checks_n;
+
+    // Not moving (or NaN)
+    if (!(impulse > 0))
+        return;
+
+    // Start from the previous position and move up to the new one
+    position = VLOADN(&global_previous_boid[INDEX_IN_BOID(BOID_POS_VAR)]);
+
+    // The agent kernel has chosen the triangle of the boid's orientation
+    triangle_template = vload4((int)global_new_boid[BOID_TRIANGLE_OFFSET], global_triangle_rects);
+
+    // First check if the boid has collided into a wall without moving
+    check_for_collision(global_maze, triangle_template, position, velocity, &triangle_rect, hits);
+    if (hits[NORTH] || hits[EAST] || hits[SOUTH] || hits[WEST]) {
+        is_collision_detected = true;
+        delta = 0;
+        if (hits[EAST])
+            delta.x = triangle_rect.s2 / TILE_WIDTH * TILE_WIDTH - triangle_rect.s2;
+        if (hits[WEST])
+            delta.x = (int)ceil((float)triangle_rect.s0 / TILE_WIDTH) * TILE_WIDTH - triangle_rect.s0;
+        if (hits[NORTH])
+            delta.y = (int)ceil((float)triangle_rect.s1 / TILE_HEIGHT) * TILE_HEIGHT - triangle_rect.s1;
+        if (hits[SOUTH])
+            delta.y = triangle_rect.s3 / TILE_HEIGHT * TILE_HEIGHT - triangle_rect.s3;
+        position.x += delta.x / TILE_WIDTH;
+        position.y += delta.y / TILE_HEIGHT;
+    }
+    else {
+        // First position is unobstructed, so check positions ahead
+        unit_impulse = COLLISION_CHECK_STEP;
+        delta = velocity * unit_impulse / impulse;
+        checks_n = (int)ceil(impulse / unit_impulse);
+        for (i = 0; i < checks_n; i++) {
+            if ((i + 1) * unit_impulse > impulse) {
+                // Last step can be smaller
+                unit_impulse = impulse - unit_impulse * i;
+                delta = velocity * unit_impulse / impulse;
+            }
+
+            check_for_collision(global_maze, triangle_template, position + delta, velocity,
+                                &triangle_rect, hits);
+            if (hits[NORTH] || hits[EAST] || hits[SOUTH] || hits[WEST]) {
+                is_collision_detected = true;
+                // Nullify impulse if a wall is on the way, i.e. slide along the wall
+                if ((delta.x > 0 && hits[EAST]) || (delta.x < 0 && hits[WEST]))
+                    delta.x = 0;
+                if ((delta.y > 0 && hits[SOUTH]) || (delta.y < 0 && hits[NORTH]))
+                    delta.y = 0;
+                if (delta.x == 0 && delta.y == 0)
+                    // Can't proceed
+                    break;
+            }
+
+            if (position.x + delta.x < 0 || position.y + delta.y < 0 ||
+                position.x + delta.x > MAZE_WIDTH || position.y + delta.y > MAZE_HEIGHT)
+                // Boid is outside the maze, no point continuing the check
+                break;
+            position += delta;
+        }
+    }
+
+    if (is_collision_detected)
+        VSTOREN(position, &global_new_boid[INDEX_IN_BOID(BOID_POS_VAR)]);
+}
+
+
+
+void
+apply_node_updates(__global uchar* global_map, __global int* global_node_updates, int x, int y) {
+    // Processes a single node. The updates recorded by the agents on it are applied
+    // a kind at a time, as in numpy_computations.update_pheromone_levels(): clearing,
+    // trailing, consumption, raising to the unexplored passes and the agents' own levels.
+    // Where several agents set the level, the one with the highest index wins
+    int node = INDEX_IN_MAZE(x, y);
+    int boid_id, i;
+    __global int* update;
+    float pheromone_level = NODE_PHEROMONE_A(global_map, x, y);
+    float trailing_level = 0;
+    float consumer_level = 0;
+    float raised_level = 0;
+    boolean is_updated = false;
+    boolean is_cleared = false;
+    boolean is_trailed = false;
+    boolean is_raised = false;
+    int consumers_n = 0;
+    uchar flags = 0;
+
+    for (boid_id = 0; boid_id < NUMBER_OF_BOIDS; boid_id++) {
+        update = &global_node_updates[boid_id * NODE_UPDATE_SIZE];
+        if (update[NODE_UPDATE_NODE_VAR] != node)
+            continue;
+        is_updated = true;
+        flags |= update[NODE_UPDATE_FLAGS_VAR];
+        if (update[NODE_UPDATE_OP_VAR] == NODE_UPDATE_CLEAR)
+            is_cleared = true;
+        else if (update[NODE_UPDATE_OP_VAR] == NODE_UPDATE_TRAIL) {
+            is_trailed = true;
+            trailing_level = as_float(update[NODE_UPDATE_LEVEL_VAR]);
+        }
+        else if (update[NODE_UPDATE_OP_VAR] == NODE_UPDATE_CONSUME) {
+            consumers_n++;
+            consumer_level = as_float(update[NODE_UPDATE_LEVEL_VAR]);
+        }
+    }
+    if (is_updated == false)
+        return;
+
+    if (is_cleared == true)
+        pheromone_level = 0;
+    if (is_trailed == true)
+        pheromone_level = trailing_level;
+    // Agents consume 1 attractant pheromone each, one after another
+    if (consumers_n > 0) {
+        if (pheromone_level >= 1)
+            for (i = 0; i < consumers_n; i++)
+                pheromone_level -= 1;
+        else
+            pheromone_level = 0;
+    }
+    // Raising depends on the level after consumption, so it is another pass
+    for (boid_id = 0; boid_id < NUMBER_OF_BOIDS; boid_id++) {
+        update = &global_node_updates[boid_id * NODE_UPDATE_SIZE];
+        if (update[NODE_UPDATE_NODE_VAR] == node &&
+            update[NODE_UPDATE_RAISE_VAR] > 0 && pheromone_level < update[NODE_UPDATE_RAISE_VAR]) {
+            is_raised = true;
+            raised_level = update[NODE_UPDATE_RAISE_VAR];
+        }
+    }
+    if (is_raised == true)
+        pheromone_level = raised_level;
+    // Consumers' additions overwrite each other, the last one's stays
+    if (consumers_n > 0)
+        pheromone_level += consumer_level;
+
+    SET_NODE_PHEROMONE_A(global_map, x, y, pheromone_level);
+    NODE_FLAGS(global_map, x, y) |= flags;
+}
+
+
+
+// A timestep of a single boid: sensors, AI and locomotion. Rules 1, 2 and 3 come in
+// precomputed (flock sums and the avoidance vector). Same for k_agent_ai_and_sim and
+// k_agent_step_fused
+void
+simulate_agent_step(__global float* global_previous_flock,
+                    __global float* global_new_flock,
+                    __global uchar* global_map,
+                    __global uchar* global_cmms,
+                    __global uchar* global_maze,
+                    __local float* local_flock_pos_sum,
+                    __local float* local_flock_vel_sum,
+                    __local ushort* local_iteration,
+                    FLOATN avoidance_vector,
+                    __global ushort* global_agent_programmes,
+                    __global int* global_node_updates,
+                    uint random_key,
+                    int instance,
+                    int boid_id,
+                    __global float* global_experiment,
+                    __global float* global_test) {
+    FLOATN impulse;
+    FLOATN velocity;
+    FLOATN position;
+    float orientation;
+    uchar sensor_readings[READINGS_N];
+
+    /* Entry fetch (global -> private). Sensors read the maze at the previous position */
+    read_sensors(global_maze,
+                 &global_previous_flock[INDEX_IN_FLOCK(boid_id, 0)],
+                 sensor_readings);
+
+    /*---------           Compute outputs           ---------------*/
+
+    agent_ai(global_map,
+             &global_cmms[boid_id * SQUARE_TYPES_N3],
+             avoidance_vector,
+             local_flock_pos_sum,
+             local_flock_vel_sum,
+             global_previous_flock,
+             global_new_flock,
+             &global_agent_programmes[INDEX_IN_PROGS(boid_id)],
+             &global_node_updates[boid_id * NODE_UPDATE_SIZE],
+             sensor_readings,
+             boid_id,
+             &impulse,
+             // Random numbers are drawn for the step and the boid (of the instance)
+             random_key,
+             (uint2)(*local_iteration, instance * NUMBER_OF_BOIDS + boid_id),
+             local_iteration,
+             &global_experiment[INDEX_IN_EXP(boid_id)],
+             global_test);
+
+    simulate_locomotion(global_previous_flock,
+                        local_iteration,
+                        impulse,
+                        boid_id,
+                        &velocity);
+
+    /*---------            Save outputs            ---------------*/
+
+    // Non-finite values (NaN or infinity) are saved as zeros, so the flocks
+    // the host gets are clean
+    velocity = zero_non_finite(velocity);
+    position = zero_non_finite(
+        VLOADN(&global_previous_flock[INDEX_IN_FLOCK(boid_id, BOID_POS_VAR)]) + velocity);
+    if (!isfinite(global_new_flock[INDEX_IN_FLOCK(boid_id, BOID_PHEROMONE_VAR)]))
+        global_new_flock[INDEX_IN_FLOCK(boid_id, BOID_PHEROMONE_VAR)] = 0;
+
+    // Move boids
+    VSTOREN(position, &global_new_flock[INDEX_IN_FLOCK(boid_id, BOID_POS_VAR)]);
+
+    // Update velocity
+    VSTOREN(velocity,
+        &global_new_flock[INDEX_IN_FLOCK(boid_id, BOID_VEL_VAR)]);
+
+    // Orientation and its template triangle for collision detection and rendering
+    orientation = get_orientation(
+        velocity, global_previous_flock[INDEX_IN_FLOCK(boid_id, 0) + BOID_ORIENTATION_OFFSET]);
+    global_new_flock[INDEX_IN_FLOCK(boid_id, 0) + BOID_ORIENTATION_OFFSET] = orientation;
+    global_new_flock[INDEX_IN_FLOCK(boid_id, 0) + BOID_TRIANGLE_OFFSET] = get_triangle_index(orientation);
+}
+
+
+
+int2
+follow_goal_path(__global uchar* global_map, int2 node) {
+    // Same as maze_solver.reuse_swarm_progress(): returns the end of the path of goal nodes
+    // the agents have marked from the node on. Neighbours are tried in the order of
+    // maze_solver.get_neighbours(). At most MAZE_SIZE nodes are followed, as the path may loop
+    const int delta_x[4] = {0, -1, 1, 0};
+    const int delta_y[4] = {-1, 0, 0, 1};
+    int2 previous_node = (int2)(-1, -1);
+    int2 neighbour;
+    int i, nodes_n;
+
+    if (NODE_FLAG(global_map, node.x, node.y, NODE_IS_GOAL_FLAG) == false)
+        return node;
+    for (nodes_n = 0; nodes_n < MAZE_SIZE; nodes_n++) {
+        for (i = 0; i < 4; i++) {
+            neighbour = (int2)(node.x + delta_x[i], node.y + delta_y[i]);
+            if (neighbour.x < 0 || neighbour.x >= MAZE_WIDTH ||
+                neighbour.y < 0 || neighbour.y >= MAZE_HEIGHT)
+                continue;
+            if (NODE_FLAG(global_map, neighbour.x, neighbour.y, NODE_IS_GOAL_FLAG) &&
+                (neighbour.x != previous_node.x || neighbour.y != previous_node.y))
+                break;
+        }
+        if (i == 4)
+            break;
+        previous_node = node;
+        node = neighbour;
+    }
+    return node;
+}
+
+
+
+boolean
+is_node_open(__global uchar* global_maze, __global uchar* global_map, int node) {
+    // Explored passages are searched by maze_solver.solve_maze()
+    int x = node / MAZE_HEIGHT;
+    int y = node % MAZE_HEIGHT;
+    return global_maze[node] < FIRST_WALL_ID &&
+           NODE_FLAG(global_map, x, y, NODE_IS_EXPLORED_FLAG);
+}
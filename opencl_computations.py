@@ -3,32 +3,161 @@ opencl_computations.py encapsulates all interaction with OpenCL - initialization
 data transfers, kernel execution etc.
 """
 import os
+import json
+import hashlib
+from time import time
 
 import pyopencl as cl
 import numpy as np
 
 import configs as cfg
 import agents
-import collision_detection as coll_detect
 import maze
-
-
-def init_opencl():
-    """ Set up OpenCL """
-    platform = cl.get_platforms()
-    my_gpu_devices = platform[0].get_devices(device_type=cl.device_type.GPU)
-    device = my_gpu_devices[0]
-    context = cl.Context(devices=my_gpu_devices)
+import profiling
+import recorder
+
+# Kernels computed in work groups of tunable sizes (see autotuning.py).
+# k_init_memory is a single work item
+TUNABLE_KERNELS = ["k_update_map", "k_list_map_changes", "k_agent_reynolds_rules13_preprocess",
+                   "k_clear_cells", "k_bin_boids", "k_sort_cells",
+                   "k_agent_reynolds_rule2_preprocess", "k_agent_ai_and_sim", "k_agent_step_fused",
+                   "k_apply_node_updates", "k_detect_collisions",
+                   "k_update_values", "k_check_goal_reachability"]
+# Device memory a run continues from (see OpenCLBackend.get_state()) and its element types.
+# The rest is recomputed on every step
+STATE_BUFFERS = {"global_generated_flocks": np.float32, "global_map": np.uint8,
+                 "global_map_shadow": np.uint8, "global_cmms": np.uint8,
+                 "global_agent_programmes": np.uint16, "global_experiment": np.float32,
+                 "global_solved": np.uint8}
+# Ints an agent records its update of the current node in (see NODE_UPDATE_*_VAR in main.cl)
+NODE_UPDATE_SIZE = 5
+
+
+def init_opencl(device_override=None):
+    """
+    Set up OpenCL on the most suitable device. Device types are tried in the
+    order of cfg.device_preference, so machines without a GPU fall back to
+    a CPU implementation (e.g. pocl). If several devices are available, they are
+    calibrated and the fastest one is used.
+    The choice can be forced with device_override or the environment variable
+    cfg.device_env_var: either a device type ("CPU"), "platform:device"
+    indices ("0:1") or a part of the device name.
+    """
+    devices = get_candidate_devices()
+    if device_override is None:
+        device_override = os.environ.get(cfg.device_env_var)
+    if device_override:
+        devices = [device for device in devices if device_matches(device, device_override)]
+        if not devices:
+            raise RuntimeError("No OpenCL device matches '%s'" % device_override)
+    if not devices:
+        raise RuntimeError("No OpenCL devices of types " + ", ".join(cfg.device_preference) +
+                           " are available")
+
+    if cfg.calibrate_devices and len(devices) > 1:
+        device = calibrate_devices(devices)
+    else:
+        device = devices[0]
+    print("Using OpenCL device", device.name.strip(), "on", device.platform.name.strip())
+    context = cl.Context(devices=[device])
 
     # Create queues
-    queue = cl.CommandQueue(context)  # AWOOGA! to uncomment
-    # properties=cl.command_queue_properties.PROFILING_ENABLE)
+    queue = create_queue(context)
 
     return context, device, queue
 
 
-def build_opencl_program(context, device):
-    """ Builds the program """
+def create_queue(context):
+    """ Creates an in-order queue, with profiling if it's on """
+    if cfg.profiling_on:
+        return cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+    return cl.CommandQueue(context)
+
+
+def get_candidate_devices():
+    """ Returns devices of all platforms sorted according to cfg.device_preference """
+    devices = []
+    try:
+        platforms = cl.get_platforms()
+    except cl.Error:
+        # No OpenCL ICD is installed
+        platforms = []
+    for platform in platforms:
+        try:
+            platform_devices = platform.get_devices()
+        except cl.Error:
+            # Platforms without devices raise DEVICE_NOT_FOUND
+            continue
+        for device in platform_devices:
+            for rank, device_type in enumerate(cfg.device_preference):
+                if device.type & getattr(cl.device_type, device_type):
+                    devices.append((rank, device))
+                    break
+    # The sort is stable, so platform order is kept within the same device type
+    devices.sort(key=lambda ranked_device: ranked_device[0])
+    return [device for _, device in devices]
+
+
+def device_matches(device, device_override):
+    """ Checks if the device is the one requested by the override string """
+    device_override = device_override.strip()
+    if hasattr(cl.device_type, device_override.upper()):
+        return bool(device.type & getattr(cl.device_type, device_override.upper()))
+    if ":" in device_override:
+        platform_i, device_i = device_override.split(":", 1)
+        if platform_i.isdigit() and device_i.isdigit():
+            # Indices out of range match no device
+            platforms = cl.get_platforms()
+            if int(platform_i) >= len(platforms) or device.platform != platforms[int(platform_i)]:
+                return False
+            platform_devices = device.platform.get_devices()
+            return (int(device_i) < len(platform_devices) and
+                    device == platform_devices[int(device_i)])
+    return device_override.lower() in device.name.lower()
+
+
+def calibrate_devices(devices):
+    """ Runs a short kernel on every device and returns the fastest one """
+    print("Calibrating OpenCL devices.")
+    source = open(os.path.join(os.getcwd(), cfg.cl_dir, cfg.cl_calibration_url), 'r').read()
+    data = np.random.rand(cfg.calibration_items).astype(np.float32)
+    fastest_device = None
+    best_time = float('Inf')
+    for device in devices:
+        try:
+            context = cl.Context(devices=[device])
+            queue = cl.CommandQueue(context)
+            kernel = cl.Program(context, source).build().k_calibrate
+            buffer = cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR,
+                               hostbuf=data)
+            # The first launch includes lazy initialization, so it is not timed
+            kernel(queue, data.shape, None, buffer)
+            queue.finish()
+            t1 = time()
+            for _ in range(cfg.calibration_runs):
+                kernel(queue, data.shape, None, buffer)
+            cl.enqueue_copy(queue, data, buffer)
+            queue.finish()
+            device_time = time() - t1
+        except cl.Error as e:
+            print("Device", device.name.strip(), "failed calibration:", e)
+            continue
+        print("%s: %.4f s" % (device.name.strip(), device_time))
+        if device_time < best_time:
+            best_time = device_time
+            fastest_device = device
+    if fastest_device is None:
+        # Nothing has been calibrated, rely on the preference order
+        fastest_device = devices[0]
+    return fastest_device
+
+
+def build_opencl_program(context, device, local_sizes=None):
+    """
+    Builds the program. Work group sizes of the kernels are given by local_sizes
+    ({kernel name: size}), otherwise they are the ones tuned for the device and the
+    workload (see autotuning.py). The preferred multiple is used for the others
+    """
     print("Building an OpenCL program.")
     # Fetch source code
     source = open(os.path.join(os.getcwd(), cfg.cl_dir, cfg.cl_main_url), 'r').read()
@@ -38,9 +167,14 @@ def build_opencl_program(context, device):
                    "max_work_group_size": 256,  # Dummy value
 
                    "number_of_boids": cfg.NumberOfBoids,
+                   "instances_n": cfg.batch_instances,
 
                    "maze_width": cfg.maze_width,
                    "maze_height": cfg.maze_height,
+                   "starting_node_x": cfg.starting_node[0],
+                   "starting_node_y": cfg.starting_node[1],
+                   "goal_node_x": cfg.goal_node[0],
+                   "goal_node_y": cfg.goal_node[1],
 
                    "neuron_threshold": cfg.NEURON_THRESHOLD,
                    "square_types_n": maze.Square.square_types_n *
@@ -54,8 +188,6 @@ def build_opencl_program(context, device):
                        cfg.boid_attractant_dissolution_component,
                    "node_attractant_dissolution_component":
                        cfg.node_attractant_dissolution_component,
-                   "node_marker_dissolution_component":
-                       cfg.node_marker_dissolution_component,
                    "readings_n": cfg.READINGS_N,
                    "reading_north": 0,
                    "reading_east": 1,
@@ -64,12 +196,14 @@ def build_opencl_program(context, device):
                    "reading_bottom": 4,
 
                    "minseparation": cfg.MinSeparation,
+                   "separation_cells": int(np.ceil(cfg.MinSeparation)),
                    "boidvelocity": cfg.BoidVelocity,
                    "traction": cfg.Traction,
                    "center": cfg.center[0],
 
                    "dimensions": cfg.Dimensions,
                    "total_timesteps": cfg.total_timesteps,
+                   "flock_ring_length": cfg.flock_ring_length,
 
                    "weightseparation": cfg.WeightSeparation,
                    "weightcenterofmass": cfg.WeightCenterOfMass,
@@ -79,6 +213,8 @@ def build_opencl_program(context, device):
                    "boid_pos_var": cfg.BOID_POS_VAR,
                    "boid_vel_var": cfg.BOID_VEL_VAR,
                    "boid_pheromone_var": cfg.BOID_PHEROMONE_VAR,
+                   "boid_orientation_offset": cfg.BOID_ORIENTATION_OFFSET,
+                   "boid_triangle_offset": cfg.BOID_TRIANGLE_OFFSET,
                    "arrdim": cfg.ARRDIM,
 
                    "prog_size": cfg.PROG_SIZE,
@@ -106,62 +242,226 @@ def build_opencl_program(context, device):
                    "goal_edge_vertical": cfg.GOAL_EDGE_VERTICAL,
 
                    "node_size": cfg.NODE_SIZE,
-                   "node_is_explored_var": cfg.NODE_IS_EXPLORED_VAR,
-                   "node_pheromone_a_var": cfg.NODE_PHEROMONE_A_VAR,
-                   "node_pheromone_m_var": cfg.NODE_PHEROMONE_M_VAR,
-                   "node_is_deadend_var": cfg.NODE_IS_DEADEND_VAR,
-                   "node_is_goal_var": cfg.NODE_IS_GOAL_VAR,
+                   "node_pheromone_a_offset": cfg.NODE_PHEROMONE_A_OFFSET,
+                   "node_flags_offset": cfg.NODE_FLAGS_OFFSET,
+                   "node_markers_offset": cfg.NODE_MARKERS_OFFSET,
+                   "node_pheromone_a_one": cfg.NODE_PHEROMONE_A_ONE,
+                   "node_is_explored_flag": cfg.NODE_IS_EXPLORED_FLAG,
+                   "node_is_deadend_flag": cfg.NODE_IS_DEADEND_FLAG,
+                   "node_is_goal_flag": cfg.NODE_IS_GOAL_FLAG,
+                   "node_marker_steps": cfg.NODE_MARKER_STEPS,
+                   "map_change_slots": get_map_change_slots(),
+                   "node_update_size": NODE_UPDATE_SIZE,
 
                    "entrance_id": maze.Square(
                        maze.Passage.entrance,
                        maze.Orientation.north).get_numeric_value(),
                    "exit_id": maze.Square(
                        maze.Passage.exit,
-                       maze.Orientation.north).get_numeric_value()
+                       maze.Orientation.north).get_numeric_value(),
+                   "border_id": maze.Wall.normal.value,
+                   "no_bottom_id": maze.Passage.normal.value,
+                   # Wall symbols have greater values than passage ones
+                   "first_wall_id": maze.Square(
+                       maze.Wall.normal,
+                       maze.Orientation.north).get_numeric_value(),
+
+                   "tile_width": cfg.tile_width,
+                   "tile_height": cfg.tile_height,
+                   "collision_check_step": cfg.collision_check_step,
+                   "collision_precision_x": cfg.collision_check_step * cfg.window_width,
+                   "collision_precision_y": cfg.collision_check_step * cfg.window_height,
+                   "triangles_n": cfg.triangles_n
                    }
 
-    # Specify include directory
-    build_options = "-I \"" + os.path.join(os.getcwd(), cfg.cl_dir) + "\""
+    for name in TUNABLE_KERNELS:
+        prog_params[name + "_group_size"] = 64  # Dummy value
 
-    # Build program with some of the parameters missing to get their values
-    prog = cl.Program(context, source % prog_params).build(options=build_options)
+    # Specify include directory. Constants are kept single precision - on devices
+    # supporting doubles (e.g. CPUs) they would not mix with float vectors otherwise
+    build_options = "-cl-single-precision-constant -I \"" + os.path.join(os.getcwd(), cfg.cl_dir) + "\""
 
-    gpu_params = {}
-    # Get the correct values. Any kernel can be used here
-    gpu_params["preferred_multiple"] = cl.Kernel(prog, 'k_init_memory').get_work_group_info(
-        cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE,
-        device)
-    gpu_params["max_work_group_size"] = device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+    # Work group parameters are baked into the program, so they are queried by building
+    # it with dummy values first. The query result is cached per device
+    work_groups_key = get_cache_key(device, prog_params, build_options)
+    gpu_params = load_work_group_params(work_groups_key)
+    if gpu_params is None:
+        prog = cl.Program(context, source % prog_params).build(options=build_options)
+
+        gpu_params = {}
+        # Get the correct values. Any kernel can be used here
+        gpu_params["preferred_multiple"] = cl.Kernel(prog, 'k_init_memory').get_work_group_info(
+            cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE,
+            device)
+        gpu_params["max_work_group_size"] = device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+        save_work_group_params(work_groups_key, gpu_params)
 
     prog_params["preferred_work_group_size_multiple"] = gpu_params["preferred_multiple"]
     prog_params["max_work_group_size"] = gpu_params["max_work_group_size"]
 
-    prog = cl.Program(context, source % prog_params).build(options=build_options)
+    if local_sizes is None:
+        local_sizes = load_local_sizes(device) or {}
+    gpu_params["local_sizes"] = {name: local_sizes.get(name, gpu_params["preferred_multiple"])
+                                 for name in TUNABLE_KERNELS}
+    for name, local_size in gpu_params["local_sizes"].items():
+        prog_params[name + "_group_size"] = local_size
+
+    prog = build_cached_program(context, device, source % prog_params, prog_params, build_options)
     kernels = {}
     kernels["k_init_memory"] = prog.k_init_memory
     kernels["k_update_map"] = prog.k_update_map
+    kernels["k_list_map_changes"] = prog.k_list_map_changes
     kernels["k_agent_reynolds_rules13_preprocess"] = prog.k_agent_reynolds_rules13_preprocess
+    kernels["k_clear_cells"] = prog.k_clear_cells
+    kernels["k_bin_boids"] = prog.k_bin_boids
+    kernels["k_sort_cells"] = prog.k_sort_cells
     kernels["k_agent_reynolds_rule2_preprocess"] = prog.k_agent_reynolds_rule2_preprocess
     kernels["k_agent_ai_and_sim"] = prog.k_agent_ai_and_sim
+    kernels["k_agent_step_fused"] = prog.k_agent_step_fused
+    kernels["k_apply_node_updates"] = prog.k_apply_node_updates
     kernels["k_update_values"] = prog.k_update_values
+    kernels["k_detect_collisions"] = prog.k_detect_collisions
+    kernels["k_check_goal_reachability"] = prog.k_check_goal_reachability
 
     return kernels, gpu_params
 
 
-def prepare_host_memory(context):
-    """ Prepare buffers & arrays on host side """
+def get_device_identity(device):
+    """ Describes the device and its driver. Cached binaries are only valid for the same ones """
+    return [device.platform.name, device.platform.version,
+            device.name, device.version, device.driver_version]
+
+
+def get_cache_key(device, prog_params, build_options):
+    """
+    Hashes everything that affects a compiled program: sources of all the files in
+    cfg.cl_dir (including the headers), program constants, build options and the device
+    """
+    sha = hashlib.sha256()
+    cl_dir = os.path.join(os.getcwd(), cfg.cl_dir)
+    for filename in sorted(os.listdir(cl_dir)):
+        if filename.endswith((".cl", ".h")):
+            sha.update(filename.encode())
+            sha.update(open(os.path.join(cl_dir, filename), 'rb').read())
+    sha.update(json.dumps(prog_params, sort_keys=True, default=str).encode())
+    sha.update(build_options.encode())
+    sha.update(json.dumps(get_device_identity(device)).encode())
+    return sha.hexdigest()
+
+
+def load_work_group_params(key):
+    """ Returns cached work group parameters or None """
+    if not cfg.cl_cache_on:
+        return None
+    try:
+        with open(os.path.join(os.getcwd(), cfg.cl_cache_dir, cfg.cl_work_groups_url),
+                  'r') as work_groups_f:
+            work_groups = json.load(work_groups_f)
+    except (IOError, ValueError):
+        return None
+    return work_groups.get(key)
+
+
+def save_work_group_params(key, gpu_params):
+    if not cfg.cl_cache_on:
+        return
+    path = os.path.join(os.getcwd(), cfg.cl_cache_dir, cfg.cl_work_groups_url)
+    try:
+        with open(path, 'r') as work_groups_f:
+            work_groups = json.load(work_groups_f)
+    except (IOError, ValueError):
+        work_groups = {}
+    work_groups[key] = gpu_params
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    replace_file(path, json.dumps(work_groups, indent=4), 'w')
+
+
+def get_workload_key(device):
+    """ Work group sizes are tuned for the device, the swarm size and the maze size """
+    return " | ".join([name.strip() for name in get_device_identity(device)] +
+                      ["%d boids" % cfg.NumberOfBoids,
+                       "%dx%d maze" % (cfg.maze_width, cfg.maze_height)])
+
+
+def load_local_sizes(device):
+    """ Returns the work group sizes tuned for the device and the workload or None """
+    try:
+        with open(os.path.join(os.getcwd(), cfg.autotune_url), 'r') as tuned_f:
+            tuned = json.load(tuned_f)
+    except (IOError, ValueError):
+        return None
+    return tuned.get(get_workload_key(device))
+
+
+def save_local_sizes(device, local_sizes):
+    path = os.path.join(os.getcwd(), cfg.autotune_url)
+    try:
+        with open(path, 'r') as tuned_f:
+            tuned = json.load(tuned_f)
+    except (IOError, ValueError):
+        tuned = {}
+    tuned[get_workload_key(device)] = local_sizes
+    replace_file(path, json.dumps(tuned, indent=4, sort_keys=True), 'w')
+
+
+def replace_file(path, data, mode):
+    """
+    Writes data to a temporary file first and puts it in place of the file at once,
+    so that runs sharing the caches never read a half written file
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, mode) as tmp_f:
+        tmp_f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_cached_program(context, device, source, prog_params, build_options):
+    """
+    Builds the program from a cached binary if there is one. Otherwise builds it
+    from the source and caches the binary
+    """
+    if not cfg.cl_cache_on:
+        return cl.Program(context, source).build(options=build_options)
+
+    binary_path = os.path.join(os.getcwd(), cfg.cl_cache_dir,
+                               get_cache_key(device, prog_params, build_options) + ".bin")
+    if os.path.exists(binary_path):
+        try:
+            with open(binary_path, 'rb') as binary_f:
+                binary = binary_f.read()
+            return cl.Program(context, [device], [binary]).build(options=build_options)
+        except cl.Error as e:
+            print("Failed to load the cached program binary:", e)
+
+    prog = cl.Program(context, source).build(options=build_options)
+    os.makedirs(os.path.dirname(binary_path), exist_ok=True)
+    replace_file(binary_path, prog.get_info(cl.program_info.BINARIES)[0], 'wb')
+    return prog
+
+
+def prepare_host_memory(context, queue):
+    """
+        Prepare buffers & arrays on host side. Buffers hold the data of all the
+        instances (see cfg.batch_instances), one after another
+    """
 
     print("Creating buffers.")
     buffers = {}
 
+    # Termination flags of the instances. Kernels skip the solved ones
+    buffers["global_solved"] = cl.Buffer(
+        context, cl.mem_flags.READ_ONLY, size=np.dtype(np.uint8).itemsize *
+        cfg.batch_instances)
+
     # Iteration number buffer
     buffers["global_iteration"] = cl.Buffer(
         context, cl.mem_flags.READ_ONLY, size=np.dtype(np.uint16).itemsize)
 
-    # Empty buffers for output data
+    # Empty buffers for output data. It's a ring of the latest flocks (of all the
+    # instances), the whole history is kept on the host
     buffers["global_generated_flocks"] = cl.Buffer(
         context, cl.mem_flags.READ_WRITE, size=agents.Boid.arraySize *
-        cfg.total_timesteps * cfg.NumberOfBoids)
+        cfg.flock_ring_length * cfg.batch_instances * cfg.NumberOfBoids)
 
     # Buffers for transferring Python-computed amendments to OpenCL values
     buffers["global_amendments_n"] = cl.Buffer(
@@ -172,52 +472,98 @@ def prepare_host_memory(context):
     buffers["global_amendment_values"] = cl.Buffer(
         context, cl.mem_flags.READ_ONLY, size=np.dtype(np.float32).itemsize *
         cfg.NumberOfBoids * cfg.ARRDIM * cfg.Dimensions)
-    # Amendment data holder class
-    amendments = coll_detect.Amendments()
 
     # Buffer for CMMs
     buffers["global_cmms"] = cl.Buffer(
         context, cl.mem_flags.READ_ONLY, size=np.dtype(np.uint8).itemsize *
-        cfg.NumberOfBoids * int(np.power(maze.Square.square_types_n *
+        cfg.batch_instances * cfg.NumberOfBoids * int(np.power(maze.Square.square_types_n *
                                          maze.Square.square_orientation_n, 3)))
 
-    # Buffer for random numbers
-    buffers["global_random"] = cl.Buffer(
-        context, cl.mem_flags.READ_ONLY, size=np.dtype(np.float32).itemsize)
-
     # Buffer for agent programmes
     buffers["global_agent_programmes"] = cl.Buffer(
         context, cl.mem_flags.READ_ONLY, size=np.dtype(np.uint16).itemsize *
-        cfg.NumberOfBoids * cfg.PROG_SIZE)
+        cfg.batch_instances * cfg.NumberOfBoids * cfg.PROG_SIZE)
 
-    # Buffer for sensor readings
-    buffers["global_sensor_readings"] = cl.Buffer(
+    # Buffer for the maze (numeric values of squares). Sensors read it on the device
+    buffers["global_maze"] = cl.Buffer(
         context, cl.mem_flags.READ_ONLY, size=np.dtype(np.uint8).itemsize *
-        cfg.NumberOfBoids * 5)
+        cfg.batch_instances * cfg.maze_width * cfg.maze_height)
+
+    # Buffer for the bounding rects of the boid triangles (see get_triangle_rects())
+    buffers["global_triangle_rects"] = cl.Buffer(
+        context, cl.mem_flags.READ_ONLY, size=np.dtype(np.float32).itemsize *
+        cfg.triangles_n * 4)
 
     # Buffer for the map
     buffers["global_map"] = cl.Buffer(
-        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.float32).itemsize *
+        context, cl.mem_flags.READ_WRITE,
+        size=cfg.batch_instances * cfg.maze_width * cfg.maze_height * cfg.NODE_SIZE)
+    # Flocks are downloaded into a ring of pinned host slots, one per step in flight (see
+    # get_map_change_slots()), and appended to the histories from there (see
+    # append_flocks()). A step holds all the instances, so it is downloaded at once
+    host_flocks = map_pinned_array(context, queue,
+                                   (get_map_change_slots(), cfg.batch_instances,
+                                    cfg.NumberOfBoids, agents.Boid.arrayLen), np.float32)
+
+    # Only the nodes changed since the previous step are downloaded. They are found by
+    # comparing the map with its shadow and listed in a slot per step in flight,
+    # a list per instance
+    buffers["global_map_shadow"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE,
+        size=cfg.batch_instances * cfg.maze_width * cfg.maze_height * cfg.NODE_SIZE)
+    buffers["global_map_changes_n"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.int32).itemsize *
+        get_map_change_slots() * cfg.batch_instances)
+    buffers["global_changed_nodes"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.int32).itemsize *
+        get_map_change_slots() * cfg.batch_instances * cfg.maze_width * cfg.maze_height)
+    buffers["global_changed_values"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=get_map_change_slots() * cfg.batch_instances *
         cfg.maze_width * cfg.maze_height * cfg.NODE_SIZE)
-    # And array
-    if cfg.track_map_changes:
-        global_map = np.zeros((cfg.total_timesteps, cfg.maze_width,
-                               cfg.maze_height, cfg.NODE_SIZE), dtype=np.float32)
-    else:
-        global_map = None
+
+    # Goal checks on the device (see cfg.backend_goal_check): the nodes reached from the
+    # start and whether the goal is among them, in a slot per step in flight
+    buffers["global_reached_nodes"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE,
+        size=cfg.batch_instances * cfg.maze_width * cfg.maze_height)
+    buffers["global_goal_reached"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.uint8).itemsize *
+        get_map_change_slots() * cfg.batch_instances)
+
+    # Two staging slots for the downloaded flocks (see gpu_enqueue_flocks()),
+    # so that the download of one step overlaps the computation of the next one
+    buffers["staging_flocks"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=agents.Boid.arraySize *
+        cfg.batch_instances * cfg.NumberOfBoids * 2)
 
     # Buffer for experiment results
     buffers["global_experiment"] = cl.Buffer(
         context, cl.mem_flags.READ_ONLY, size=np.dtype(np.float32).itemsize *
-        cfg.NumberOfBoids * cfg.EXP_SIZE)
+        cfg.batch_instances * cfg.NumberOfBoids * cfg.EXP_SIZE)
 
     buffers["global_boid_avoidance_vectors"] = cl.Buffer(
         context, cl.mem_flags.READ_WRITE, size=np.dtype(np.float32).itemsize *
-        cfg.NumberOfBoids * cfg.Dimensions)
+        cfg.batch_instances * cfg.NumberOfBoids * cfg.Dimensions)
+    # Cell lists for the neighbour search: the first boid of each cell (maze tile)
+    # and the next boid of each boid
+    buffers["global_cell_heads"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.int32).itemsize *
+        cfg.batch_instances * cfg.maze_width * cfg.maze_height)
+    buffers["global_boid_next"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.int32).itemsize *
+        cfg.batch_instances * cfg.NumberOfBoids)
+    # Updates of the current nodes recorded by the agents, applied by k_apply_node_updates
+    buffers["global_node_updates"] = cl.Buffer(
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.int32).itemsize *
+        cfg.batch_instances * cfg.NumberOfBoids * NODE_UPDATE_SIZE)
+    # Flock sums of rules 1 and 3 of the work groups - see FLOCK_SUM_GROUPS_N in main.cl.
+    # There are no more groups than boids
     buffers["global_flock_pos_sum"] = cl.Buffer(
-        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.float32).itemsize * cfg.Dimensions)
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.float32).itemsize *
+        cfg.batch_instances * cfg.NumberOfBoids * cfg.Dimensions)
     buffers["global_flock_vel_sum"] = cl.Buffer(
-        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.float32).itemsize * cfg.Dimensions)
+        context, cl.mem_flags.READ_WRITE, size=np.dtype(np.float32).itemsize *
+        cfg.batch_instances * cfg.NumberOfBoids * cfg.Dimensions)
 
     # TEST
     buffers["global_test"] = cl.Buffer(
@@ -236,11 +582,70 @@ def prepare_host_memory(context):
     buffers["local_readings"] = cl.LocalMemory(
         np.dtype(np.uint8).itemsize * cfg.NumberOfBoids * cfg.Dimensions)
 
-    return buffers, amendments, global_map
+    return buffers, host_flocks
+
+
+def map_pinned_array(context, queue, shape, dtype):
+    """
+        Returns a zeroed host array in memory allocated by OpenCL (ALLOC_HOST_PTR), which
+        is pinned on discrete devices and needs no copies on CPU ones. It is mapped once
+        and stays mapped, the array keeps the buffer alive
+    """
+    pinned_buffer = cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR,
+                              size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    array, _ = cl.enqueue_map_buffer(queue, pinned_buffer,
+                                     cl.map_flags.READ | cl.map_flags.WRITE,
+                                     0, shape, dtype, is_blocking=True)
+    array.fill(0)
+    return array
+
+
+def create_slot_flocks(host_flocks):
+    """ Flocks viewing the slots of host_flocks, by slot and instance. Allocated once """
+    slot_flocks = []
+    for host_flock in host_flocks:
+        slot_flocks.append([])
+        for instance_arrays in host_flock:
+            flock = agents.Flock(cfg.NumberOfBoids)
+            flock.np_arrays = instance_arrays
+            slot_flocks[-1].append(flock)
+    return slot_flocks
+
+
+def create_history_flocks():
+    """
+        Flocks of every step of the instances, for the histories kept in memory, by
+        instance and step. They are allocated once, like the map histories, and their
+        arrays are the rows of an array per instance
+    """
+    history_flocks = []
+    for instance_arrays in np.zeros((cfg.batch_instances, cfg.total_timesteps,
+                                     cfg.NumberOfBoids, agents.Boid.arrayLen), dtype=np.float32):
+        history_flocks.append([])
+        for np_arrays in instance_arrays:
+            flock = agents.Flock(cfg.NumberOfBoids)
+            flock.np_arrays = np_arrays
+            history_flocks[-1].append(flock)
+    return history_flocks
+
+
+def append_flocks(step, instances_flocks, slot_flocks, history_flocks):
+    """
+        Appends the flocks of the step, downloaded into their slot (see create_slot_flocks()),
+        to the histories of the instances. Recordings copy them straight into their chunks,
+        the histories kept in memory into the flocks of the step in history_flocks
+    """
+    for flocks, slot_flock, instance_history_flocks in zip(
+            instances_flocks, slot_flocks[step % get_map_change_slots()], history_flocks):
+        if recorder.is_recording(flocks):
+            flocks.append(slot_flock)
+        else:
+            instance_history_flocks[step].np_arrays[:] = slot_flock.np_arrays
+            flocks.append(instance_history_flocks[step])
 
 
-def set_kernel_arguments(kernels, buffers):
-    """ Set arguments """
+def set_kernel_arguments(kernels, buffers, random_key):
+    """ Set arguments. random_key is the key of the agents' random numbers """
     # If same global buffer is passed to multiple kernels,
     # values are preserved between kernel switches.
     # If same local buffer is passed to multiple kernels,
@@ -250,35 +655,67 @@ def set_kernel_arguments(kernels, buffers):
 
     kernels["k_init_memory"].set_args(
         buffers["global_map"],
+        buffers["global_map_shadow"],
         buffers["global_flock_pos_sum"],
         buffers["global_flock_vel_sum"],
         buffers["global_boid_avoidance_vectors"],
         buffers["global_agent_programmes"],
-        buffers["global_cmms"]
+        buffers["global_cmms"],
+        buffers["global_experiment"],
+        buffers["global_solved"]
     )
     kernels["k_update_map"].set_args(
         buffers["global_map"],
+        buffers["global_solved"],
         buffers["global_test"]
     )
+    kernels["k_list_map_changes"].set_args(
+        buffers["global_map"],
+        buffers["global_map_shadow"],
+        buffers["global_solved"],
+        buffers["global_iteration"],
+        buffers["global_map_changes_n"],
+        buffers["global_changed_nodes"],
+        buffers["global_changed_values"]
+    )
     kernels["k_agent_reynolds_rules13_preprocess"].set_args(
         buffers["global_generated_flocks"],
+        buffers["global_solved"],
         buffers["global_iteration"],
         buffers["global_flock_pos_sum"],
-        buffers["local_flock_pos_sum"],
         buffers["global_flock_vel_sum"],
-        buffers["local_flock_vel_sum"],
         buffers["global_test"]
     )
+    kernels["k_clear_cells"].set_args(
+        buffers["global_cell_heads"],
+        buffers["global_solved"]
+    )
+    kernels["k_bin_boids"].set_args(
+        buffers["global_generated_flocks"],
+        buffers["global_solved"],
+        buffers["global_iteration"],
+        buffers["global_cell_heads"],
+        buffers["global_boid_next"]
+    )
+    kernels["k_sort_cells"].set_args(
+        buffers["global_solved"],
+        buffers["global_cell_heads"],
+        buffers["global_boid_next"]
+    )
     kernels["k_agent_reynolds_rule2_preprocess"].set_args(
         buffers["global_generated_flocks"],
+        buffers["global_solved"],
         buffers["global_iteration"],
+        buffers["global_cell_heads"],
+        buffers["global_boid_next"],
         buffers["global_boid_avoidance_vectors"]
     )
     kernels["k_agent_ai_and_sim"].set_args(
         buffers["global_generated_flocks"],
+        buffers["global_solved"],
         buffers["global_map"],
         buffers["global_cmms"],
-        buffers["global_sensor_readings"],
+        buffers["global_maze"],
         buffers["global_flock_pos_sum"],
         buffers["local_flock_pos_sum"],
         buffers["global_flock_vel_sum"],
@@ -287,10 +724,44 @@ def set_kernel_arguments(kernels, buffers):
         buffers["local_iteration"],
         buffers["global_boid_avoidance_vectors"],
         buffers["global_agent_programmes"],
-        buffers["global_random"],
+        buffers["global_node_updates"],
+        np.uint32(random_key),
+        buffers["global_experiment"],
+        buffers["global_test"]
+    )
+    kernels["k_agent_step_fused"].set_args(
+        buffers["global_generated_flocks"],
+        buffers["global_solved"],
+        buffers["global_map"],
+        buffers["global_cmms"],
+        buffers["global_maze"],
+        buffers["global_iteration"],
+        buffers["global_agent_programmes"],
+        buffers["global_node_updates"],
+        np.uint32(random_key),
         buffers["global_experiment"],
         buffers["global_test"]
     )
+    kernels["k_apply_node_updates"].set_args(
+        buffers["global_map"],
+        buffers["global_solved"],
+        buffers["global_node_updates"]
+    )
+    kernels["k_detect_collisions"].set_args(
+        buffers["global_generated_flocks"],
+        buffers["global_solved"],
+        buffers["global_maze"],
+        buffers["global_triangle_rects"],
+        buffers["global_iteration"]
+    )
+    kernels["k_check_goal_reachability"].set_args(
+        buffers["global_map"],
+        buffers["global_maze"],
+        buffers["global_solved"],
+        buffers["global_iteration"],
+        buffers["global_reached_nodes"],
+        buffers["global_goal_reached"]
+    )
     kernels["k_update_values"].set_args(
         buffers["global_generated_flocks"],
         buffers["global_amendments_n"],
@@ -302,90 +773,214 @@ def set_kernel_arguments(kernels, buffers):
     )
 
 
-def prepare_device_memory(queue, kernels, buffers, flock):
+def prepare_device_memory(queue, kernels, buffers, first_flocks, amazes, template_triangles,
+                          state=None):
     """
-        Initializes device memory and transfers
-        first flocks from host to the device.
+        Initializes device memory and transfers the first flocks and the mazes of the
+        instances and the triangle rects for collision detection from host to the device.
+        The memory of a run saved by gpu_download_state() is uploaded over it, if given
     """
-    print("Initializing the memory and transferring the first flock.")
+    print("Initializing the memory and transferring the first flocks.")
     intermediary_events = [cl.enqueue_nd_range_kernel(
         queue, kernels["k_init_memory"], [1], [1]),
-        cl.enqueue_copy(queue, buffers["global_generated_flocks"], flock.np_arrays)]
+        cl.enqueue_copy(queue, buffers["global_generated_flocks"],
+                        np.array([flock.np_arrays for flock in first_flocks], dtype=np.float32)),
+        cl.enqueue_copy(queue, buffers["global_maze"],
+                        np.array([amaze.get_numeric_matrix() for amaze in amazes])),
+        cl.enqueue_copy(queue, buffers["global_triangle_rects"],
+                        get_triangle_rects(template_triangles))]
+    if state is not None:
+        print("Transferring the saved state.")
+        # The queue is in-order, so the uploads overwrite what k_init_memory has set
+        for name in STATE_BUFFERS:
+            intermediary_events.append(cl.enqueue_copy(queue, buffers[name], state[name]))
     return intermediary_events
 
 
-def update_map(queue, kernels, intermediary_events):
+def gpu_download_state(queue, buffers):
+    """ Downloads the memory of all the instances a run continues from (see STATE_BUFFERS) """
+    state = {}
+    for name, dtype in STATE_BUFFERS.items():
+        state[name] = np.empty(buffers[name].size // np.dtype(dtype).itemsize, dtype=dtype)
+        cl.enqueue_copy(queue, state[name], buffers[name])
+    queue.finish()
+    return state
+
+
+def get_triangle_rects(template_triangles):
+    """
+        Packs what collision detection needs of the template triangles: offset of the
+        triangle top left corner from the boid center and the size of the bounding rect
+    """
+    triangle_rects = np.zeros((len(template_triangles), 4), dtype=np.float32)
+    for i, triangle in enumerate(template_triangles):
+        triangle_rects[i, 0:2] = triangle.get_triangle_top_left()
+        triangle_rects[i, 2:4] = triangle.rect.size
+    return triangle_rects
+
+
+def update_map(queue, kernels, gpu_params, intermediary_events):
     """
         Updates map. Updating includes:
         - "Dissoluting" pheromones: pheromone level is reduced regularly to simulate ageing.
     """
-    intermediary_events.append(cl.enqueue_nd_range_kernel(
-        queue, kernels["k_update_map"], [1], [1]))
+    event = cl.enqueue_nd_range_kernel(queue, kernels["k_update_map"],
+                                       *get_map_work_sizes(gpu_params, "k_update_map"))
+    profiling.record("k_update_map", event)
+    intermediary_events.append(event)
+
 
+def get_map_work_sizes(gpu_params, kernel_name):
+    """ Global and local sizes for the kernels with one work item per map node and instance """
+    # Example workgroup/workitem pair: 1x21x1 groups of 64x1x1 items (21x21 maze, 1 instance)
+    local_size = gpu_params["local_sizes"][kernel_name]
+    return ((int(np.ceil(cfg.maze_width / local_size) * local_size),
+             cfg.maze_height, cfg.batch_instances),
+            (local_size, 1, 1))
 
-def gpu_generate_next_flock(step, queue, intermediary_events, kernels,
-                            gpu_params, buffers, flocks, global_map):
+
+def get_boids_work_sizes(gpu_params, kernel_name):
+    """ Global and local sizes for the kernels with one work item per boid and instance """
+    # Example workgroup/workitem pair: 7x1 groups of 64x1 items (400 boids, 1 instance)
+    local_size = gpu_params["local_sizes"][kernel_name]
+    return ((int(np.ceil(cfg.NumberOfBoids / local_size) * local_size), cfg.batch_instances),
+            (local_size, 1))
+
+
+def get_goal_check_work_sizes(gpu_params):
+    """ Global and local sizes of k_check_goal_reachability: a work group per instance """
+    local_size = gpu_params["local_sizes"]["k_check_goal_reachability"]
+    return (local_size, cfg.batch_instances), (local_size, 1)
+
+
+def get_map_change_slots():
+    """
+        Changed map nodes are listed (and flocks and goal checks are downloaded) into a slot
+        per step for all steps in flight: the batch handled by the host and the one enqueued ahead
+        (see OpenCLBackend.generate_flocks())
+    """
+    return 2 * cfg.steps_per_batch
+
+
+def list_map_changes(step, queue, kernels, gpu_params, buffers, events, wait_for=None):
+    """
+        Enqueues listing of the map nodes changed since the previous step. Returns the
+        offset of the lengths of the lists of the instances
+    """
+    slot_offset = (step % get_map_change_slots()) * cfg.batch_instances * \
+        np.dtype(np.int32).itemsize
+    events["transfer_map_changes_n_reset"] = cl.enqueue_fill_buffer(
+        queue, buffers["global_map_changes_n"], np.int32(0), slot_offset,
+        cfg.batch_instances * np.dtype(np.int32).itemsize, wait_for=wait_for)
+    events["k_list_map_changes"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_list_map_changes"],
+        *get_map_work_sizes(gpu_params, "k_list_map_changes"),
+        wait_for=[events["transfer_map_changes_n_reset"]])
+    return slot_offset
+
+
+def check_goal_reachability(step, queue, kernels, gpu_params, events, wait_for=None):
+    """
+        Enqueues the check whether the goal is reachable on the maps of the instances
+        (see cfg.backend_goal_check). Returns the offset of the results of the instances
+    """
+    events["k_check_goal_reachability"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_check_goal_reachability"], *get_goal_check_work_sizes(gpu_params),
+        wait_for=wait_for)
+    return (step % get_map_change_slots()) * cfg.batch_instances * np.dtype(np.uint8).itemsize
+
+
+def gpu_download_map_changes(step, queue, buffers, map_changes_n, current_maps, global_maps):
+    """
+        Downloads the lists of the map nodes changed in the steps starting from "step"
+        (map_changes_n holds their lengths per step and instance) and patches them into
+        current_maps, the maps of the instances at the previous step. The maps of every
+        step are put into the histories of the instances in global_maps
+    """
+    nodes_n = cfg.maze_width * cfg.maze_height
+    changes = []
+    transfer_events = []
+    for i, instances_changes_n in enumerate(map_changes_n):
+        slot = (step + i) % get_map_change_slots()
+        for instance, changes_n in enumerate(instances_changes_n):
+            list_i = slot * cfg.batch_instances + instance
+            changed_nodes = np.empty(changes_n, dtype=np.int32)
+            changed_values = np.empty(changes_n, dtype=maze.get_node_dtype())
+            changes.append((i, instance, changed_nodes, changed_values))
+            if changes_n == 0:
+                continue
+            events = {}
+            events["transfer_changed_nodes"] = cl.enqueue_copy(
+                queue, changed_nodes, buffers["global_changed_nodes"],
+                src_offset=list_i * nodes_n * np.dtype(np.int32).itemsize, is_blocking=False)
+            events["transfer_changed_values"] = cl.enqueue_copy(
+                queue, changed_values, buffers["global_changed_values"],
+                src_offset=list_i * nodes_n * cfg.NODE_SIZE, is_blocking=False)
+            transfer_events += events.values()
+            record_events(events)
+    if transfer_events:
+        cl.wait_for_events(transfer_events)
+
+    for i, instance, changed_nodes, changed_values in changes:
+        current_maps[instance].reshape(nodes_n)[changed_nodes] = changed_values
+        global_maps[instance][step + i] = current_maps[instance]
+
+
+def gpu_generate_next_flock(step, queue, intermediary_events, kernels, gpu_params, buffers,
+                            flocks, current_maps, global_maps, host_flocks, slot_flocks,
+                            history_flocks, goal_reached, detect_collisions):
     """
         Does one iteration of the computation. To be called in the increasing continuous
-        order of the integer "step" argument
+        order of the integer "step" argument. If detect_collisions is set, collisions
+        are detected on the device. The flock is downloaded into a slot of host_flocks
+        and appended from there (see append_flocks()), the goal check
+        (cfg.backend_goal_check) is downloaded into goal_reached[step].
+        Steps are computed one by one for a single instance only (see simulator.run())
         """
-    # Prepare memory for the generated flock
-    new_flock = agents.Flock(cfg.NumberOfBoids)
-    new_flock.init_empty_array()
+    host_flock = host_flocks[step % get_map_change_slots()]
 
     events = {}
 
     # Transfer the iteration number
     iteration = np.uint16(step)
-    intermediary_events.append(cl.enqueue_copy(queue, buffers["global_iteration"], iteration))
-
-    # Transfer the random number
-    random = np.float32(np.random.rand(1) * 2 * np.pi)
-    intermediary_events.append(cl.enqueue_copy(queue, buffers["global_random"], random))
+    events["transfer_iteration"] = cl.enqueue_copy(queue, buffers["global_iteration"], iteration)
+    intermediary_events.append(events["transfer_iteration"])
 
     # -------------------------------------------------------------------------
 
-    # Example workgroup/workitem pair: 7 groups of 64 items (400 boids)
-    events["k_agent_reynolds_rules13_preprocess"] = cl.enqueue_nd_range_kernel(
-        queue, kernels["k_agent_reynolds_rules13_preprocess"],
-        (int(np.ceil(cfg.NumberOfBoids / gpu_params["preferred_multiple"]) *
-             gpu_params["preferred_multiple"]),),
-        (gpu_params["preferred_multiple"],), global_work_offset=None,
-        wait_for=intermediary_events)
-
-    # Example workgroup/workitem pair: 625 groups of 256 items (400x400 boids)
-    events["k_agent_reynolds_rule2_preprocess"] = cl.enqueue_nd_range_kernel(
-        queue, kernels["k_agent_reynolds_rule2_preprocess"],
-        (int(np.ceil(np.square(cfg.NumberOfBoids) / gpu_params["max_work_group_size"]) *
-             gpu_params["max_work_group_size"]),),
-        (gpu_params["max_work_group_size"],), global_work_offset=None,
-        wait_for=intermediary_events)
+    agent_step_event = enqueue_agent_step(queue, kernels, gpu_params, events,
+                                          wait_for=intermediary_events)
+    flock_ready_event = agent_step_event
 
-    # Example workgroup/workitem pair: 7 groups of 64 items (400 boids)
-    events["k_agent_ai_and_sim"] = cl.enqueue_nd_range_kernel(
-        queue, kernels["k_agent_ai_and_sim"],
-        (int(np.ceil(cfg.NumberOfBoids / gpu_params["preferred_multiple"]) *
-             gpu_params["preferred_multiple"]),),
-        (gpu_params["preferred_multiple"],), global_work_offset=None,
-        wait_for=[events["k_agent_reynolds_rules13_preprocess"],
-                  events["k_agent_reynolds_rule2_preprocess"]])
+    if detect_collisions:
+        events["k_detect_collisions"] = cl.enqueue_nd_range_kernel(
+            queue, kernels["k_detect_collisions"],
+            *get_boids_work_sizes(gpu_params, "k_detect_collisions"),
+            global_work_offset=None, wait_for=[agent_step_event])
+        flock_ready_event = events["k_detect_collisions"]
 
     # transfer device -> host -------------------------------------------------
     # Second parameter size defines transfer size
     events["transfer_flocks"] = cl.enqueue_copy(
-        queue, new_flock.np_arrays, buffers["global_generated_flocks"],
-        device_offset=step * cfg.NumberOfBoids * agents.Boid.arraySize,
-        wait_for=[events["k_agent_ai_and_sim"]])
+        queue, host_flock, buffers["global_generated_flocks"],
+        src_offset=(step % cfg.flock_ring_length) * host_flock.nbytes,
+        wait_for=[flock_ready_event])
     if cfg.track_map_changes:
-        events["transfer_map"] = cl.enqueue_copy(
-            queue, global_map[step], buffers["global_map"],
-            wait_for=[events["k_agent_ai_and_sim"]])
-    else:
-        events["transfer_map"] = None
-
-    cl.wait_for_events([events["transfer_flocks"], events["transfer_map"]])
-    # print(new_flock.np_arrays)
-    flocks.append(new_flock)
+        map_changes_n = np.zeros((1, cfg.batch_instances), dtype=np.int32)
+        slot_offset = list_map_changes(step, queue, kernels, gpu_params, buffers, events,
+                                       wait_for=[agent_step_event])
+        events["transfer_map_changes_n"] = cl.enqueue_copy(
+            queue, map_changes_n, buffers["global_map_changes_n"], src_offset=slot_offset,
+            wait_for=[events["k_list_map_changes"]])
+        gpu_download_map_changes(step, queue, buffers, map_changes_n, current_maps,
+                                 global_maps)
+    if cfg.backend_goal_check:
+        result_offset = check_goal_reachability(step, queue, kernels, gpu_params, events,
+                                                wait_for=[agent_step_event])
+        events["transfer_goal_reached"] = cl.enqueue_copy(
+            queue, goal_reached[step], buffers["global_goal_reached"],
+            src_offset=result_offset, wait_for=[events["k_check_goal_reachability"]])
+    append_flocks(step, [flocks], slot_flocks, history_flocks)
 
     # TEST
     if cfg.debug_on:
@@ -398,6 +993,157 @@ def gpu_generate_next_flock(step, queue, intermediary_events, kernels,
         print(s)
     # -------------------------------------------------------------------------
 
+    record_events(events)
+
+
+def enqueue_agent_step(queue, kernels, gpu_params, events, wait_for=None):
+    """
+        Enqueues the kernels computing the next flock from the previous one: Reynolds
+        rules and the agents' AI and locomotion, either in separate kernels or in
+        k_agent_step_fused (see cfg.fused_agent_step), followed by the updates of the
+        nodes the agents are on. Their events are put into events.
+        Returns the event of the last one
+    """
+    if cfg.fused_agent_step:
+        events["k_agent_step_fused"] = cl.enqueue_nd_range_kernel(
+            queue, kernels["k_agent_step_fused"],
+            *get_boids_work_sizes(gpu_params, "k_agent_step_fused"),
+            global_work_offset=None, wait_for=wait_for)
+        return enqueue_node_updates(queue, kernels, gpu_params, events,
+                                    events["k_agent_step_fused"])
+
+    events["k_agent_reynolds_rules13_preprocess"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_agent_reynolds_rules13_preprocess"],
+        *get_boids_work_sizes(gpu_params, "k_agent_reynolds_rules13_preprocess"),
+        global_work_offset=None, wait_for=wait_for)
+
+    # Neighbour search for rule 2 goes through the cell lists of the previous flock
+    events["k_clear_cells"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_clear_cells"],
+        *get_map_work_sizes(gpu_params, "k_clear_cells"),
+        wait_for=wait_for)
+    events["k_bin_boids"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_bin_boids"],
+        *get_boids_work_sizes(gpu_params, "k_bin_boids"),
+        global_work_offset=None, wait_for=[events["k_clear_cells"]])
+    # Boids are binned in any order, so the lists are sorted for reproducible sums
+    events["k_sort_cells"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_sort_cells"],
+        *get_map_work_sizes(gpu_params, "k_sort_cells"),
+        wait_for=[events["k_bin_boids"]])
+    events["k_agent_reynolds_rule2_preprocess"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_agent_reynolds_rule2_preprocess"],
+        *get_boids_work_sizes(gpu_params, "k_agent_reynolds_rule2_preprocess"),
+        global_work_offset=None, wait_for=[events["k_sort_cells"]])
+
+    events["k_agent_ai_and_sim"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_agent_ai_and_sim"],
+        *get_boids_work_sizes(gpu_params, "k_agent_ai_and_sim"),
+        global_work_offset=None,
+        wait_for=[events["k_agent_reynolds_rules13_preprocess"],
+                  events["k_agent_reynolds_rule2_preprocess"]])
+    return enqueue_node_updates(queue, kernels, gpu_params, events, events["k_agent_ai_and_sim"])
+
+
+def enqueue_node_updates(queue, kernels, gpu_params, events, agent_event):
+    """
+        Enqueues k_apply_node_updates after the agent kernel (agent_event). Agents only
+        record their updates of the nodes they are on, so that the updates are applied
+        in the order of the boids, whatever the order of the work items.
+        Returns its event
+    """
+    events["k_apply_node_updates"] = cl.enqueue_nd_range_kernel(
+        queue, kernels["k_apply_node_updates"],
+        *get_map_work_sizes(gpu_params, "k_apply_node_updates"),
+        wait_for=[agent_event])
+    return events["k_apply_node_updates"]
+
+
+def record_events(events):
+    """ Records events named after kernels or transfers ("transfer_...") for profiling """
+    for name, event in events.items():
+        profiling.record(name, event,
+                         profiling.TRANSFER if name.startswith("transfer") else profiling.KERNEL)
+
+
+def gpu_enqueue_flocks(step, steps_n, queue, transfer_queue, kernels, gpu_params, buffers,
+                       host_flocks, detect_collisions, staging_events):
+    """
+        Enqueues steps_n iterations of all the instances starting from "step" without
+        waiting for them. Collisions are detected on the device, if requested. The queues
+        are in-order, so each command starts after the previous one on the same queue is
+        finished. Results of each step are copied to a staging slot on the device and
+        downloaded from there on transfer_queue, so the download of one step overlaps the
+        kernels of the next one. A slot is reused every second step, after its previous
+        downloads (staging_events[slot], updated here) are finished.
+        The flocks are downloaded into the slots of host_flocks of their steps. Of the map,
+        only the lengths of the lists of the changed nodes and the goal checks
+        (cfg.backend_goal_check) are downloaded.
+        Returns the lengths, the goal checks, the events of the downloads and the host
+        arrays which must stay alive until the non-blocking transfers are finished
+    """
+    iterations = np.arange(step, step + steps_n, dtype=np.uint16)
+    map_changes_n = np.zeros((steps_n, cfg.batch_instances), dtype=np.int32)
+    goal_reached = np.zeros((steps_n, cfg.batch_instances), dtype=np.uint8)
+    # A step holds the flocks of all the instances
+    flocks_size = cfg.batch_instances * cfg.NumberOfBoids * agents.Boid.arraySize
+
+    transfer_events = []
+    for i in range(steps_n):
+        events = {}
+        events["transfer_iteration"] = cl.enqueue_copy(
+            queue, buffers["global_iteration"], iterations[i:i + 1], is_blocking=False)
+
+        enqueue_agent_step(queue, kernels, gpu_params, events)
+
+        # Simulation response
+        if detect_collisions:
+            events["k_detect_collisions"] = cl.enqueue_nd_range_kernel(
+                queue, kernels["k_detect_collisions"],
+                *get_boids_work_sizes(gpu_params, "k_detect_collisions"))
+
+        # Copy the results to the staging slot, once its previous downloads are finished
+        slot = (step + i) % 2
+        events["transfer_flocks_staging"] = cl.enqueue_copy(
+            queue, buffers["staging_flocks"], buffers["global_generated_flocks"],
+            byte_count=flocks_size, src_offset=((step + i) % cfg.flock_ring_length) * flocks_size,
+            dst_offset=slot * flocks_size, wait_for=staging_events[slot])
+        events["transfer_flocks"] = cl.enqueue_copy(
+            transfer_queue, host_flocks[(step + i) % get_map_change_slots()],
+            buffers["staging_flocks"],
+            src_offset=slot * flocks_size, is_blocking=False,
+            wait_for=[events["transfer_flocks_staging"]])
+        staging_events[slot] = [events["transfer_flocks"]]
+        transfer_events.append(events["transfer_flocks"])
+        if cfg.track_map_changes:
+            # The lists are downloaded by gpu_download_map_changes() once their
+            # lengths are known
+            slot_offset = list_map_changes(step + i, queue, kernels, gpu_params, buffers, events)
+            events["transfer_map_changes_n"] = cl.enqueue_copy(
+                transfer_queue, map_changes_n[i], buffers["global_map_changes_n"],
+                src_offset=slot_offset, is_blocking=False,
+                wait_for=[events["k_list_map_changes"]])
+            transfer_events.append(events["transfer_map_changes_n"])
+        if cfg.backend_goal_check:
+            # The map is checked before the pheromones are dissoluted, as it is listed
+            result_offset = check_goal_reachability(step + i, queue, kernels, gpu_params,
+                                                    events)
+            events["transfer_goal_reached"] = cl.enqueue_copy(
+                transfer_queue, goal_reached[i], buffers["global_goal_reached"],
+                src_offset=result_offset, is_blocking=False,
+                wait_for=[events["k_check_goal_reachability"]])
+            transfer_events.append(events["transfer_goal_reached"])
+
+        events["k_update_map"] = cl.enqueue_nd_range_kernel(
+            queue, kernels["k_update_map"],
+            *get_map_work_sizes(gpu_params, "k_update_map"))
+        record_events(events)
+
+    # Start the commands without waiting for anything
+    queue.flush()
+    transfer_queue.flush()
+    return map_changes_n, goal_reached, transfer_events, (iterations,)
+
 
 def gpu_amend_values(queue, kernels, gpu_params, buffers, amendments):
     """
@@ -407,78 +1153,205 @@ def gpu_amend_values(queue, kernels, gpu_params, buffers, amendments):
     intermediary_events = []
     packet = amendments.get_packet()
     if packet[amendments.amount_i] > 0:
-        events = [
-            cl.enqueue_copy(queue, buffers["global_amendments_n"],
-                            packet[amendments.amount_i]),
-            cl.enqueue_copy(queue, buffers["global_amendment_indices"],
-                            packet[amendments.indices_i]),
-            cl.enqueue_copy(queue, buffers["global_amendment_values"],
-                            packet[amendments.values_i])]
-
-        # X groups of 64 items (amendments.amount work items)
-        intermediary_events.append(
-            cl.enqueue_nd_range_kernel(
-                queue, kernels["k_update_values"],
-                (int(np.ceil(amendments.amount / gpu_params["preferred_multiple"]) *
-                     gpu_params["preferred_multiple"]),),
-                (gpu_params["preferred_multiple"],), global_work_offset=None,
-                wait_for=events))
+        events = {}
+        events["transfer_amendments_n"] = cl.enqueue_copy(
+            queue, buffers["global_amendments_n"], packet[amendments.amount_i])
+        events["transfer_amendment_indices"] = cl.enqueue_copy(
+            queue, buffers["global_amendment_indices"], packet[amendments.indices_i])
+        events["transfer_amendment_values"] = cl.enqueue_copy(
+            queue, buffers["global_amendment_values"], packet[amendments.values_i])
+
+        # X groups of local size items (amendments.amount work items)
+        events["k_update_values"] = cl.enqueue_nd_range_kernel(
+            queue, kernels["k_update_values"],
+            (int(np.ceil(amendments.amount / gpu_params["local_sizes"]["k_update_values"]) *
+                 gpu_params["local_sizes"]["k_update_values"]),),
+            (gpu_params["local_sizes"]["k_update_values"],), global_work_offset=None,
+            wait_for=list(events.values()))
+        intermediary_events.append(events["k_update_values"])
+        record_events(events)
     return intermediary_events
 
 
-def standardize_values(flock):
-    """
-    OpenCL may return values that are smaller than Python's minimum resolution.
-    Python treats them as NoN. This function makes them equal to zero.
-    """
-    for boid in flock.np_arrays:
-        for i in range(len(boid)):
-            try:
-                if np.isnan(boid[i]) or np.isinf(boid[i]):
-                    boid[i] = 0
-            except:
-                boid[i] = 0
+def gpu_set_solved(queue, buffers, instance):
+    """ Raises the termination flag of the instance, so the kernels enqueued next skip it """
+    event = cl.enqueue_copy(queue, buffers["global_solved"], np.ones(1, dtype=np.uint8),
+                            dst_offset=instance * np.dtype(np.uint8).itemsize)
+    profiling.record("transfer_solved", event, profiling.TRANSFER)
+
 
+def get_experiment_data(queue, buffers):
+    global_experiment = np.zeros((cfg.batch_instances, cfg.NumberOfBoids, cfg.EXP_SIZE),
+                                 dtype=np.float32)
+    cl.enqueue_copy(queue, global_experiment, buffers["global_experiment"])
+    return global_experiment
 
-def gpu_transfer_readings(queue, buffers,
-                          sensor_readings, intermediary_events):
+
+class OpenCLBackend:
     """
-    Transfers the readings calculated by the simulation to the boids on GPU.
+        Simulation backend running the agents on an OpenCL device. It computes
+        cfg.batch_instances instances together, see simulator.run_batch()
     """
-    # Convert the list into a packet
-    packet = np.zeros((cfg.NumberOfBoids, 5), dtype=np.uint8)
-    for i in range(cfg.NumberOfBoids):
-        # When a reading is None it means that it is a border of the maze
-        if sensor_readings[i].northern_reading is not None:
-            packet[i][0] = sensor_readings[i].northern_reading.get_numeric_value()
-        else:
-            packet[i][0] = maze.Wall.normal.value
-        if sensor_readings[i].eastern_reading is not None:
-            packet[i][1] = sensor_readings[i].eastern_reading.get_numeric_value()
-        else:
-            packet[i][1] = maze.Wall.normal.value
-        if sensor_readings[i].southern_reading is not None:
-            packet[i][2] = sensor_readings[i].southern_reading.get_numeric_value()
-        else:
-            packet[i][2] = maze.Wall.normal.value
-        if sensor_readings[i].western_reading is not None:
-            packet[i][3] = sensor_readings[i].western_reading.get_numeric_value()
-        else:
-            packet[i][3] = maze.Wall.normal.value
-        """if sensor_readings[i].bottom_reading is not None:
-            packet[i][4] = 1
+    name = "OpenCL"
+    runs_batches = True
+
+    def __init__(self, context, device, queue):
+        self.context = context
+        self.device = device
+        self.queue = queue
+        # Results computed in batches are downloaded on a queue of their own
+        self.transfer_queue = create_queue(context)
+        # Download events of the two staging slots and the batch enqueued ahead
+        self.staging_events = [[], []]
+        self.next_batch = None
+        self.kernels = None
+        self.gpu_params = None
+        # Work group sizes to build the program with instead of the tuned ones
+        self.local_sizes = None
+        self.buffers = None
+        self.host_flocks = None
+        # Flocks viewing the slots of host_flocks and those of the histories kept in memory
+        self.slot_flocks = None
+        self.history_flocks = None
+        # Maps of the instances at the last downloaded step and their histories
+        self.current_maps = None
+        self.global_maps = None
+        # Goal checks of the steps (see cfg.backend_goal_check) by instance
+        self.goal_reached = None
+        # Last steps of the solved instances
+        self.end_steps = {}
+        self.intermediary_events = []
+        # Key of the random numbers of the agents
+        self.random_key = None
+        # Collided boids are only marked for rendering by the collision detection
+        # on the host, so it is kept there when bounding rects are shown
+        self.detects_collisions = cfg.collision_detection_on and \
+            not (cfg.bounding_rects_show and cfg.steps_per_batch == 1 and
+                 cfg.batch_instances == 1)
+
+    def prepare(self, first_flock, amaze, template_triangles, state=None):
+        """
+            Builds the program and prepares the memory. A run saved by get_state() is
+            continued, if its state is given. Returns the map history (see
+            recorder.create_map_history())
+        """
+        return self.prepare_batch([first_flock], [amaze], template_triangles, state)[0]
+
+    def prepare_batch(self, first_flocks, amazes, template_triangles, state=None):
+        """ Like prepare() for cfg.batch_instances instances. Returns their map histories """
+        if len(amazes) != cfg.batch_instances:
+            raise ValueError("%d instances are given, but the program is built for %d "
+                             "(cfg.batch_instances)" % (len(amazes), cfg.batch_instances))
+        self.kernels, self.gpu_params = build_opencl_program(self.context, self.device,
+                                                             self.local_sizes)
+        self.buffers, self.host_flocks = prepare_host_memory(self.context, self.queue)
+        self.slot_flocks = create_slot_flocks(self.host_flocks)
+        if cfg.record_on:
+            self.history_flocks = [None] * cfg.batch_instances
         else:
-            packet[i][4] = 0"""
-        if sensor_readings[i].bottom_reading is not None:
-            packet[i][4] = sensor_readings[i].bottom_reading.get_numeric_value()
+            self.history_flocks = create_history_flocks()
+        self.random_key = agents.get_random_seed() if state is None else state["random_key"]
+        set_kernel_arguments(self.kernels, self.buffers, self.random_key)
+        self.intermediary_events = prepare_device_memory(self.queue, self.kernels,
+                                                         self.buffers, first_flocks, amazes,
+                                                         template_triangles, state)
+        self.global_maps = [recorder.create_map_history(instance)
+                            for instance in range(cfg.batch_instances)]
+        self.goal_reached = np.zeros((cfg.total_timesteps, cfg.batch_instances), dtype=np.uint8)
+        if cfg.track_map_changes:
+            maps_shape = (cfg.batch_instances, cfg.maze_width, cfg.maze_height)
+            if state is None:
+                self.current_maps = np.zeros(maps_shape, dtype=maze.get_node_dtype())
+            else:
+                # The shadow is the map of the last downloaded step
+                self.current_maps = state["global_map_shadow"].view(
+                    maze.get_node_dtype()).reshape(maps_shape).copy()
+        return self.global_maps
+
+    def amend_values(self, amendments):
+        self.intermediary_events = gpu_amend_values(self.queue, self.kernels, self.gpu_params,
+                                                    self.buffers, amendments)
+
+    def update_map(self):
+        update_map(self.queue, self.kernels, self.gpu_params, self.intermediary_events)
+
+    def generate_next_flock(self, step, flocks, global_map):
+        gpu_generate_next_flock(step, self.queue, self.intermediary_events, self.kernels,
+                                self.gpu_params, self.buffers, flocks, self.current_maps,
+                                self.global_maps, self.host_flocks, self.slot_flocks,
+                                self.history_flocks, self.goal_reached, self.detects_collisions)
+
+    def generate_flocks(self, step, steps_n, flocks, global_map, work_ahead=True):
+        self.generate_batch(step, steps_n, [flocks], work_ahead)
+
+    def generate_batch(self, step, steps_n, instances_flocks, work_ahead=True):
+        """
+            Takes the batch enqueued by the previous call (or enqueues it) and enqueues
+            the following one before waiting for the downloads, so the device computes
+            the next batch while the host handles this one. Without work_ahead, the device
+            stops at the end of this batch (e.g. for get_state()). The flocks of every
+            instance are appended to its history in instances_flocks, the maps to the
+            histories returned by prepare_batch()
+        """
+        if self.next_batch is None:
+            self.next_batch = self.enqueue_flocks(step, steps_n)
+        # The host arrays are kept referenced until the transfers are finished
+        map_changes_n, goal_reached, transfer_events, host_arrays = self.next_batch
+
+        next_step = step + steps_n
+        if next_step < cfg.total_timesteps and work_ahead:
+            self.next_batch = self.enqueue_flocks(
+                next_step, min(steps_n, cfg.total_timesteps - next_step))
         else:
-            packet[i][4] = maze.Passage.normal.value
-
-    intermediary_events.append(
-        cl.enqueue_copy(queue, buffers["global_sensor_readings"], packet))
-
-
-def get_experiment_data(queue, buffers):
-    global_experiment = np.zeros((cfg.NumberOfBoids, cfg.EXP_SIZE), dtype=np.float32)
-    cl.enqueue_copy(queue, global_experiment, buffers["global_experiment"])
-    return global_experiment
+            self.next_batch = None
+
+        cl.wait_for_events(transfer_events)
+        self.goal_reached[step:step + steps_n] = goal_reached
+        if cfg.track_map_changes:
+            gpu_download_map_changes(step, self.transfer_queue, self.buffers, map_changes_n,
+                                     self.current_maps, self.global_maps)
+        # The slots of host_flocks are reused by the following batches
+        for i in range(steps_n):
+            append_flocks(step + i, instances_flocks, self.slot_flocks, self.history_flocks)
+        self.intermediary_events = []
+
+    def enqueue_flocks(self, step, steps_n):
+        return gpu_enqueue_flocks(step, steps_n, self.queue, self.transfer_queue, self.kernels,
+                                  self.gpu_params, self.buffers, self.host_flocks,
+                                  self.detects_collisions, self.staging_events)
+
+    def get_state(self):
+        """
+            Returns the device memory and the random key the run continues from with
+            prepare(). Steps must not be computed ahead (see generate_batch())
+        """
+        if self.next_batch is not None:
+            raise RuntimeError("The state is saved while a batch is computed ahead")
+        self.transfer_queue.finish()
+        state = gpu_download_state(self.queue, self.buffers)
+        state["random_key"] = self.random_key
+        return state
+
+    def is_goal_reachable(self, step, instance=0):
+        """
+            Whether the goal is reachable on the map of the instance at the given step, as
+            checked on the device (see cfg.backend_goal_check). The maze can only be solved
+            if it is
+        """
+        return bool(self.goal_reached[step, instance])
+
+    def set_solved(self, instance, step):
+        """ Stops computing the instance solved at the given step """
+        self.end_steps[instance] = step
+        gpu_set_solved(self.queue, self.buffers, instance)
+
+    def get_experiment_data(self, instance=0):
+        experiment_data = get_experiment_data(self.queue, self.buffers)[instance]
+        self.queue.finish()
+        # Hits of the steps enqueued ahead past the end of the simulation don't count
+        end_step = self.end_steps.get(instance, cfg.total_timesteps - 1)
+        hits = experiment_data[:, cfg.EXP_BOID_HITS_VAR:]
+        late_hits = hits > end_step
+        experiment_data[:, cfg.EXP_BOID_HIT_COUNT_VAR] -= late_hits.sum(axis=1)
+        hits[late_hits] = 0
+        return experiment_data
@@ -0,0 +1,55 @@
+"""
+profiling.py collects timings of OpenCL commands (kernels and transfers) when
+cfg.profiling_on is set and reports them at the end of the simulation.
+"""
+
+import numpy as np
+
+import configs as cfg
+
+# Command kinds
+KERNEL = "kernel"
+TRANSFER = "transfer"
+
+# Recorded (kind, name, event) triples. Timings are read from the events
+# only when reporting, so that recording doesn't wait for the device
+events = []
+
+
+def record(name, event, kind=KERNEL):
+    """ Records an event of a command enqueued on a queue with profiling enabled """
+    if cfg.profiling_on and event is not None:
+        events.append((kind, name, event))
+
+
+def get_durations():
+    """ Returns durations of the recorded commands in ms as {(kind, name): array} """
+    durations = {}
+    for kind, name, event in events:
+        event.wait()
+        durations.setdefault((kind, name), []).append(
+            (event.profile.end - event.profile.start) * 1e-6)
+    return {key: np.array(value) for key, value in durations.items()}
+
+
+def report():
+    """ Prints totals, means and percentiles per kernel and per transfer """
+    durations = get_durations()
+    if not durations:
+        print("No OpenCL commands have been profiled.")
+        return
+
+    print("OpenCL profiling [ms]:")
+    row = "{0:<9} {1:<36} {2:>7} {3:>10} {4:>8} {5:>8} {6:>8} {7:>8} {8:>8}"
+    print(row.format("Kind", "Name", "Count", "Total", "Mean", "p50", "p90", "p99", "Max"))
+    kind_totals = {}
+    for (kind, name), values in sorted(durations.items(), key=lambda item: -item[1].sum()):
+        kind_totals[kind] = kind_totals.get(kind, 0) + values.sum()
+        print(row.format(kind, name, len(values),
+                         "%.3f" % values.sum(), "%.3f" % values.mean(),
+                         "%.3f" % np.percentile(values, 50),
+                         "%.3f" % np.percentile(values, 90),
+                         "%.3f" % np.percentile(values, 99),
+                         "%.3f" % values.max()))
+    for kind in sorted(kind_totals):
+        print("Total of %s commands: %.3f" % (kind, kind_totals[kind]))
@@ -0,0 +1,234 @@
+"""
+recorder.py streams the flocks and the maps of a run to disk as they are computed, when
+cfg.record_on is set, so that host memory doesn't grow with the length of the run. Every
+history (the flocks or the maps of an instance) is a directory of chunks of
+cfg.record_chunk_steps steps in .npy files. Only a window of the latest chunks is kept
+in memory. The histories are read like the lists of flocks and the map arrays kept in
+memory otherwise (see create_flock_history() and create_map_history()), so the simulator,
+the solver and the renderer don't tell them apart.
+"""
+import os
+
+import numpy as np
+
+import configs as cfg
+import agents
+import maze
+
+
+class ChunkedSteps:
+    """
+    Array of the steps of a run, saved in chunks of cfg.record_chunk_steps steps into
+    <cfg.record_dir>/<name>/<chunk index>.npy. The latest cfg.record_window_chunks chunks
+    (at least enough for a batch of cfg.steps_per_batch steps) are kept in memory, and
+    their steps can still be changed. Older chunks are saved once they leave the window,
+    and their steps are read from the memory-mapped files. Steps are appended in order,
+    by append() or by assigning the step after the last one
+    """
+
+    def __init__(self, name, step_shape, dtype):
+        self.path = os.path.join(os.getcwd(), cfg.record_dir, name)
+        self.step_shape = tuple(step_shape)
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.window_chunks = max(cfg.record_window_chunks,
+                                 cfg.steps_per_batch // cfg.record_chunk_steps + 2)
+        # Chunks in the window by their indices
+        self.chunks = {}
+        # The saved chunk read last
+        self.mapped_index = None
+        self.mapped_chunk = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def __len__(self):
+        return self.length
+
+    def get_chunk_url(self, index):
+        return os.path.join(self.path, "%06d.npy" % index)
+
+    def get_location(self, step):
+        """ Returns the chunk index and the offset in the chunk of an existing step """
+        if step < 0:
+            step += self.length
+        if not 0 <= step < self.length:
+            raise IndexError("Step %d is out of the %d recorded steps" % (step, self.length))
+        return divmod(step, cfg.record_chunk_steps)
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return np.array([self[i] for i in range(*step.indices(len(self)))],
+                            dtype=self.dtype).reshape((-1,) + self.step_shape)
+        index, offset = self.get_location(step)
+        if index in self.chunks:
+            return self.chunks[index][offset]
+        if index != self.mapped_index:
+            self.mapped_chunk = np.load(self.get_chunk_url(index), mmap_mode="r")
+            self.mapped_index = index
+        return self.mapped_chunk[offset]
+
+    def __setitem__(self, step, values):
+        if step == self.length:
+            self.append(values)
+            return
+        index, offset = self.get_location(step)
+        if index not in self.chunks:
+            raise IndexError("Step %d has left the window and is saved already" % step)
+        self.chunks[index][offset] = values
+
+    def append(self, values):
+        index, offset = divmod(self.length, cfg.record_chunk_steps)
+        if offset == 0:
+            self.chunks[index] = np.zeros((cfg.record_chunk_steps,) + self.step_shape,
+                                          dtype=self.dtype)
+            for old_index in sorted(self.chunks)[:-self.window_chunks]:
+                self.save_chunk(old_index)
+                del self.chunks[old_index]
+        self.chunks[index][offset] = values
+        self.length += 1
+
+    def save_chunk(self, index):
+        """ Saves the steps of the chunk recorded so far """
+        steps_n = min(self.length - index * cfg.record_chunk_steps, cfg.record_chunk_steps)
+        np.save(self.get_chunk_url(index), self.chunks[index][:steps_n])
+        if index == self.mapped_index:
+            self.mapped_index = self.mapped_chunk = None
+
+    def flush(self):
+        """
+        Saves the chunks in the window as well (they stay in memory) and removes the
+        chunks past the last step left by a longer recording
+        """
+        for index in self.chunks:
+            self.save_chunk(index)
+        index = (self.length + cfg.record_chunk_steps - 1) // cfg.record_chunk_steps
+        while os.path.exists(self.get_chunk_url(index)):
+            os.remove(self.get_chunk_url(index))
+            index += 1
+
+    def __delitem__(self, steps):
+        """ Only the last steps can be deleted, e.g. del global_map[completion_time:] """
+        if not isinstance(steps, slice) or steps.stop is not None or steps.step is not None:
+            raise IndexError("Only the steps from a step on can be deleted from the history")
+        self.truncate(steps.indices(len(self))[0])
+
+    def truncate(self, length):
+        """ Drops the steps from "length" on. The last chunk left is loaded into the window """
+        self.length = min(self.length, length)
+        last_index = (self.length - 1) // cfg.record_chunk_steps
+        for index in [index for index in self.chunks if index > last_index]:
+            del self.chunks[index]
+        if self.length > 0 and last_index not in self.chunks:
+            chunk = np.zeros((cfg.record_chunk_steps,) + self.step_shape, dtype=self.dtype)
+            saved_chunk = np.load(self.get_chunk_url(last_index))
+            steps_n = self.length - last_index * cfg.record_chunk_steps
+            chunk[:steps_n] = saved_chunk[:steps_n]
+            self.chunks[last_index] = chunk
+        self.mapped_index = self.mapped_chunk = None
+
+    def restore(self, length):
+        """ Continues the recording saved by flush() from its first "length" steps """
+        self.chunks = {}
+        self.length = length
+        self.truncate(length)
+
+
+class FlockHistory:
+    """
+    The flocks of a run recorded in ChunkedSteps, used like the list of agents.Flock kept
+    in memory otherwise. Appended flocks are copied in. The flocks read are views of the
+    chunks, so those in the window can still be amended (e.g. by the collision detection).
+    Collision marks of the boids (cfg.bounding_rects_show) are not recorded
+    """
+
+    def __init__(self, name):
+        self.steps = ChunkedSteps(name, (cfg.NumberOfBoids, agents.Boid.arrayLen), np.float32)
+        # The flock read last, so reading the same step again doesn't create another one
+        self.last_step = None
+        self.last_flock = None
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        for step in range(len(self)):
+            yield self[step]
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return [self[i] for i in range(*step.indices(len(self)))]
+        if step < 0:
+            step += len(self)
+        if step != self.last_step:
+            self.last_flock = agents.Flock(cfg.NumberOfBoids)
+            self.last_flock.np_arrays = self.steps[step]
+            self.last_step = step
+        return self.last_flock
+
+    def __delitem__(self, steps):
+        """ Only the last steps can be deleted, e.g. del flocks[completion_time:] """
+        if not isinstance(steps, slice) or steps.stop is not None or steps.step is not None:
+            raise IndexError("Only the steps from a step on can be deleted from the history")
+        self.steps.truncate(steps.indices(len(self))[0])
+        self.last_step = self.last_flock = None
+
+    def append(self, flock):
+        self.steps.append(flock.np_arrays)
+
+    def extend(self, flocks):
+        for flock in flocks:
+            self.append(flock)
+
+    def flush(self):
+        self.steps.flush()
+
+    def restore(self, length):
+        self.steps.restore(length)
+        self.last_step = self.last_flock = None
+
+
+def create_flock_history(flocks, instance=0):
+    """
+    Returns the flock history of an instance, starting with the given flocks: a recording
+    if cfg.record_on is set, the list of flocks otherwise
+    """
+    if not cfg.record_on:
+        return flocks
+    history = FlockHistory("flocks_%d" % instance)
+    history.extend(flocks)
+    return history
+
+
+def create_map_history(instance=0):
+    """
+    Returns the map history of an instance: a recording if cfg.record_on is set, an array
+    of cfg.total_timesteps maps otherwise. The map of step 0 is empty. None if the maps
+    aren't tracked
+    """
+    if not cfg.track_map_changes:
+        return None
+    if cfg.record_on:
+        history = ChunkedSteps("map_%d" % instance, (cfg.maze_width, cfg.maze_height),
+                               maze.get_node_dtype())
+        history.append(np.zeros((cfg.maze_width, cfg.maze_height), dtype=maze.get_node_dtype()))
+        return history
+    return np.zeros((cfg.total_timesteps, cfg.maze_width, cfg.maze_height),
+                    dtype=maze.get_node_dtype())
+
+
+def is_recording(history):
+    return isinstance(history, (ChunkedSteps, FlockHistory))
+
+
+def flush(history):
+    """ Saves the whole history, if it's a recording """
+    if is_recording(history):
+        history.flush()
+
+
+def truncate(history, length):
+    """
+    Drops the steps from "length" on from a recording. Map arrays in memory keep all
+    cfg.total_timesteps steps
+    """
+    if is_recording(history):
+        del history[length:]
@@ -140,17 +140,17 @@ def render_animation(amaze, flocks, template_triangles, global_map):
         for x in range(cfg.maze_width):
             for y in range(cfg.maze_height):
                 if isinstance(amaze.matrix[x][y].shape, maze.Passage):
-                    if not global_map[step][x][y][cfg.NODE_IS_EXPLORED_VAR]:
+                    if not maze.is_node_flag_set(global_map[step], x, y, cfg.NODE_IS_EXPLORED_FLAG):
                         # Is the node explored?
                         render_overlay(x, y, cfg.maze_unexplored_color, new_maze_surf)
                     else:
-                        if global_map[step][x][y][cfg.NODE_IS_DEADEND_VAR]:
+                        if maze.is_node_flag_set(global_map[step], x, y, cfg.NODE_IS_DEADEND_FLAG):
                             render_overlay(x, y, cfg.maze_deadend_color, new_maze_surf)
-                    if global_map[step][x][y][cfg.NODE_IS_GOAL_VAR]:
+                    if maze.is_node_flag_set(global_map[step], x, y, cfg.NODE_IS_GOAL_FLAG):
                         render_overlay(x, y, cfg.maze_goal_color, new_maze_surf)
                     # Node pheromone level
                     render_node_pheromone_level(x, y,
-                                                global_map[step][x][y][cfg.NODE_PHEROMONE_A_VAR],
+                                                maze.get_node_pheromone_a(global_map[step], x, y),
                                                 pheromone_level_font, new_maze_surf)
 
         # Copy the maze onto the screen Surface
@@ -206,8 +206,7 @@ def render_overlay(x, y, fill_color, alpha_surf):
 def render_triangle(screen, flock, boid, boid_n, template_triangles, fill_color, contour_color):
     """ Renders a single triangle """
     # Get a rotated triangle without location
-    template_triangle = template_triangles[
-        np.minimum(int(np.round(np.degrees(flock.object_list[boid_n].orientation))), 359)]
+    template_triangle = template_triangles[int(boid[cfg.BOID_TRIANGLE_OFFSET])]
     triangle_center = maze.to_coors(boid[pos_var + x_var], boid[pos_var + y_var])
 
     if cfg.bounding_rects_show:
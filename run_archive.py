@@ -0,0 +1,197 @@
+"""
+run_archive.py saves finished runs into archives, which are rendered and analysed later,
+e.g. on another machine (see main.py --archive and --render-archive, RunArchive and
+experiment.report_archive()). The flocks and the maps of a RunArchive are rendered by
+renderer.render_animation() like those of a run.
+
+An archive is a directory (cfg.archive_dir by default) of:
+
+    header.pkl        Pickled dict: "format_version" (ARCHIVE_FORMAT_VERSION), "settings"
+                      (the values of ARCHIVED_SETTINGS in configs.py the run was simulated
+                      with), "maze" (maze.Maze), "steps_n" (number of timesteps, the first
+                      flock included), "completion_time" (0 if the maze wasn't solved)
+                      and "computation_time" (seconds)
+    positions.npy     float32 [steps_n, NumberOfBoids, Dimensions], in unit squares
+    velocities.npy    float32 [steps_n, NumberOfBoids, Dimensions]
+    pheromones.npy    float32 [steps_n, NumberOfBoids], pheromone levels of the boids
+    orientations.npy  float32 [steps_n, NumberOfBoids], radians in [0, 2 pi)
+    map.npy           maze.get_node_dtype() [steps_n, maze_width, maze_height], map
+                      snapshots of every step. Only if cfg.track_map_changes was set
+    experiment.npy    float32 [NumberOfBoids, EXP_SIZE], see backend.get_experiment_data()
+
+The arrays are plain .npy files. They are memory-mapped (np.load(url, mmap_mode="r")),
+so only the steps read are loaded. The header is written last, an archive without
+it is incomplete.
+"""
+import os
+import pickle
+
+import numpy as np
+
+import configs as cfg
+import agents
+import maze
+import numpy_computations as np_comp
+
+# 2: the pheromone levels of map.npy are in 16.16 fixed point (see configs.py)
+ARCHIVE_FORMAT_VERSION = 2
+# Settings the archived data depends on
+ARCHIVED_SETTINGS = ["NumberOfBoids", "maze_size", "maze_width", "maze_height", "Dimensions",
+                     "framespersecond", "total_timesteps", "solver", "track_map_changes",
+                     "starting_node", "goal_node", "EXP_SIZE"]
+HEADER_URL = "header.pkl"
+MAP_URL = "map.npy"
+EXPERIMENT_URL = "experiment.npy"
+# Boid fields by their archive files: the first and the last index in the boid array
+BOID_FIELDS = {"positions.npy": (cfg.BOID_POS_VAR * cfg.Dimensions,
+                                 (cfg.BOID_POS_VAR + 1) * cfg.Dimensions),
+               "velocities.npy": (cfg.BOID_VEL_VAR * cfg.Dimensions,
+                                  (cfg.BOID_VEL_VAR + 1) * cfg.Dimensions),
+               "pheromones.npy": (cfg.BOID_PHEROMONE_VAR * cfg.Dimensions,
+                                  cfg.BOID_PHEROMONE_VAR * cfg.Dimensions + 1),
+               "orientations.npy": (cfg.BOID_ORIENTATION_OFFSET,
+                                    cfg.BOID_ORIENTATION_OFFSET + 1)}
+
+
+def get_archive_url(archive_url=None):
+    return os.path.join(os.getcwd(), cfg.archive_dir if archive_url is None else archive_url)
+
+
+def save(amaze, flocks, global_map, experiment_data, completion_time, computation_time,
+         archive_url=None):
+    """
+    Saves the run into an archive (cfg.archive_dir by default). The flocks and the maps
+    are written a step at a time, so recorded runs (see recorder.py) aren't loaded whole
+    """
+    archive_url = get_archive_url(archive_url)
+    os.makedirs(archive_url, exist_ok=True)
+    header_url = os.path.join(archive_url, HEADER_URL)
+    # An archive being overwritten is incomplete until the new header is written
+    if os.path.exists(header_url):
+        os.remove(header_url)
+    steps_n = len(flocks)
+    print("Archiving %d timesteps into %s" % (steps_n, archive_url))
+
+    fields = {}
+    for field_url, (first, last) in BOID_FIELDS.items():
+        shape = (steps_n, cfg.NumberOfBoids) + ((last - first,) if last - first > 1 else ())
+        fields[field_url] = np.lib.format.open_memmap(os.path.join(archive_url, field_url),
+                                                      mode="w+", dtype=np.float32, shape=shape)
+    for step in range(steps_n):
+        np_arrays = flocks[step].np_arrays
+        for field_url, (first, last) in BOID_FIELDS.items():
+            fields[field_url][step] = np_arrays[:, first:last].reshape(
+                fields[field_url].shape[1:])
+    for field in fields.values():
+        field.flush()
+
+    map_url = os.path.join(archive_url, MAP_URL)
+    if global_map is not None:
+        maps = np.lib.format.open_memmap(map_url, mode="w+", dtype=maze.get_node_dtype(),
+                                         shape=(steps_n, cfg.maze_width, cfg.maze_height))
+        for step in range(steps_n):
+            maps[step] = global_map[step]
+        maps.flush()
+    elif os.path.exists(map_url):
+        os.remove(map_url)
+    np.save(os.path.join(archive_url, EXPERIMENT_URL), experiment_data)
+
+    header = {"format_version": ARCHIVE_FORMAT_VERSION,
+              "settings": {name: getattr(cfg, name) for name in ARCHIVED_SETTINGS},
+              "maze": amaze,
+              "steps_n": steps_n,
+              "completion_time": completion_time,
+              "computation_time": computation_time}
+    with open(header_url, "wb") as header_f:
+        pickle.dump(header, header_f, pickle.HIGHEST_PROTOCOL)
+
+
+class ArchivedFlocks:
+    """
+    The flocks of an archive, used like the list of agents.Flock of a run. Flocks are
+    assembled from the memory-mapped fields when read. Collision marks of the boids
+    (cfg.bounding_rects_show) are not archived
+    """
+
+    def __init__(self, fields, steps_n):
+        self.fields = fields
+        self.steps_n = steps_n
+        # The flock read last, so reading the same step again doesn't assemble it again
+        self.last_step = None
+        self.last_flock = None
+
+    def __len__(self):
+        return self.steps_n
+
+    def __iter__(self):
+        for step in range(len(self)):
+            yield self[step]
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return [self[i] for i in range(*step.indices(len(self)))]
+        if step < 0:
+            step += len(self)
+        if not 0 <= step < len(self):
+            raise IndexError("Step %d is out of the %d archived steps" % (step, len(self)))
+        if step != self.last_step:
+            np_arrays = np.zeros((self.fields["positions.npy"].shape[1], agents.Boid.arrayLen),
+                                 dtype=np.float32)
+            for field_url, (first, last) in BOID_FIELDS.items():
+                np_arrays[:, first:last] = self.fields[field_url][step].reshape(
+                    len(np_arrays), last - first)
+            # The template triangles are not archived, they follow from the orientations
+            np_arrays[:, cfg.BOID_TRIANGLE_OFFSET] = np_comp.get_triangle_indices(
+                np_arrays[:, cfg.BOID_ORIENTATION_OFFSET])
+            self.last_flock = agents.Flock(len(np_arrays))
+            self.last_flock.np_arrays = np_arrays
+            self.last_step = step
+        return self.last_flock
+
+
+class RunArchive:
+    """
+    A run loaded from an archive saved by save(). The arrays are memory-mapped:
+    flocks (ArchivedFlocks), global_map (None if the map wasn't tracked) and the fields
+    by their file names. It stands in for the backend of the run in experiment.report()
+    """
+
+    def __init__(self, archive_url=None):
+        self.url = get_archive_url(archive_url)
+        header_url = os.path.join(self.url, HEADER_URL)
+        if not os.path.exists(header_url):
+            raise ValueError("%s is not a complete run archive" % self.url)
+        with open(header_url, "rb") as header_f:
+            header = pickle.load(header_f)
+        if header["format_version"] != ARCHIVE_FORMAT_VERSION:
+            raise ValueError("The run archive format %d is not supported (%d is)" %
+                             (header["format_version"], ARCHIVE_FORMAT_VERSION))
+        self.settings = header["settings"]
+        self.maze = header["maze"]
+        self.steps_n = header["steps_n"]
+        self.completion_time = header["completion_time"]
+        self.computation_time = header["computation_time"]
+
+        self.fields = {field_url: np.load(os.path.join(self.url, field_url), mmap_mode="r")
+                       for field_url in BOID_FIELDS}
+        self.flocks = ArchivedFlocks(self.fields, self.steps_n)
+        if self.settings["track_map_changes"]:
+            self.global_map = np.load(os.path.join(self.url, MAP_URL), mmap_mode="r")
+        else:
+            self.global_map = None
+        print("Loaded the run archive of %d timesteps from %s" % (self.steps_n, self.url))
+
+    def apply_settings(self):
+        """ Sets the settings the run was simulated with, e.g. before rendering it """
+        for name, value in self.settings.items():
+            setattr(cfg, name, value)
+        # The archive holds the steps simulated, which ends with the solution
+        cfg.total_timesteps = self.steps_n
+        cfg.window_size = cfg.window_width, cfg.window_height = \
+            cfg.maze_width * cfg.tile_width, cfg.maze_height * cfg.tile_height
+
+    def get_experiment_data(self, instance=0):
+        """ Like backend.get_experiment_data(). Archives hold a single instance """
+        if instance != 0:
+            raise IndexError("Archives hold a single instance, %d is requested" % instance)
+        return np.load(os.path.join(self.url, EXPERIMENT_URL))
@@ -1,181 +1,316 @@
 """
-simulator.py runs the simulation - see run(). It runs agent AIs on GPU,
-collects the results and generates the environment response.
+simulator.py runs the simulation - see run(). It runs agent AIs on a backend
+(OpenCL device or NumPy), collects the results and generates the environment response.
+Runs can be saved in checkpoints and continued - see save_checkpoint().
 """
+import os
+import pickle
+import random
 
 import numpy as np
 
 import configs as cfg
+import agents
+import maze
 import maze_solver
-import opencl_computations as cl_comp
+import recorder
+import numpy_computations as np_comp
 import collision_detection as coll_detect
-import maze
 
-x_var = cfg.X
-y_var = cfg.Y
-pos = cfg.BOID_POS_VAR * cfg.Dimensions
-vel = cfg.BOID_VEL_VAR * cfg.Dimensions
 
-
-class SensorReadings():
-    def __init__(self, northern_reading, eastern_reading,
-                 southern_reading, western_reading, bottom_reading):
-        self.northern_reading = northern_reading
-        self.eastern_reading = eastern_reading
-        self.southern_reading = southern_reading
-        self.western_reading = western_reading
-        self.bottom_reading = bottom_reading
+def create_backend(device_override=None):
+    """
+    Creates the backend selected by cfg.backend. In "auto" mode small swarms are
+    computed with NumPy, as OpenCL launch and transfer overheads dominate for them,
+    unless several instances are computed in batches (cfg.batch_instances).
+    NumPy is also the fallback when OpenCL is not available.
+    """
+    if cfg.backend == "NumPy" or (cfg.backend == "auto" and cfg.batch_instances == 1 and
+                                  cfg.NumberOfBoids <= cfg.numpy_backend_max_boids):
+        print("Using NumPy backend.")
+        return np_comp.NumpyBackend()
+    try:
+        # Imported here so that machines without PyOpenCL can still use NumPy
+        import opencl_computations as cl_comp
+        return cl_comp.OpenCLBackend(*cl_comp.init_opencl(device_override))
+    except (ImportError, RuntimeError) as e:
+        if cfg.backend != "auto":
+            raise
+        print("OpenCL is not available (%s). Using NumPy backend." % e)
+        return np_comp.NumpyBackend()
 
 
-def run(context, device, queue, amaze, flocks, template_triangles):
-    """ Simulates agents behaviour in a given maze """
+def run(backend, amaze, flocks, template_triangles, checkpoint=None):
+    """
+    Simulates agents behaviour in a given maze. A run is continued from its
+    checkpoint (see load_checkpoint()), if it's given with its maze and flocks
+    """
 
     completion_time = 0
     solver = None
-    # Agents-related OpenCL computations
-    kernels, gpu_params = cl_comp.build_opencl_program(context, device)
+    if checkpoint is None:
+        global_map = backend.prepare(flocks[0], amaze, template_triangles)
+        step = 1
+    else:
+        check_checkpoint_settings(checkpoint, backend)
+        global_map = backend.prepare(flocks[0], amaze, template_triangles,
+                                     checkpoint["backend_state"])
+        step = restore_checkpoint(checkpoint, global_map) + 1
+    amendments = coll_detect.Amendments()
+    tracker = create_connectivity_tracker(amaze)
 
-    buffers, amendments, global_map = cl_comp.prepare_host_memory(context)
+    print("Starting the simulation.")
+    host_collisions = cfg.collision_detection_on and not backend.detects_collisions
+    if cfg.steps_per_batch > 1 and host_collisions:
+        print("Collision detection is off, as steps are computed in batches.")
+    # Only collision detection on the host needs to return to the host after every step
+    # before the next one is computed. Otherwise the backend may work ahead
+    per_step = cfg.steps_per_batch == 1 and host_collisions
+    while step < cfg.total_timesteps:
+        # print("Computing flock N {0} on GPU.".format(step))
+        # Get agents' impulses and partially correct simulation response
+        # (in the form of positions)
+        if not per_step:
+            # The backend takes sensor readings itself, so there is no need to
+            # return to the host on every step
+            batch_end = min(step + cfg.steps_per_batch, cfg.total_timesteps)
+            is_checkpoint = is_checkpoint_due(step, batch_end)
+            # The backend mustn't work ahead of the checkpoint
+            backend.generate_flocks(step, batch_end - step, flocks, global_map,
+                                    work_ahead=not is_checkpoint)
+        else:
+            batch_end = step + 1
+            is_checkpoint = is_checkpoint_due(step, batch_end)
+            backend.generate_next_flock(step, flocks, global_map)
 
-    cl_comp.set_kernel_arguments(kernels, buffers)
+        is_solved = False
+        for step in range(step, batch_end):
+            # print(flocks[step].np_arrays)
+            # Select flocks. The backend has cleaned their values and computed
+            # the orientations of the boids
+            current_flock = flocks[step]
+            previous_flock = flocks[step - 1]
 
-    cl_comp.prepare_device_memory(queue, kernels, buffers, flocks[0])
+            if per_step:
+                # Check for wall collisions and update simulation response accordingly
+                coll_detect.run(current_flock, previous_flock, amaze, template_triangles, amendments)
 
-    # Calculate the orientations for the first flock
-    i = 0
-    first_flock = flocks[0]
-    for boid in first_flock.np_arrays:
-        calculate_orientation(boid, first_flock.object_list[i], first_flock.object_list[i])
-        i += 1
+                # Send simulation response to the backend
+                simulation_response(backend, amendments)
 
-    amendments.clear()
-    # Send first simulation response to the device based on starting values.
-    # It will be just sensor readings for starting position.
-    intermediary_events = simulation_response(queue, kernels, gpu_params,
-                                              buffers, amendments,
-                                              first_flock, amaze)
+                # Update map (might even happen during sending simulation response to the device
+                backend.update_map()
 
-    print("Starting the simulation.")
-    for step in range(1, cfg.total_timesteps):
-        # print("Computing flock N {0} on GPU.".format(step))
-        # Get agents' impulses and partially correct simulation response
-        # (in the form of positions)
-        cl_comp.gpu_generate_next_flock(step, queue, intermediary_events, kernels,
-                                        gpu_params, buffers, flocks, global_map)
-        # print(flocks[step].np_arrays)
-        # Fix NaN's
-        cl_comp.standardize_values(flocks[step])
-
-        # Select flocks
-        current_flock = flocks[step]
-        previous_flock = flocks[step - 1]
-
-        # Calculate boids' orientations
-        i = 0
-        for boid in current_flock.np_arrays:
-            # TODO accelerate orientation calculation using OpenCL
-            calculate_orientation(boid, current_flock.object_list[i], previous_flock.object_list[i])
-            i += 1
-
-        # Check for wall collisions and update simulation response accordingly
-        if cfg.collision_detection_on:
-            coll_detect.run(current_flock, previous_flock, amaze, template_triangles, amendments)
-
-        # Send simulation response to the device
-        intermediary_events = simulation_response(queue, kernels, gpu_params,
-                                                  buffers, amendments,
-                                                  current_flock, amaze)
-
-        # Update map (might even happen during sending simulation response to the device
-        cl_comp.update_map(queue, kernels, intermediary_events)
-
-        path_to_goal = maze_solver.solve_maze(global_map[step],
-                                              amaze, cfg.starting_node,
-                                              cfg.goal_node)
-        if path_to_goal is not None:
-            if cfg.solver == "CPU":
-                for node in path_to_goal:
-                    global_map[step][node[0]][node[1]][cfg.NODE_IS_GOAL_VAR] = True
-                path_completed = True
-            else:
-                path_completed = True
-                for node in path_to_goal:
-                    if not global_map[step][node[0]][node[1]][cfg.NODE_IS_GOAL_VAR]:
-                        path_completed = False
-                        break
-            if path_completed:
+            is_solved = is_maze_solved(backend, global_map, step, amaze, tracker)
+            if is_solved:
                 cfg.total_timesteps = step + 1
                 print("Maze is solved by " + cfg.solver + "! Completion time = %d !!!!!!!!!" % cfg.total_timesteps)
                 completion_time = cfg.total_timesteps
                 break
+        if is_solved:
+            # The batch might have gone further
+            del flocks[step + 1:]
+            recorder.truncate(global_map, step + 1)
+            break
+        if is_checkpoint:
+            save_checkpoint(backend, amaze, flocks, global_map, step)
+        step = batch_end
+
+    recorder.flush(flocks)
+    recorder.flush(global_map)
+    print("The simulation is finished.")
+    return global_map, backend, completion_time, solver
+
+
+def run_batch(backend, amazes, instances_flocks, template_triangles):
+    """
+    Simulates independent instances (mazes and swarms of the same sizes, see
+    cfg.batch_instances) together. An instance stops being computed once its maze is solved.
+    Returns the map histories and the completion times (0 if not solved) of the instances
+    """
+    if not backend.runs_batches:
+        raise RuntimeError("The %s backend doesn't compute instances in batches" % backend.name)
+
+    completion_times = [0] * len(amazes)
+    global_maps = backend.prepare_batch([flocks[0] for flocks in instances_flocks], amazes,
+                                        template_triangles)
+
+    print("Starting the simulation of %d instances." % len(amazes))
+    if cfg.collision_detection_on and not backend.detects_collisions:
+        print("Collision detection is off, as instances are computed in batches.")
+    unsolved = list(range(len(amazes)))
+    trackers = [create_connectivity_tracker(amaze) for amaze in amazes]
+    step = 1
+    while step < cfg.total_timesteps and unsolved:
+        batch_end = min(step + cfg.steps_per_batch, cfg.total_timesteps)
+        backend.generate_batch(step, batch_end - step, instances_flocks)
 
+        for instance in list(unsolved):
+            flocks = instances_flocks[instance]
+            for instance_step in range(step, batch_end):
+                if is_maze_solved(backend, global_maps[instance], instance_step,
+                                  amazes[instance], trackers[instance], instance):
+                    completion_times[instance] = instance_step + 1
+                    print("Maze %d is solved by %s! Completion time = %d" %
+                          (instance, cfg.solver, completion_times[instance]))
+                    backend.set_solved(instance, instance_step)
+                    unsolved.remove(instance)
+                    break
+        step = batch_end
+
+    # The batches might have gone further than the solutions
+    for flocks, global_map, completion_time in zip(instances_flocks, global_maps,
+                                                   completion_times):
+        if completion_time:
+            del flocks[completion_time:]
+            recorder.truncate(global_map, completion_time)
+        recorder.flush(flocks)
+        recorder.flush(global_map)
     print("The simulation is finished.")
-    return global_map, buffers, completion_time, solver
+    return global_maps, backend, completion_times
 
 
-def calculate_orientation(boid, current_boid_obj, previous_boid_obj):
-    """ Calculates orientation based on boid's velocity """
-    if boid[vel + x_var] == 0 and boid[vel + y_var] == 0:
-        alpha = previous_boid_obj.orientation
+def is_checkpoint_due(step, batch_end):
+    """
+    Checks if a checkpoint is to be saved after the steps from "step" to batch_end
+    (excluded): every cfg.checkpoint_interval timesteps, except at the end of the run
+    """
+    if cfg.checkpoint_interval <= 0 or batch_end >= cfg.total_timesteps:
+        return False
+    return (batch_end - 1) // cfg.checkpoint_interval > (step - 1) // cfg.checkpoint_interval
+
+
+def get_checkpoint_settings(backend):
+    """ Settings a run can only be continued with """
+    settings = {name: getattr(cfg, name) for name in
+                ["NumberOfBoids", "maze_size", "total_timesteps", "steps_per_batch",
+                 "collision_detection_on", "track_map_changes", "solver",
+                 "flock_ring_length", "fused_agent_step", "record_on", "record_chunk_steps"]}
+    settings["backend"] = backend.name
+    return settings
+
+
+def save_checkpoint(backend, amaze, flocks, global_map, step):
+    """
+    Saves everything needed to continue the run after the given step into
+    cfg.checkpoint_url: the memory of the backend, the maze, the flocks and the maps
+    so far and the states of the random number generators. Recorded flocks and maps
+    (see cfg.record_on) are saved into their recordings instead. The file is replaced
+    only once the checkpoint is written, so an interrupted save keeps the previous one
+    """
+    if recorder.is_recording(flocks):
+        recorder.flush(flocks)
+        recorder.flush(global_map)
+        flocks = global_map = None
+    checkpoint = {"settings": get_checkpoint_settings(backend),
+                  "step": step,
+                  "backend_state": backend.get_state(),
+                  "maze": amaze,
+                  "flocks": None if flocks is None else
+                  np.array([flock.np_arrays for flock in flocks[:step + 1]]),
+                  "global_map": None if global_map is None else global_map[:step + 1].copy(),
+                  "numpy_random_state": np.random.get_state(),
+                  "random_state": random.getstate()}
+    checkpoint_url = os.path.join(os.getcwd(), cfg.checkpoint_url)
+    # Temporary files are named like in opencl_computations.replace_file(), so that
+    # experiment processes sharing cfg.checkpoint_url don't write into the same one
+    tmp_url = "%s.%d.tmp" % (checkpoint_url, os.getpid())
+    with open(tmp_url, "wb") as checkpoint_f:
+        pickle.dump(checkpoint, checkpoint_f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_url, checkpoint_url)
+    print("Step %d is saved into %s" % (step, cfg.checkpoint_url))
+
+
+def load_checkpoint():
+    """
+    Loads the checkpoint saved by save_checkpoint(). The run is continued by passing
+    it to run() with its maze (checkpoint["maze"]) and flocks (checkpoint["flocks"])
+    """
+    checkpoint_url = os.path.join(os.getcwd(), cfg.checkpoint_url)
+    with open(checkpoint_url, "rb") as checkpoint_f:
+        checkpoint = pickle.load(checkpoint_f)
+    if checkpoint["flocks"] is None:
+        # The flocks are recorded
+        flocks = recorder.FlockHistory("flocks_0")
+        flocks.restore(checkpoint["step"] + 1)
     else:
-        if boid[vel + x_var] == 0:
-            if boid[vel + y_var] > 0:
-                alpha = np.pi / 2
-            else:
-                alpha = np.pi * 1.5
-        else:
-            if boid[vel + y_var] == 0:
-                if boid[vel + x_var] > 0:
-                    alpha = 0
-                else:
-                    alpha = np.pi
-            else:
-                alpha = np.arctan(boid[vel + y_var] / boid[vel + x_var])
-        # noinspection PyChainedComparisons
-        if boid[vel + x_var] > 0 and boid[vel + y_var] < 0:
-            alpha += np.pi * 2
-        else:
-            if boid[vel + x_var] < 0 and boid[vel + y_var] != 0:
-                alpha = np.pi + alpha
-
-    current_boid_obj.orientation = alpha
-
-
-def simulation_response(queue, kernels, gpu_params, buffers, amendments, flock, amaze):
-    """ Calculates simulation response and sends it to GPU (i.e. agents)
-    """
-    # Transfer the amended position
-    intermediary_events = cl_comp.gpu_amend_values(
-        queue, kernels, gpu_params, buffers, amendments)
-
-    # Get sensor readings
-    sensor_readings = []
-    for boid in flock.np_arrays:
-        neighboring_tiles = maze.get_neighboring_tiles(boid[pos + x_var],
-                                                       boid[pos + y_var],
-                                                       amaze, None,
-                                                       include_none=True)
-        # Convert coordinates into Square objects
-        northern_value = eastern_value = south_value = western_value = bottom_value = None
-        coors = neighboring_tiles[maze.Location.top.value]
-        if coors is not None:
-            northern_value = amaze.matrix[coors[x_var]][coors[y_var]]
-        coors = neighboring_tiles[maze.Location.right.value]
-        if coors is not None:
-            eastern_value = amaze.matrix[coors[x_var]][coors[y_var]]
-        coors = neighboring_tiles[maze.Location.bottom.value]
-        if coors is not None:
-            south_value = amaze.matrix[coors[x_var]][coors[y_var]]
-        coors = neighboring_tiles[maze.Location.left.value]
-        if coors is not None:
-            western_value = amaze.matrix[coors[x_var]][coors[y_var]]
-        coors = neighboring_tiles[maze.Location.center.value]
-        if coors is not None:
-            bottom_value = amaze.matrix[coors[x_var]][coors[y_var]]
-
-        sensor_readings.append(
-            SensorReadings(northern_value, eastern_value, south_value, western_value, bottom_value))
-
-    cl_comp.gpu_transfer_readings(queue, buffers, sensor_readings,
-                                  intermediary_events)
-    return intermediary_events
+        flocks = []
+        for np_arrays in checkpoint["flocks"]:
+            flock = agents.Flock(cfg.NumberOfBoids)
+            flock.np_arrays = np_arrays
+            flocks.append(flock)
+    checkpoint["flocks"] = flocks
+    print("Loaded the checkpoint of step %d from %s" % (checkpoint["step"], cfg.checkpoint_url))
+    return checkpoint
+
+
+def check_checkpoint_settings(checkpoint, backend):
+    """ Raises ValueError if the checkpoint is saved with different settings """
+    settings = get_checkpoint_settings(backend)
+    differences = [name for name in settings if checkpoint["settings"].get(name) != settings[name]]
+    if differences:
+        raise ValueError("The checkpoint is saved with different settings: " +
+                         ", ".join("%s = %s" % (name, checkpoint["settings"].get(name))
+                                   for name in differences))
+
+
+def restore_checkpoint(checkpoint, global_map):
+    """
+    Restores the maps and the random number generators of the run saved in the
+    checkpoint. The backend is given its state by prepare(). Returns the saved step
+    """
+    if recorder.is_recording(global_map):
+        global_map.restore(checkpoint["step"] + 1)
+    elif global_map is not None:
+        global_map[:checkpoint["step"] + 1] = checkpoint["global_map"]
+    np.random.set_state(checkpoint["numpy_random_state"])
+    random.setstate(checkpoint["random_state"])
+    print("Resuming the simulation after step %d." % checkpoint["step"])
+    return checkpoint["step"]
+
+
+def create_connectivity_tracker(amaze):
+    """ The maps are checked by a tracker on the host, unless the backend checks them """
+    if cfg.backend_goal_check or not cfg.track_map_changes:
+        return None
+    return maze_solver.ConnectivityTracker(amaze)
+
+
+def is_maze_solved(backend, global_map, step, amaze, tracker=None, instance=0):
+    """
+    Checks if the path to the goal is found on the map of the given step. The path is
+    only searched for once the goal is reachable, as the backend (cfg.backend_goal_check)
+    or the tracker (maze_solver.ConnectivityTracker) finds
+    """
+    if cfg.backend_goal_check:
+        if not backend.is_goal_reachable(step, instance):
+            return False
+    elif tracker is not None and not tracker.is_connected(global_map[step], cfg.starting_node,
+                                                           cfg.goal_node):
+        return False
+    if global_map is None:
+        # The reachable goal is all there is to check without the maps
+        if cfg.solver != "CPU" or not cfg.backend_goal_check:
+            raise ValueError("The maps must be tracked (cfg.track_map_changes) to check the "
+                             "solutions of the %s solver" % cfg.solver)
+        return True
+    path_to_goal = maze_solver.solve_maze(global_map[step],
+                                          amaze, cfg.starting_node,
+                                          cfg.goal_node)
+    if path_to_goal is None:
+        return False
+    if cfg.solver == "CPU":
+        for node in path_to_goal:
+            maze.set_node_flag(global_map[step], node[0], node[1], cfg.NODE_IS_GOAL_FLAG)
+        return True
+    for node in path_to_goal:
+        if not maze.is_node_flag_set(global_map[step], node[0], node[1], cfg.NODE_IS_GOAL_FLAG):
+            return False
+    return True
+
+
+def simulation_response(backend, amendments):
+    """ Sends simulation response (amended positions) to the backend (i.e. agents).
+    Sensor readings are taken by the backend itself from the maze
+    """
+    backend.amend_values(amendments)
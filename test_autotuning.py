@@ -0,0 +1,41 @@
+"""
+Work group sizes tried by the autotuner and the sizes it saves for a device and a
+workload (see cfg.autotune_url).
+"""
+import pytest
+
+cl_comp = pytest.importorskip("opencl_computations")
+autotuning = pytest.importorskip("autotuning")
+
+
+@pytest.mark.parametrize("boids_n, maze_width, max_work_group_size, expected", [
+    (100, 21, 256, [1, 2, 4, 8, 16, 32, 64, 128]),
+    (100, 21, 32, [1, 2, 4, 8, 16, 32]),
+    (10, 21, 1024, [1, 2, 4, 8, 16, 32]),
+    (64, 8, 1024, [1, 2, 4, 8, 16, 32, 64])])
+def test_candidate_sizes(configs, fake_platforms, boids_n, maze_width, max_work_group_size,
+                         expected):
+    configs.NumberOfBoids = boids_n
+    configs.maze_width = maze_width
+    device = fake_platforms[0].get_devices()[0]
+    device.max_work_group_size = max_work_group_size
+    assert autotuning.get_candidate_sizes(device) == expected
+
+
+def test_local_sizes_round_trip(configs, fake_platforms):
+    fast_gpu, slow_gpu = fake_platforms[0].get_devices()
+    assert cl_comp.load_local_sizes(fast_gpu) is None
+    cl_comp.save_local_sizes(fast_gpu, {"k_update_map": 32, "k_agent_ai_and_sim": 64})
+    cl_comp.save_local_sizes(slow_gpu, {"k_update_map": 8})
+    assert cl_comp.load_local_sizes(fast_gpu) == {"k_update_map": 32, "k_agent_ai_and_sim": 64}
+    assert cl_comp.load_local_sizes(slow_gpu) == {"k_update_map": 8}
+
+    # Sizes are tuned for the workload too
+    configs.NumberOfBoids += 1
+    assert cl_comp.load_local_sizes(fast_gpu) is None
+    configs.NumberOfBoids -= 1
+    configs.maze_height += 2
+    assert cl_comp.load_local_sizes(fast_gpu) is None
+    configs.maze_height -= 2
+    fast_gpu.driver_version = "2.0"
+    assert cl_comp.load_local_sizes(fast_gpu) is None
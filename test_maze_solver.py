@@ -0,0 +1,143 @@
+"""
+maze_solver.ConnectivityTracker and the goal checks of the backends
+(cfg.backend_goal_check) against solve_maze() on random maps.
+"""
+import numpy as np
+import pytest
+
+import maze
+import maze_solver
+import numpy_computations as np_comp
+
+MAPS_N = 60
+# Maps checked on the device at once, an instance each
+INSTANCES_N = 4
+
+
+def explore(global_map_inst, nodes, flag):
+    for x, y in zip(*np.nonzero(nodes)):
+        maze.set_node_flag(global_map_inst, x, y, flag)
+
+
+def assert_tracker_agrees(tracker, global_map_inst, amaze, configs):
+    expected = maze_solver.solve_maze(global_map_inst.copy(), amaze, configs.starting_node,
+                                      configs.goal_node) is not None
+    assert tracker.is_connected(global_map_inst, configs.starting_node,
+                                configs.goal_node) == expected
+    return expected
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_growing_maps(configs, generate_instance, seed):
+    """ Nodes are only explored, as the swarm spreads, until the goal is reached """
+    amaze, _ = generate_instance(seed)
+    random_state = np.random.RandomState(seed)
+    tracker = maze_solver.ConnectivityTracker(amaze)
+    global_map_inst = np.zeros((configs.maze_width, configs.maze_height),
+                               dtype=maze.get_node_dtype())
+    results = []
+    for _ in range(MAPS_N):
+        explore(global_map_inst, random_state.rand(*global_map_inst.shape) < 0.03,
+                configs.NODE_IS_EXPLORED_FLAG)
+        results.append(assert_tracker_agrees(tracker, global_map_inst, amaze, configs))
+    explore(global_map_inst, np.ones(global_map_inst.shape, dtype=bool),
+            configs.NODE_IS_EXPLORED_FLAG)
+    results.append(assert_tracker_agrees(tracker, global_map_inst, amaze, configs))
+    # Both answers are checked
+    assert not results[0] and results[-1]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_changing_maps(configs, generate_instance, seed):
+    """ Explored nodes are outdated again and partial solutions (goal flags) come and go """
+    amaze, _ = generate_instance(seed)
+    random_state = np.random.RandomState(seed)
+    tracker = maze_solver.ConnectivityTracker(amaze)
+    results = []
+    for _ in range(MAPS_N):
+        global_map_inst = np.zeros((configs.maze_width, configs.maze_height),
+                                   dtype=maze.get_node_dtype())
+        explore(global_map_inst, random_state.rand(*global_map_inst.shape) <
+                random_state.uniform(0.5, 1), configs.NODE_IS_EXPLORED_FLAG)
+        explore(global_map_inst, random_state.rand(*global_map_inst.shape) < 0.05,
+                configs.NODE_IS_GOAL_FLAG)
+        results.append(assert_tracker_agrees(tracker, global_map_inst, amaze, configs))
+    assert any(results) and not all(results)
+
+
+def generate_goal_check_maps(amaze, random_state, configs):
+    """
+    Maps explored at random, with goal paths (see reuse_swarm_progress()) along the solution
+    from the start and from the goal and stray goal nodes
+    """
+    global_map_inst = np.zeros((configs.maze_width, configs.maze_height),
+                               dtype=maze.get_node_dtype())
+    explore(global_map_inst, np.ones(global_map_inst.shape, dtype=bool),
+            configs.NODE_IS_EXPLORED_FLAG)
+    # The path is listed from the goal
+    solution = maze_solver.solve_maze(global_map_inst, amaze, configs.starting_node,
+                                      configs.goal_node)[::-1]
+    maps = []
+    for _ in range(MAPS_N):
+        global_map_inst = np.zeros_like(global_map_inst)
+        explore(global_map_inst, random_state.rand(*global_map_inst.shape) <
+                random_state.uniform(0.5, 1), configs.NODE_IS_EXPLORED_FLAG)
+        goal_path = np.zeros(global_map_inst.shape, dtype=bool)
+        for x, y in (solution[:random_state.randint(len(solution))] +
+                     solution[len(solution) - random_state.randint(len(solution)):]):
+            goal_path[x, y] = True
+        explore(global_map_inst, goal_path | (random_state.rand(*global_map_inst.shape) < 0.02),
+                configs.NODE_IS_GOAL_FLAG)
+        maps.append(global_map_inst)
+    return maps
+
+
+def is_solved(global_map_inst, amaze, configs):
+    return maze_solver.solve_maze(global_map_inst.copy(), amaze, configs.starting_node,
+                                  configs.goal_node) is not None
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_numpy_goal_check(configs, generate_instance, seed):
+    amaze, _ = generate_instance(seed)
+    maze_matrix = amaze.get_numeric_matrix()
+    results = []
+    for global_map_inst in generate_goal_check_maps(amaze, np.random.RandomState(seed), configs):
+        expected = is_solved(global_map_inst, amaze, configs)
+        assert np_comp.check_goal_reachability(maze_matrix, global_map_inst) == expected
+        results.append(expected)
+    assert any(results) and not all(results)
+
+
+def test_device_goal_check(configs, generate_instance, create_opencl_backend,
+                           template_triangles):
+    """ The instances are checked in the same launches, with maps of their own """
+    cl = pytest.importorskip("pyopencl")
+    cl_comp = pytest.importorskip("opencl_computations")
+    configs.batch_instances = INSTANCES_N
+    instances = [generate_instance(seed) for seed in range(INSTANCES_N)]
+    backend = create_opencl_backend()
+    backend.prepare_batch([first_flocks[0] for _, first_flocks in instances],
+                          [amaze for amaze, _ in instances], template_triangles)
+    instances_maps = [generate_goal_check_maps(amaze, np.random.RandomState(seed), configs)
+                      for seed, (amaze, _) in enumerate(instances)]
+    # np.array() of the maps would pack their nodes tighter than the device does
+    maps = np.zeros((INSTANCES_N, configs.maze_width, configs.maze_height),
+                    dtype=maze.get_node_dtype())
+    goal_reached = np.zeros(INSTANCES_N, dtype=np.uint8)
+    results = []
+    for step in range(MAPS_N):
+        for instance, instance_maps in enumerate(instances_maps):
+            maps[instance] = instance_maps[step]
+        cl.enqueue_copy(backend.queue, backend.buffers["global_map"], maps)
+        cl.enqueue_copy(backend.queue, backend.buffers["global_iteration"], np.uint16(step))
+        result_offset = cl_comp.check_goal_reachability(step, backend.queue, backend.kernels,
+                                                        backend.gpu_params, {})
+        cl.enqueue_copy(backend.queue, goal_reached, backend.buffers["global_goal_reached"],
+                        src_offset=result_offset)
+        for instance, (amaze, _) in enumerate(instances):
+            expected = is_solved(maps[instance], amaze, configs)
+            assert bool(goal_reached[instance]) == expected, \
+                "map %d of instance %d" % (step, instance)
+            results.append(expected)
+    assert any(results) and not all(results)
@@ -0,0 +1,164 @@
+"""
+The NumPy backend against the OpenCL one. With collisions off and the same seed, both
+compute the same programmes and maps. Flocks differ by the rounding of the maths
+functions (e.g. atan of the orientations) only. The random numbers of the agents are
+the same bits on both, and they are those of Philox2x32-10.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import maze
+import numpy_computations as np_comp
+
+SEED = 3
+STEPS_N = 30
+# Flocks go through sin, cos and atan, which round differently on the devices
+FLOCK_TOLERANCE = 1e-5
+# Known answers of Philox2x32-10 from Random123: counter, key and the results
+PHILOX_KAT = [((0x00000000, 0x00000000), 0x00000000, (0xff1dae59, 0x6cd10df2)),
+              ((0xffffffff, 0xffffffff), 0xffffffff, (0x2c3f628b, 0xab4fd7ad)),
+              ((0x243f6a88, 0x85a308d3), 0x13198a2e, (0xdd7ce038, 0xf62a4c12))]
+# The generator of utilities.cl on its own. It only needs the constants below of main.cl
+PHILOX_SOURCE = """
+#define DIMENSIONS      2
+#define FLOATN          float2
+#define ERROR_EXPONENT  0.001
+#pragma OPENCL FP_CONTRACT OFF
+#include "utilities.cl"
+
+__kernel void k_philox(__global uint* counters, uint key, __global uint* bits,
+                       __global float* angles) {
+    int i = get_global_id(0);
+    uint2 counter = vload2(i, counters);
+    vstore2(philox2x32(counter, key), i, bits);
+    angles[i] = random_angle(counter, key);
+}
+"""
+
+
+@pytest.fixture
+def backends(configs, generate_instance, create_opencl_backend, template_triangles):
+    """ Both backends prepared with the same instance, and their flock histories """
+    configs.collision_detection_on = False
+    configs.random_seed = SEED
+    configs.total_timesteps = STEPS_N + 1
+    amaze, first_flocks = generate_instance(SEED)
+    opencl_backend = create_opencl_backend()
+    numpy_backend = np_comp.NumpyBackend()
+    numpy_flocks = list(first_flocks)
+    opencl_flocks = list(first_flocks)
+    numpy_map = numpy_backend.prepare(first_flocks[0], amaze, template_triangles)
+    opencl_map = opencl_backend.prepare(first_flocks[0], amaze, template_triangles)
+    return (numpy_backend, numpy_flocks, numpy_map), (opencl_backend, opencl_flocks, opencl_map)
+
+
+def download(backend, name, dtype):
+    cl = pytest.importorskip("pyopencl")
+    values = np.empty(backend.buffers[name].size // np.dtype(dtype).itemsize, dtype=dtype)
+    cl.enqueue_copy(backend.queue, values, backend.buffers[name])
+    return values
+
+
+def assert_same_states(numpy_backend, opencl_backend, step):
+    numpy_state = numpy_backend.get_state()
+    opencl_state = opencl_backend.get_state()
+    programmes = numpy_state["programmes"]
+    np.testing.assert_array_equal(
+        opencl_state["global_agent_programmes"].reshape(programmes.shape), programmes,
+        "programmes of step %d" % step)
+    np.testing.assert_array_equal(opencl_state["global_cmms"].reshape(numpy_state["cmms"].shape),
+                                  numpy_state["cmms"], "CMMs of step %d" % step)
+    opencl_map = opencl_state["global_map"].view(maze.get_node_dtype())
+    for field in maze.get_node_dtype().names:
+        np.testing.assert_array_equal(opencl_map[field], numpy_state["map"][field],
+                                      "map %s of step %d" % (field, step))
+
+
+@pytest.mark.parametrize("counter, key, expected", PHILOX_KAT)
+def test_philox_known_answers(counter, key, expected):
+    assert tuple(int(word) for word in np_comp.philox2x32(*counter, key)) == expected
+
+
+def test_random_numbers_match_the_device(configs, create_opencl_backend):
+    cl = pytest.importorskip("pyopencl")
+    backend = create_opencl_backend()
+    random_state = np.random.RandomState(SEED)
+    counters = np.concatenate([
+        np.array([counter for counter, _, _ in PHILOX_KAT], dtype=np.uint32),
+        # Steps and boids, as the agents count them, and any other counters
+        np.stack(np.meshgrid(np.arange(64), np.arange(16)), axis=-1).reshape(-1, 2),
+        random_state.randint(0, 2 ** 32, size=(256, 2), dtype=np.uint64)]).astype(np.uint32)
+    k_philox = cl.Program(backend.context, PHILOX_SOURCE).build(
+        options="-cl-single-precision-constant -I \"%s\"" %
+        os.path.join(os.getcwd(), configs.cl_dir)).k_philox
+    counters_buffer = cl.Buffer(backend.context,
+                                cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                hostbuf=counters)
+    bits_buffer = cl.Buffer(backend.context, cl.mem_flags.WRITE_ONLY, size=counters.nbytes)
+    angles_buffer = cl.Buffer(backend.context, cl.mem_flags.WRITE_ONLY,
+                              size=len(counters) * np.dtype(np.float32).itemsize)
+    bits = np.empty_like(counters)
+    angles = np.empty(len(counters), dtype=np.float32)
+
+    for key in [0, 0xffffffff] + list(random_state.randint(0, 2 ** 32, size=4, dtype=np.uint64)):
+        k_philox(backend.queue, (len(counters),), None, counters_buffer, np.uint32(key),
+                 bits_buffer, angles_buffer)
+        cl.enqueue_copy(backend.queue, bits, bits_buffer)
+        cl.enqueue_copy(backend.queue, angles, angles_buffer)
+        expected_bits = np_comp.philox2x32(counters[:, 0], counters[:, 1], key)
+        np.testing.assert_array_equal(bits[:, 0], expected_bits[0], "key %x" % key)
+        np.testing.assert_array_equal(bits[:, 1], expected_bits[1], "key %x" % key)
+        np.testing.assert_array_equal(
+            angles, np_comp.random_angle(counters[:, 0], counters[:, 1], key), "key %x" % key)
+    assert angles.min() >= 0 and angles.max() < 2 * np.pi
+
+
+def test_reynolds_rules_match_the_kernels(configs, backends):
+    (_, numpy_flocks, _), (opencl_backend, opencl_flocks, opencl_map) = backends
+    configs.fused_agent_step = False
+    opencl_backend.generate_flocks(1, 1, opencl_flocks, opencl_map, work_ahead=False)
+    previous_flock = numpy_flocks[0].np_arrays.astype(np.float32)
+
+    pos_sum, vel_sum = np_comp.agent_reynolds_rules13_preprocess(previous_flock)
+    groups_n = -(-configs.NumberOfBoids //
+                 opencl_backend.gpu_params["local_sizes"]["k_agent_reynolds_rules13_preprocess"])
+    for name, flock_sum in [("global_flock_pos_sum", pos_sum), ("global_flock_vel_sum", vel_sum)]:
+        group_sums = download(opencl_backend, name, np.float32)
+        np.testing.assert_allclose(
+            group_sums[:groups_n * configs.Dimensions].reshape(groups_n, -1).sum(axis=0),
+            flock_sum, rtol=1e-6, atol=1e-6, err_msg=name)
+
+    np.testing.assert_allclose(
+        download(opencl_backend, "global_boid_avoidance_vectors", np.float32).reshape(
+            configs.NumberOfBoids, configs.Dimensions),
+        np_comp.agent_reynolds_rule2_preprocess(previous_flock), rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("fused_agent_step", [False, True])
+def test_steps_match_the_kernels(configs, backends, fused_agent_step):
+    configs.fused_agent_step = fused_agent_step
+    (numpy_backend, numpy_flocks, numpy_map), (opencl_backend, opencl_flocks, opencl_map) = \
+        backends
+    for step in range(1, STEPS_N + 1):
+        numpy_backend.generate_flocks(step, 1, numpy_flocks, numpy_map)
+        opencl_backend.generate_flocks(step, 1, opencl_flocks, opencl_map, work_ahead=False)
+
+        assert_same_states(numpy_backend, opencl_backend, step)
+        np.testing.assert_allclose(opencl_flocks[step].np_arrays, numpy_flocks[step].np_arrays,
+                                   rtol=0, atol=FLOCK_TOLERANCE,
+                                   err_msg="flock of step %d" % step)
+        np.testing.assert_array_equal(opencl_map[step], numpy_map[step],
+                                      "listed map of step %d" % step)
+
+
+def test_fixed_pheromone_levels(configs):
+    """ Levels are rounded to the nearest 16.16 fixed point value, which reads back exactly """
+    assert maze.get_node_dtype().itemsize == configs.NODE_SIZE
+    assert configs.NODE_SIZE % 4 == 0
+    levels = np.array([0, 0.01, 1, 2.5, 255.99], dtype=np.float32)
+    fixed_levels = maze.to_fixed_pheromone_levels(levels)
+    np.testing.assert_array_equal(fixed_levels, [0, 655, 65536, 163840, 16776561])
+    np.testing.assert_array_equal(
+        maze.to_fixed_pheromone_levels(maze.to_pheromone_levels(fixed_levels)), fixed_levels)
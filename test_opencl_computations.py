@@ -0,0 +1,173 @@
+"""
+Device selection by the override strings (see opencl_computations.init_opencl()) on
+fake platforms, the keys and the files of the program caches, and maps put together
+from the lists of the changed nodes (cfg.track_map_changes) against the full maps
+downloaded from the device.
+"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import maze
+import recorder
+
+cl_comp = pytest.importorskip("opencl_computations")
+
+SEED = 5
+INSTANCES_N = 2
+STEPS_N = 24
+
+
+@pytest.mark.parametrize("device_override, expected", [
+    ("CPU", ["Some CPU"]), ("gpu", ["Fast GPU", "Slow GPU"]), ("ACCELERATOR", []),
+    ("0:1", ["Slow GPU"]), ("1:0", ["Some CPU"]), ("slow", ["Slow GPU"]),
+    # Indices out of range
+    ("7:0", []), ("1:1", []), ("0:2", [])])
+def test_device_matches(configs, fake_platforms, device_override, expected):
+    assert [device.name for device in cl_comp.get_candidate_devices()
+            if cl_comp.device_matches(device, device_override)] == expected
+
+
+def test_candidate_devices_are_preferred(configs, fake_platforms):
+    configs.device_preference = ["CPU", "GPU"]
+    assert [device.name for device in cl_comp.get_candidate_devices()] == \
+        ["Some CPU", "Fast GPU", "Slow GPU"]
+    configs.device_preference = ["GPU"]
+    assert [device.name for device in cl_comp.get_candidate_devices()] == \
+        ["Fast GPU", "Slow GPU"]
+
+
+@pytest.mark.parametrize("device_override", ["7:0", "0:5", "TPU"])
+def test_no_matching_device(configs, fake_platforms, device_override):
+    # The auto backend falls back to NumPy on the RuntimeError
+    with pytest.raises(RuntimeError, match="No OpenCL device matches"):
+        cl_comp.init_opencl(device_override)
+
+
+@pytest.fixture
+def cache_sources(configs, tmp_path):
+    """ A copy of the OpenCL sources (cfg.cl_dir) the cache keys are computed from """
+    cl_dir = tmp_path / "opencl"
+    shutil.copytree(os.path.join(os.getcwd(), configs.cl_dir), str(cl_dir))
+    configs.cl_dir = str(cl_dir)
+    return cl_dir
+
+
+def test_cache_key_changes(cache_sources, fake_platforms):
+    device = fake_platforms[0].get_devices()[0]
+    prog_params = {"number_of_boids": 100, "maze_width": 21}
+    key = cl_comp.get_cache_key(device, prog_params, "-I opencl")
+    assert cl_comp.get_cache_key(device, dict(prog_params), "-I opencl") == key
+
+    other_keys = [cl_comp.get_cache_key(device, dict(prog_params, number_of_boids=101),
+                                        "-I opencl"),
+                  cl_comp.get_cache_key(device, prog_params, "-I opencl -cl-fast-relaxed-math"),
+                  cl_comp.get_cache_key(fake_platforms[0].get_devices()[1], prog_params,
+                                        "-I opencl")]
+    device.driver_version = "1.1"
+    other_keys.append(cl_comp.get_cache_key(device, prog_params, "-I opencl"))
+    device.driver_version = "1.0"
+    # Headers are included by main.cl, they count as much as the rest of the sources
+    with open(str(cache_sources / "agents.h"), "a") as header_f:
+        header_f.write("\n")
+    other_keys.append(cl_comp.get_cache_key(device, prog_params, "-I opencl"))
+    assert len(set(other_keys + [key])) == len(other_keys) + 1
+
+
+def test_work_group_params_round_trip(configs):
+    assert cl_comp.load_work_group_params("a") is None
+    cl_comp.save_work_group_params("a", {"preferred_multiple": 32, "max_work_group_size": 256})
+    cl_comp.save_work_group_params("b", {"preferred_multiple": 64, "max_work_group_size": 1024})
+    assert cl_comp.load_work_group_params("a") == {"preferred_multiple": 32,
+                                                   "max_work_group_size": 256}
+    assert cl_comp.load_work_group_params("b") == {"preferred_multiple": 64,
+                                                   "max_work_group_size": 1024}
+    # Nothing but the cache is left in the directory
+    assert os.listdir(configs.cl_cache_dir) == [configs.cl_work_groups_url]
+
+    configs.cl_cache_on = False
+    assert cl_comp.load_work_group_params("a") is None
+
+
+def test_failed_cache_write_keeps_the_file(configs):
+    cl_comp.save_work_group_params("a", {"preferred_multiple": 32})
+    # Parameters which can't be written
+    with pytest.raises(TypeError):
+        cl_comp.save_work_group_params("b", {"preferred_multiple": object()})
+    assert cl_comp.load_work_group_params("a") == {"preferred_multiple": 32}
+
+    with open(os.path.join(configs.cl_cache_dir, configs.cl_work_groups_url), "w") as cache_f:
+        cache_f.write("{\"a\": ")
+    assert cl_comp.load_work_group_params("a") is None
+    cl_comp.save_work_group_params("a", {"preferred_multiple": 16})
+    assert cl_comp.load_work_group_params("a") == {"preferred_multiple": 16}
+
+
+@pytest.fixture
+def run_instances(configs, generate_instance, create_opencl_backend, template_triangles):
+    """ Runs the instances in batches of the given steps. Returns their flocks and maps """
+    configs.random_seed = SEED
+    configs.batch_instances = INSTANCES_N
+    configs.total_timesteps = STEPS_N + 1
+    instances = [generate_instance(SEED + instance) for instance in range(INSTANCES_N)]
+
+    def run(steps_per_batch, on_batch=None):
+        backend = create_opencl_backend()
+        global_maps = backend.prepare_batch([first_flocks[0] for _, first_flocks in instances],
+                                            [amaze for amaze, _ in instances],
+                                            template_triangles)
+        instances_flocks = [recorder.create_flock_history(list(first_flocks), instance)
+                            for instance, (_, first_flocks) in enumerate(instances)]
+        for step in range(1, STEPS_N + 1, steps_per_batch):
+            steps_n = min(steps_per_batch, STEPS_N + 1 - step)
+            backend.generate_batch(step, steps_n, instances_flocks, work_ahead=on_batch is None)
+            if on_batch is not None:
+                on_batch(backend, global_maps, step + steps_n - 1)
+        return instances_flocks, global_maps
+    return run
+
+
+def assert_maps_are_downloaded(backend, global_maps, step):
+    """ The shadow is the whole map the changes of the step are listed against """
+    full_maps = backend.get_state()["global_map_shadow"].view(maze.get_node_dtype()).reshape(
+        INSTANCES_N, backend.current_maps.shape[1], backend.current_maps.shape[2])
+    for instance in range(INSTANCES_N):
+        np.testing.assert_array_equal(global_maps[instance][step], full_maps[instance],
+                                      "map of instance %d at step %d" % (instance, step))
+
+
+def test_map_changes_match_full_maps(run_instances):
+    _, global_maps = run_instances(1, assert_maps_are_downloaded)
+    # The pheromones have spread, so there is something to patch
+    assert (global_maps[0][STEPS_N]["pheromone_a"] > 0).any()
+
+
+@pytest.mark.parametrize("steps_per_batch", [4, 7])
+def test_batched_map_changes_match_single_steps(configs, run_instances, steps_per_batch):
+    _, single_step_maps = run_instances(1, assert_maps_are_downloaded)
+    configs.steps_per_batch = steps_per_batch
+    _, batched_maps = run_instances(steps_per_batch)
+    for instance in range(INSTANCES_N):
+        np.testing.assert_array_equal(batched_maps[instance][:STEPS_N + 1],
+                                      single_step_maps[instance][:STEPS_N + 1],
+                                      "maps of instance %d" % instance)
+
+
+@pytest.mark.parametrize("record_on", [False, True])
+def test_batched_flocks_match_single_steps(configs, run_instances, record_on):
+    """ Flocks are downloaded into a ring of slots, every step must keep its own """
+    configs.record_on = record_on
+    single_step_flocks, _ = run_instances(1)
+    # The recordings of both runs are written into the same files
+    single_step_flocks = [np.array([flock.np_arrays for flock in flocks])
+                          for flocks in single_step_flocks]
+    configs.steps_per_batch = 4
+    batched_flocks, _ = run_instances(4)
+    for instance in range(INSTANCES_N):
+        assert len(batched_flocks[instance]) == STEPS_N + 1
+        np.testing.assert_array_equal(np.array([flock.np_arrays
+                                                for flock in batched_flocks[instance]]),
+                                      single_step_flocks[instance],
+                                      "flocks of instance %d" % instance)
@@ -0,0 +1,138 @@
+"""
+Recordings of the steps of a run (see recorder.ChunkedSteps) written, read back,
+truncated and restored.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import agents
+import recorder
+
+STEP_SHAPE = (3, 2)
+CHUNK_STEPS = 4
+
+
+@pytest.fixture
+def steps(configs):
+    """ Random steps recorded in small chunks, so that most of them are saved """
+    configs.record_chunk_steps = CHUNK_STEPS
+    configs.record_window_chunks = 1
+    configs.steps_per_batch = 1
+    return np.random.RandomState(0).rand(11, *STEP_SHAPE).astype(np.float32)
+
+
+def record(steps):
+    history = recorder.ChunkedSteps("steps", STEP_SHAPE, np.float32)
+    for values in steps:
+        history.append(values)
+    return history
+
+
+def get_chunk_files(history):
+    return sorted(os.listdir(history.path))
+
+
+def test_steps_are_read_back(steps):
+    history = record(steps)
+    assert len(history) == len(steps)
+    # The first chunks have left the window and are read from their files
+    assert 0 not in history.chunks
+    for step, values in enumerate(steps):
+        np.testing.assert_array_equal(history[step], values)
+    np.testing.assert_array_equal(history[-1], steps[-1])
+    np.testing.assert_array_equal(history[2:9], steps[2:9])
+    with pytest.raises(IndexError):
+        history[len(steps)]
+
+
+def test_saved_steps_cannot_be_changed(steps):
+    history = record(steps)
+    history[len(steps) - 1] = 0
+    assert (history[len(steps) - 1] == 0).all()
+    with pytest.raises(IndexError):
+        history[0] = 0
+    # Assigning the step after the last one appends it
+    history[len(steps)] = steps[0]
+    np.testing.assert_array_equal(history[len(steps)], steps[0])
+
+
+def test_flushed_recording_is_restored(steps):
+    history = record(steps)
+    history.flush()
+    assert get_chunk_files(history) == ["000000.npy", "000001.npy", "000002.npy"]
+
+    restored = recorder.ChunkedSteps("steps", STEP_SHAPE, np.float32)
+    restored.restore(len(steps))
+    np.testing.assert_array_equal(restored[:], steps)
+    # The recording goes on after the restored steps
+    restored.append(steps[0])
+    np.testing.assert_array_equal(restored[len(steps)], steps[0])
+
+
+def test_restored_prefix_drops_the_rest(steps):
+    record(steps).flush()
+    restored = recorder.ChunkedSteps("steps", STEP_SHAPE, np.float32)
+    restored.restore(6)
+    assert len(restored) == 6
+    np.testing.assert_array_equal(restored[:], steps[:6])
+    restored.append(steps[0])
+    restored.flush()
+    np.testing.assert_array_equal(restored[:], np.concatenate([steps[:6], steps[:1]]))
+    assert get_chunk_files(restored) == ["000000.npy", "000001.npy"]
+
+
+@pytest.mark.parametrize("length", [0, 4, 5, 9])
+def test_truncated_recording(steps, length):
+    history = record(steps)
+    del history[length:]
+    assert len(history) == length
+    np.testing.assert_array_equal(history[:], steps[:length])
+    with pytest.raises(IndexError):
+        history[length]
+    # The last chunk left can still be changed and appended to
+    history.append(steps[-1])
+    np.testing.assert_array_equal(history[length], steps[-1])
+    history.flush()
+    restored = recorder.ChunkedSteps("steps", STEP_SHAPE, np.float32)
+    restored.restore(length + 1)
+    np.testing.assert_array_equal(restored[:], np.concatenate([steps[:length], steps[-1:]]))
+    assert len(get_chunk_files(history)) == length // CHUNK_STEPS + 1
+
+
+def test_only_the_last_steps_are_deleted(steps):
+    history = record(steps)
+    with pytest.raises(IndexError):
+        del history[2:5]
+    with pytest.raises(IndexError):
+        del history[3]
+
+
+def test_flock_history_round_trip(configs, steps):
+    configs.record_on = True
+    flocks = []
+    for step in range(len(steps)):
+        flock = agents.Flock(configs.NumberOfBoids)
+        flock.np_arrays = np.full((configs.NumberOfBoids, agents.Boid.arrayLen), step,
+                                  dtype=np.float32)
+        flocks.append(flock)
+    history = recorder.create_flock_history(flocks[:1])
+    history.extend(flocks[1:])
+    assert [flock.np_arrays[0, 0] for flock in history] == list(range(len(steps)))
+
+    del history[7:]
+    recorder.flush(history)
+    restored = recorder.FlockHistory("flocks_0")
+    restored.restore(7)
+    assert len(restored) == 7
+    for step in range(7):
+        np.testing.assert_array_equal(restored[step].np_arrays, flocks[step].np_arrays)
+
+
+def test_map_history_starts_empty(configs):
+    configs.record_on = True
+    configs.track_map_changes = True
+    history = recorder.create_map_history()
+    assert len(history) == 1
+    assert not history[0]["flags"].any() and not history[0]["pheromone_a"].any()
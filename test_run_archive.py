@@ -0,0 +1,67 @@
+"""
+Runs saved into archives (see run_archive.py) and loaded back.
+"""
+import numpy as np
+import pytest
+
+import numpy_computations as np_comp
+import recorder
+import run_archive
+import simulator
+
+SEED = 11
+STEPS_N = 16
+COMPUTATION_TIME = 1.5
+
+
+@pytest.mark.parametrize("track_map_changes", [False, True])
+@pytest.mark.parametrize("record_on", [False, True])
+def test_archive_round_trip(configs, generate_instance, template_triangles, tmp_path,
+                            track_map_changes, record_on):
+    configs.random_seed = SEED
+    configs.total_timesteps = STEPS_N
+    configs.track_map_changes = track_map_changes
+    configs.record_on = record_on
+    # The goal is checked on the backend when the maps aren't downloaded
+    configs.backend_goal_check = True
+    amaze, first_flocks = generate_instance(SEED)
+    flocks = recorder.create_flock_history(list(first_flocks))
+    backend = np_comp.NumpyBackend()
+    global_map, _, completion_time, _ = simulator.run(backend, amaze, flocks,
+                                                      template_triangles)
+    experiment_data = backend.get_experiment_data()
+    settings = {name: getattr(configs, name) for name in run_archive.ARCHIVED_SETTINGS}
+    archive_url = str(tmp_path / "archive")
+    run_archive.save(amaze, flocks, global_map, experiment_data, completion_time,
+                     COMPUTATION_TIME, archive_url)
+
+    archive = run_archive.RunArchive(archive_url)
+    assert archive.settings == settings
+    assert archive.steps_n == len(flocks) == STEPS_N
+    assert archive.completion_time == completion_time
+    assert archive.computation_time == COMPUTATION_TIME
+    assert (archive.maze.get_numeric_matrix() == amaze.get_numeric_matrix()).all()
+    np.testing.assert_array_equal(archive.get_experiment_data(), experiment_data)
+    # Positions, velocities, pheromones, orientations and the triangles rebuilt from them
+    assert len(archive.flocks) == len(flocks)
+    for step in range(len(flocks)):
+        np.testing.assert_array_equal(archive.flocks[step].np_arrays, flocks[step].np_arrays,
+                                      "flock of step %d" % step)
+    np.testing.assert_array_equal(archive.flocks[-1].np_arrays, flocks[-1].np_arrays)
+    if track_map_changes:
+        np.testing.assert_array_equal(archive.global_map, global_map[:STEPS_N])
+        # The pheromones have spread, so the maps are not all empty
+        assert (archive.global_map["pheromone_a"] > 0).any()
+    else:
+        assert archive.global_map is None
+
+    configs.NumberOfBoids += 1
+    configs.total_timesteps = 1000
+    archive.apply_settings()
+    assert {name: getattr(configs, name) for name in run_archive.ARCHIVED_SETTINGS} == \
+        dict(settings, total_timesteps=STEPS_N)
+
+
+def test_incomplete_archive(configs, tmp_path):
+    with pytest.raises(ValueError, match="not a complete run archive"):
+        run_archive.RunArchive(str(tmp_path))
@@ -0,0 +1,48 @@
+"""
+Runs continued from their checkpoints (see simulator.save_checkpoint()) against the
+same runs computed in one go.
+"""
+import numpy as np
+import pytest
+
+import numpy_computations as np_comp
+import recorder
+import simulator
+
+SEED = 7
+STEPS_N = 40
+CHECKPOINT_INTERVAL = 20
+
+
+@pytest.fixture(params=["NumPy", "OpenCL"])
+def create_backend(request):
+    if request.param == "NumPy":
+        return np_comp.NumpyBackend
+    return request.getfixturevalue("create_opencl_backend")
+
+
+@pytest.mark.parametrize("record_on", [False, True])
+def test_resumed_run_is_identical(configs, generate_instance, create_backend,
+                                  template_triangles, record_on):
+    configs.random_seed = SEED
+    configs.total_timesteps = STEPS_N + 1
+    configs.checkpoint_interval = CHECKPOINT_INTERVAL
+    configs.record_on = record_on
+    amaze, first_flocks = generate_instance(SEED)
+    flocks = recorder.create_flock_history(list(first_flocks))
+    global_map, _, completion_time, _ = simulator.run(create_backend(), amaze, flocks,
+                                                      template_triangles)
+    assert completion_time == 0, "The maze is solved before the end of the run"
+    # Recordings are overwritten by the resumed run
+    expected_flocks = np.array([flock.np_arrays for flock in flocks])
+    expected_map = global_map[:STEPS_N + 1].copy()
+
+    checkpoint = simulator.load_checkpoint()
+    assert checkpoint["step"] == CHECKPOINT_INTERVAL
+    flocks = checkpoint["flocks"]
+    global_map, _, _, _ = simulator.run(create_backend(), checkpoint["maze"], flocks,
+                                        template_triangles, checkpoint)
+
+    np.testing.assert_array_equal(np.array([flock.np_arrays for flock in flocks]),
+                                  expected_flocks)
+    np.testing.assert_array_equal(global_map[:STEPS_N + 1], expected_map)